@@ -0,0 +1,126 @@
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Compares C{twisted.internet.task.coiterate} (one task per burst of data, the
+old behaviour) with L{cooperator.Cooperator} (one task per connection, woken
+for each burst) when many connections receive a small message at the same
+time.
+
+Every round, each connection gets a message and starts decoding it. The
+delay is the time between a connection getting its message and the message
+being decoded.
+
+Usage::
+
+    python benchmarks/cooperator.py [--connections N]
+"""
+
+import sys
+import time
+
+from twisted.internet import reactor, task, defer
+
+from rtmpy.protocol.rtmp import cooperator
+
+
+CONNECTIONS = [100, 1000, 5000]
+ROUNDS = 5
+
+
+class Decoder(object):
+    """
+    Decodes one message (a few microseconds of work) per call to C{next}.
+    """
+
+    def __init__(self, delays):
+        self.delays = delays
+        self.messages = []
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if not self.messages:
+            raise StopIteration
+
+        received = self.messages.pop()
+        sum(xrange(50))
+
+        self.delays.append(time.time() - received)
+
+
+def coiterate(decoder):
+    return task.coiterate(decoder)
+
+
+def cooperate(decoder):
+    t = getattr(decoder, 'task', None)
+
+    if t is None:
+        t = decoder.task = cooperator.getCooperator().decode(decoder)
+    else:
+        t.wake()
+
+    return t.whenDone()
+
+
+@defer.inlineCallbacks
+def run(start, connections):
+    delays = []
+    decoders = [Decoder(delays) for i in xrange(connections)]
+
+    begin = time.time()
+
+    for i in xrange(ROUNDS):
+        tasks = []
+
+        for decoder in decoders:
+            decoder.messages.append(time.time())
+            tasks.append(start(decoder))
+
+        yield defer.DeferredList(tasks)
+
+    elapsed = time.time() - begin
+    delays.sort()
+
+    defer.returnValue((elapsed / (ROUNDS * connections) * 1e6,
+        delays[len(delays) // 2] * 1000, delays[len(delays) * 99 // 100] * 1000))
+
+
+@defer.inlineCallbacks
+def main(sizes):
+    print '%12s %12s %14s %10s %10s' % ('connections', 'scheduler',
+        'us/message', 'p50 (ms)', 'p99 (ms)')
+
+    for connections in sizes:
+        for name, start in [('coiterate', coiterate),
+                ('cooperator', cooperate)]:
+            result = yield run(start, connections)
+
+            print '%12d %12s %14.2f %10.2f %10.2f' % ((connections, name) +
+                result)
+
+    reactor.stop()
+
+
+if __name__ == '__main__':
+    sizes = CONNECTIONS
+
+    if '--connections' in sys.argv:
+        sizes = [int(sys.argv[sys.argv.index('--connections') + 1])]
+
+    reactor.callWhenRunning(main, sizes)
+    reactor.run()
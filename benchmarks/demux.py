@@ -0,0 +1,93 @@
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Measures the cost of reassembling chunked RTMP messages in
+L{codec.ChannelDemuxer} across a range of frame and message sizes.
+
+The cost per byte should stay (roughly) flat as the message size grows, i.e.
+reassembly is linear in the size of the message.
+
+Usage::
+
+    python benchmarks/demux.py
+"""
+
+import time
+
+from pyamf.util import BufferedByteStream
+
+from rtmpy import message
+from rtmpy.protocol.rtmp import codec, buffer
+
+
+FRAME_SIZES = [128, 1024, 4096]
+MESSAGE_SIZES = [16 * 1024, 64 * 1024, 256 * 1024, 1024 * 1024]
+
+
+def encode(frameSize, size):
+    """
+    Returns an RTMP stream containing one video message of C{size} bytes.
+    """
+    output = BufferedByteStream()
+    encoder = codec.Encoder(output)
+
+    encoder.setFrameSize(frameSize)
+    encoder.send('x' * size, message.VIDEO_DATA, 1, 0)
+
+    for _ in encoder:
+        pass
+
+    return output.getvalue()
+
+
+def demux(data, frameSize, stream):
+    demuxer = codec.ChannelDemuxer(stream=stream)
+    demuxer.setFrameSize(frameSize)
+    demuxer.send(data)
+
+    while True:
+        body, meta = demuxer.readFrame()
+
+        if body is not None:
+            return body
+
+
+def run(streamClass, repeat=5):
+    print streamClass.__name__
+    print '%10s %10s %12s %10s' % ('frame', 'message', 'total (ms)', 'ns/byte')
+
+    for frameSize in FRAME_SIZES:
+        for size in MESSAGE_SIZES:
+            data = encode(frameSize, size)
+            best = None
+
+            for _ in xrange(repeat):
+                start = time.time()
+                demux(data, frameSize, streamClass())
+                elapsed = time.time() - start
+
+                if best is None or elapsed < best:
+                    best = elapsed
+
+            print '%10d %10d %12.2f %10.1f' % (
+                frameSize, size, best * 1000, best * 1e9 / size)
+
+    print
+
+
+if __name__ == '__main__':
+    run(BufferedByteStream)
+    run(buffer.ByteBuffer)
@@ -0,0 +1,129 @@
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Compares per-frame and batched draining of L{codec.Decoder} when driven by a
+shared cooperator, as L{rtmpy.protocol.rtmp.BaseStreamer} does.
+
+Each connection receives C{--size} bytes of 4KB video messages (chunked at 128
+bytes) in a single C{dataReceived}. The cooperator is ticked by hand so the
+number of round trips can be counted.
+
+Usage::
+
+    python benchmarks/drain.py [--size BYTES]
+"""
+
+import sys
+import time
+
+from twisted.internet import task
+
+from pyamf.util import BufferedByteStream
+
+from rtmpy import message
+from rtmpy.protocol.rtmp import codec
+
+
+CONNECTIONS = [10, 100, 1000]
+MESSAGE_SIZE = 4096
+
+
+class Dispatcher(object):
+    """
+    Records the time at which each message was dispatched.
+    """
+
+    def __init__(self, times):
+        self.times = times
+
+    def dispatchMessage(self, stream, datatype, timestamp, data):
+        self.times.append(time.time())
+
+    def dispatchMessages(self, messages):
+        now = time.time()
+
+        self.times.extend([now] * len(messages))
+
+    def bytesInterval(self, bytes):
+        pass
+
+
+class StreamFactory(object):
+    def getStream(self, streamId):
+        return None
+
+
+def encode(size):
+    output = BufferedByteStream()
+    encoder = codec.Encoder(output)
+
+    for i in xrange(size // MESSAGE_SIZE):
+        encoder.send('x' * MESSAGE_SIZE, message.VIDEO_DATA, 1, i)
+
+    for _ in encoder:
+        pass
+
+    return output.getvalue()
+
+
+def run(connections, data, bytesBudget):
+    ticks = []
+    cooperator = task.Cooperator(scheduler=ticks.append)
+    times = []
+    streamFactory = StreamFactory()
+
+    start = time.time()
+
+    for _ in xrange(connections):
+        decoder = codec.Decoder(Dispatcher(times), streamFactory,
+            bytesBudget=bytesBudget)
+        decoder.send(data)
+
+        cooperator.coiterate(decoder)
+
+    rounds = 0
+
+    while ticks:
+        ticks.pop(0)()
+        rounds += 1
+
+    elapsed = time.time() - start
+    latency = sum([t - start for t in times]) / len(times)
+
+    return elapsed, rounds, latency
+
+
+def main(size):
+    data = encode(size)
+
+    print '%12s %8s %12s %8s %16s' % (
+        'connections', 'mode', 'total (ms)', 'ticks', 'latency (ms)')
+
+    for connections in CONNECTIONS:
+        for mode, bytesBudget in [('frame', 0), ('batch', 64 * 1024)]:
+            elapsed, rounds, latency = run(connections, data, bytesBudget)
+
+            print '%12d %8s %12.1f %8d %16.2f' % (
+                connections, mode, elapsed * 1000, rounds, latency * 1000)
+
+
+if __name__ == '__main__':
+    size = 64 * 1024
+
+    if '--size' in sys.argv:
+        size = int(sys.argv[sys.argv.index('--size') + 1])
+
+    main(size)
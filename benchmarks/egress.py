@@ -0,0 +1,121 @@
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Measures the egress throughput of L{codec.Encoder} when encoding to a
+L{BufferedByteStream} (one C{write} per iteration) versus a
+L{buffer.SequenceBuffer} (one C{writeSequence} per iteration).
+
+The loopback transport buffers writes the way Twisted's C{FileDescriptor}
+does and joins them when the "socket" is written to.
+
+Usage::
+
+    python benchmarks/egress.py [--total BYTES]
+
+The best of C{REPEAT} runs is reported.
+"""
+
+import sys
+import time
+
+from pyamf.util import BufferedByteStream
+
+from rtmpy import message
+from rtmpy.protocol.rtmp import codec, buffer
+
+
+MESSAGE_SIZES = [1024, 64 * 1024, 1024 * 1024]
+FRAME_SIZES = [128, 4096, 65536]
+REPEAT = 5
+
+
+class LoopbackTransport(object):
+    """
+    Buffers written data and joins it in to a single string every C{SEND_LIMIT}
+    bytes, like L{twisted.internet.abstract.FileDescriptor.doWrite}.
+    """
+
+    SEND_LIMIT = 128 * 1024
+
+    def __init__(self):
+        self.buffer = []
+        self.size = 0
+        self.sent = 0
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.size += len(data)
+
+        if self.size >= self.SEND_LIMIT:
+            self.doWrite()
+
+    def writeSequence(self, seq):
+        self.buffer.extend(seq)
+        self.size += sum([len(x) for x in seq])
+
+        if self.size >= self.SEND_LIMIT:
+            self.doWrite()
+
+    def doWrite(self):
+        self.sent += len(''.join(self.buffer))
+        self.buffer = []
+        self.size = 0
+
+
+def run(bufferClass, messageSize, frameSize, total):
+    return max([encode(bufferClass(), messageSize, frameSize, total)
+        for i in xrange(REPEAT)])
+
+
+def encode(stream, messageSize, frameSize, total):
+    transport = LoopbackTransport()
+    encoder = codec.Encoder(transport, stream=stream)
+    encoder.setFrameSize(frameSize)
+
+    data = 'x' * messageSize
+    count = max(1, total // messageSize)
+
+    start = time.time()
+
+    for i in xrange(count):
+        encoder.send(data, message.VIDEO_DATA, 1, i)
+
+        for _ in encoder:
+            pass
+
+    transport.doWrite()
+
+    return transport.sent / (time.time() - start) / (1024 * 1024)
+
+
+def main(total):
+    print '%10s %8s %16s %16s' % (
+        'message', 'frame', 'write (MB/s)', 'sequence (MB/s)')
+
+    for frameSize in FRAME_SIZES:
+        for messageSize in MESSAGE_SIZES:
+            print '%10d %8d %16.1f %16.1f' % (messageSize, frameSize,
+                run(BufferedByteStream, messageSize, frameSize, total),
+                run(buffer.SequenceBuffer, messageSize, frameSize, total))
+
+
+if __name__ == '__main__':
+    total = 16 * 1024 * 1024
+
+    if '--total' in sys.argv:
+        total = int(sys.argv[sys.argv.index('--total') + 1])
+
+    main(total)
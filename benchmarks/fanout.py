@@ -0,0 +1,88 @@
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Measures the cost of fanning a video frame out to a number of viewers via
+L{codec.StreamingChannel}, chunking the frame per viewer versus once per
+C{(frameSize, channelId)} group.
+
+Usage::
+
+    python benchmarks/fanout.py
+"""
+
+import time
+
+from pyamf.util import BufferedByteStream
+
+from rtmpy import message
+from rtmpy.protocol.rtmp import codec
+
+
+VIEWERS = [10, 100, 2000]
+FRAME_SIZES = [128, 4096]
+PAYLOAD = 'x' * (20 * 1024)
+
+
+class NullTransport(object):
+    def write(self, data):
+        pass
+
+    def writeSequence(self, data):
+        pass
+
+
+def build(viewers, frameSize):
+    channels = []
+    transport = NullTransport()
+
+    for i in xrange(viewers):
+        encoder = codec.Encoder(BufferedByteStream())
+        encoder.setFrameSize(frameSize)
+
+        channel = codec.StreamingChannel(encoder, 1, transport)
+        channel.setType(message.VIDEO_DATA)
+
+        channels.append(channel)
+
+    return channels
+
+
+def run(channels, shared, frames=10):
+    start = time.time()
+
+    for i in xrange(frames):
+        chunks = {} if shared else None
+
+        for channel in channels:
+            channel.sendData(PAYLOAD, i * 40, chunks)
+
+    return (time.time() - start) / (frames * len(channels))
+
+
+def main():
+    print '%8s %10s %18s %18s' % (
+        'viewers', 'frame', 'per viewer (us)', 'shared (us)')
+
+    for frameSize in FRAME_SIZES:
+        for viewers in VIEWERS:
+            channels = build(viewers, frameSize)
+
+            print '%8d %10d %18.2f %18.2f' % (viewers, frameSize,
+                run(channels, False) * 1e6, run(channels, True) * 1e6)
+
+
+if __name__ == '__main__':
+    main()
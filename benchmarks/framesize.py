@@ -0,0 +1,134 @@
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Compares the outbound frame size policies in L{codec} for header overhead
+against audio interleaving latency.
+
+A/V at 80% of the connection bandwidth (25fps video with a keyframe every 2
+seconds, 50 audio packets a second) is muxed through a L{codec.Encoder}. The
+overhead is the share of the output taken up by RTMP headers. The latency is
+how long an audio packet waits behind video frames before it has been written,
+at the connection bandwidth.
+
+C{first packet} is the old behaviour of using the size of the first keyframe.
+
+Usage::
+
+    python benchmarks/framesize.py [--seconds N]
+"""
+
+import sys
+
+from rtmpy import message
+from rtmpy.protocol.rtmp import codec
+
+
+BANDWIDTHS = [500000, 2500000, 10000000]
+FPS = 25
+GOP = 50
+KEYFRAME_RATIO = 8
+AUDIO_SIZE = 200
+
+
+class FirstPacketFrameSize(codec.FrameSizePolicy):
+    maximum = 0xffffff
+
+    def getFrameSize(self, bandwidth):
+        return len(video_frames(bandwidth, 1)[0])
+
+
+POLICIES = [
+    ('first packet', FirstPacketFrameSize()),
+    ('fixed 4096', codec.FixedFrameSize()),
+    ('bitrate', codec.BitrateFrameSize()),
+    ('latency 10ms', codec.LatencyFrameSize()),
+    ('latency 2ms', codec.LatencyFrameSize(0.002)),
+]
+
+
+class NullOutput(object):
+    def write(self, data):
+        pass
+
+
+def video_frames(bandwidth, count):
+    """
+    Returns C{count} video frames for a stream at 80% of C{bandwidth}.
+    """
+    gopBytes = bandwidth * 0.8 / 8 * GOP / FPS - (AUDIO_SIZE * 2 * GOP)
+    inter = int(gopBytes / (GOP - 1 + KEYFRAME_RATIO))
+
+    return ['\x17' + 'k' * (inter * KEYFRAME_RATIO) if i % GOP == 0 else
+        '\x27' + 'i' * inter for i in xrange(count)]
+
+
+def run(policy, bandwidth, seconds):
+    encoder = codec.Encoder(NullOutput())
+    encoder.setFrameSize(policy.getFrameSize(bandwidth))
+
+    delays = []
+    payload = [0]
+
+    def written():
+        return encoder.bytes + len(encoder.stream)
+
+    def send(data, datatype, timestamp, whenDone=None):
+        payload[0] += len(data)
+        encoder.send(data, datatype, 1, timestamp, whenDone)
+
+    def audio(timestamp):
+        start = written()
+
+        def done():
+            delays.append(written() - start)
+
+        send('\xaf\x01' + 'a' * (AUDIO_SIZE - 2), message.AUDIO_DATA,
+            timestamp, done)
+
+    for i, frame in enumerate(video_frames(bandwidth, seconds * FPS)):
+        timestamp = i * 1000 / FPS
+
+        send(frame, message.VIDEO_DATA, timestamp)
+        audio(timestamp)
+        audio(timestamp + 20)
+
+        for _ in encoder:
+            pass
+
+    overhead = float(encoder.bytes - payload[0]) / encoder.bytes
+    ms = lambda size: size * 8000.0 / bandwidth
+
+    return (encoder.frameSize, overhead * 100,
+        ms(sum(delays) / len(delays)), ms(max(delays)))
+
+
+def main(seconds):
+    print '%10s %14s %8s %14s %12s %12s' % ('bandwidth', 'policy', 'frame',
+        'overhead (%)', 'avg (ms)', 'max (ms)')
+
+    for bandwidth in BANDWIDTHS:
+        for name, policy in POLICIES:
+            print '%10d %14s %8d %14.2f %12.2f %12.2f' % ((bandwidth, name) +
+                run(policy, bandwidth, seconds))
+
+
+if __name__ == '__main__':
+    seconds = 10
+
+    if '--seconds' in sys.argv:
+        seconds = int(sys.argv[sys.argv.index('--seconds') + 1])
+
+    main(seconds)
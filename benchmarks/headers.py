@@ -0,0 +1,149 @@
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Counts the L{header.Header} objects allocated while decoding and encoding a
+stream of video messages, and the time taken per frame.
+
+Python 2 has no C{tracemalloc} so allocations are counted by wrapping
+C{Header.__init__}.
+
+Usage::
+
+    python benchmarks/headers.py [--messages N]
+"""
+
+import sys
+import time
+
+from rtmpy import message
+from rtmpy.protocol.rtmp import codec, header
+
+
+MESSAGE_SIZES = [100, 4096, 65536]
+
+
+class NullOutput(object):
+    def write(self, data):
+        pass
+
+
+class NullDispatcher(object):
+    def dispatchMessage(self, stream, datatype, timestamp, data):
+        pass
+
+
+class NullStreamFactory(object):
+    def getStream(self, streamId):
+        return None
+
+
+class HeaderCounter(object):
+    """
+    Counts calls to C{Header.__init__}.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.original = header.Header.__init__
+
+    def __enter__(self):
+        original = self.original
+        counter = self
+
+        def __init__(self, *args, **kwargs):
+            counter.count += 1
+            original(self, *args, **kwargs)
+
+        header.Header.__init__ = __init__
+
+        return self
+
+    def __exit__(self, *exc_info):
+        header.Header.__init__ = self.original
+
+
+def encode(size, messages):
+    """
+    Returns the encoded RTMP stream.
+    """
+    out = []
+
+    class Output(object):
+        def write(self, data):
+            out.append(data)
+
+    encoder = codec.Encoder(Output())
+    data = 'x' * size
+
+    for i in xrange(messages):
+        encoder.send(data, message.VIDEO_DATA, 1, i * 40)
+
+        for _ in encoder:
+            pass
+
+    return ''.join(out)
+
+
+def run_encode(size, messages):
+    encoder = codec.Encoder(NullOutput())
+    data = 'x' * size
+
+    with HeaderCounter() as counter:
+        start = time.time()
+
+        for i in xrange(messages):
+            encoder.send(data, message.VIDEO_DATA, 1, i * 40)
+
+            for _ in encoder:
+                pass
+
+        return counter.count, time.time() - start
+
+
+def run_decode(stream):
+    decoder = codec.Decoder(NullDispatcher(), NullStreamFactory())
+    decoder.send(stream)
+
+    with HeaderCounter() as counter:
+        start = time.time()
+
+        for _ in decoder:
+            pass
+
+        return counter.count, time.time() - start
+
+
+def main(messages):
+    print '%8s %8s %8s %14s %14s' % ('', 'message', 'frames', 'headers/msg',
+        'us/frame')
+
+    for size in MESSAGE_SIZES:
+        frames = messages * ((size + codec.FRAME_SIZE - 1) // codec.FRAME_SIZE)
+
+        for name, (count, elapsed) in [
+                ('decode', run_decode(encode(size, messages))),
+                ('encode', run_encode(size, messages))]:
+            print '%8s %8d %8d %14.2f %14.2f' % (name, size, frames,
+                float(count) / messages, elapsed / frames * 1e6)
+
+
+if __name__ == '__main__':
+    messages = 2000
+
+    if '--messages' in sys.argv:
+        messages = int(sys.argv[sys.argv.index('--messages') + 1])
+
+    main(messages)
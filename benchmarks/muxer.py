@@ -0,0 +1,82 @@
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Stress test for L{codec.ChannelMuxer}: a burst of small messages (think RPC
+responses or shared object updates) is queued on an L{codec.Encoder} and then
+drained. Beyond L{codec.MAX_CHANNELS} messages, the rest wait in the pending
+queue for a channel to be released.
+
+The time per message should stay flat as the burst grows.
+
+Usage::
+
+    python benchmarks/muxer.py [--messages N]
+"""
+
+import sys
+import time
+
+from rtmpy import message
+from rtmpy.protocol.rtmp import codec
+
+
+BURSTS = [1000, 10000]
+
+
+class NullOutput(object):
+    def write(self, data):
+        pass
+
+
+def run(messages):
+    encoder = codec.Encoder(NullOutput())
+    data = 'x' * 64
+
+    start = time.time()
+
+    for i in xrange(messages):
+        encoder.send(data, message.INVOKE, 0, i)
+
+    queued = time.time()
+    pending = len(encoder.pending)
+
+    for _ in encoder:
+        pass
+
+    done = time.time()
+
+    return pending, queued - start, done - queued
+
+
+def main(bursts):
+    print '%10s %10s %12s %12s %14s' % (
+        'messages', 'pending', 'queue (ms)', 'drain (ms)', 'per msg (us)')
+
+    for messages in bursts:
+        pending, queued, drained = run(messages)
+
+        print '%10d %10d %12.1f %12.1f %14.2f' % (messages, pending,
+            queued * 1000, drained * 1000,
+            (queued + drained) / messages * 1e6)
+
+
+if __name__ == '__main__':
+    bursts = BURSTS + [100000]
+
+    if '--messages' in sys.argv:
+        bursts = [int(sys.argv[sys.argv.index('--messages') + 1])]
+
+    main(bursts)
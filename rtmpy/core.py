@@ -301,15 +301,19 @@ class NetStream(BaseStream):
         return self.nc.client
 
 
-    def sendMessage(self, msg, whenDone=None):
+    def sendMessage(self, msg, whenDone=None, deadline=None):
         """
         Sends an RTMP message to the peer. This a low level method and is not
         part of any public api. If its use is necessary then this is a bug.
 
         @param msg: The RTMP message to be sent by this stream.
         @type: L{message.Message}
+        @param deadline: If the message has not started to be written by this
+            time (see C{reactor.seconds}), it is dropped. Command messages are
+            always written.
         """
-        self.nc.sendMessage(msg, stream=self, whenDone=whenDone)
+        self.nc.sendMessage(msg, stream=self, whenDone=whenDone,
+            deadline=deadline)
 
 
     @rpc.expose
@@ -0,0 +1,108 @@
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Helpers for inspecting the FLV audio/video tag payloads carried by RTMP audio
+and video messages.
+
+Only the first couple of bytes of each payload are looked at, nothing is
+decoded.
+
+@see: U{FLV spec<http://www.adobe.com/devnet/f4v.html>} (Annex E)
+"""
+
+from rtmpy import message
+
+
+__all__ = [
+    'frame_type',
+    'is_keyframe',
+    'is_video_sequence_header',
+    'is_audio_sequence_header',
+    'is_sequence_header',
+]
+
+
+#: Video frame types (the high nibble of the first byte of a video tag)
+KEYFRAME = 1
+INTER_FRAME = 2
+DISPOSABLE_INTER_FRAME = 3
+GENERATED_KEYFRAME = 4
+INFO_FRAME = 5
+
+#: Video codec id for H.264
+CODEC_AVC = 7
+#: Audio sound format for AAC
+SOUND_FORMAT_AAC = 10
+
+#: The AVCPacketType/AACPacketType for a sequence header
+SEQUENCE_HEADER = 0
+
+
+
+def frame_type(data):
+    """
+    Returns the frame type of the video tag C{data} or C{None} if C{data} is
+    empty.
+    """
+    if not data:
+        return None
+
+    return ord(data[0]) >> 4
+
+
+def is_keyframe(data):
+    """
+    Whether the video tag C{data} contains a keyframe (a point from which a
+    decoder can start). AVC sequence headers are flagged as keyframes by
+    encoders, they are I{not} considered keyframes here.
+    """
+    if frame_type(data) != KEYFRAME:
+        return False
+
+    return not is_video_sequence_header(data)
+
+
+def is_video_sequence_header(data):
+    """
+    Whether the video tag C{data} is an AVC sequence header (the decoder
+    configuration record).
+    """
+    return (len(data) > 1 and ord(data[0]) & 0x0f == CODEC_AVC and
+        ord(data[1]) == SEQUENCE_HEADER)
+
+
+def is_audio_sequence_header(data):
+    """
+    Whether the audio tag C{data} is an AAC sequence header (the audio
+    specific config).
+    """
+    return (len(data) > 1 and ord(data[0]) >> 4 == SOUND_FORMAT_AAC and
+        ord(data[1]) == SEQUENCE_HEADER)
+
+
+def is_sequence_header(datatype, data):
+    """
+    Whether the payload of an RTMP audio/video message is a sequence header.
+
+    @param datatype: L{message.AUDIO_DATA} or L{message.VIDEO_DATA}.
+    """
+    if datatype == message.VIDEO_DATA:
+        return is_video_sequence_header(data)
+
+    if datatype == message.AUDIO_DATA:
+        return is_audio_sequence_header(data)
+
+    return False
@@ -30,6 +30,16 @@ class IMessageDispatcher(Interface):
         """
 
 
+    def dispatchMessages(messages):
+        """
+        Called with a batch of completely received RTMP messages, in the order
+        that they were received.
+
+        @param messages: A C{list} of C{(stream, datatype, timestamp, data)}
+            tuples. See L{dispatchMessage}.
+        """
+
+
     def bytesInterval(bytes):
         """
         Called when a specified number of bytes has been read from the stream.
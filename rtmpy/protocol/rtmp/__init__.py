@@ -30,12 +30,13 @@ into fixed size body chunks.
 """
 
 from twisted.python import log, failure
-from twisted.internet import protocol, task
+from twisted.internet import protocol
+from twisted.internet.interfaces import IPushProducer
 from zope.interface import Interface, Attribute, implements
 from pyamf.util import BufferedByteStream
 
 from rtmpy import message
-from rtmpy.protocol.rtmp import codec
+from rtmpy.protocol.rtmp import codec, buffer, cooperator, ping, shaping
 from rtmpy.protocol import interfaces
 
 
@@ -66,10 +67,18 @@ class MessageDispatcher(object):
     A proxy class that listens for events fired from the L{codec.Decoder}.
 
     @param streamer: The L{BaseStreamer} instance attached to the decoder.
+    @cvar passThrough: A map of datatype -> stream method name. The raw
+        payload of these messages is handed straight to the stream, no
+        L{message.Message} instance is built. Used for audio/video data.
     """
 
     implements(interfaces.IMessageDispatcher)
 
+    passThrough = {
+        message.AUDIO_DATA: 'onAudioData',
+        message.VIDEO_DATA: 'onVideoData',
+    }
+
 
     def __init__(self, streamer):
         self.streamer = streamer
@@ -82,14 +91,34 @@ class MessageDispatcher(object):
         @param stream: The L{Stream} to receive this message.
         @param datatype: The RTMP datatype for the message.
         @param timestamp: The absolute timestamp this message was received.
-        @param data: The raw data for the message.
+        @param data: The raw data for the message. May be a C{memoryview} if
+            the decoder is reading from a L{buffer.ByteBuffer}.
         """
+        name = self.passThrough.get(datatype, None)
+
+        if name is not None:
+            return getattr(stream, name)(buffer.tobytes(data), timestamp)
+
         m = message.classByType(datatype)()
 
-        m.decode(BufferedByteStream(data))
+        m.decode(BufferedByteStream(buffer.tobytes(data)))
         m.dispatch(stream, timestamp)
 
 
+    def dispatchMessages(self, messages):
+        """
+        Called when the RTMP decoder has read a batch of complete RTMP
+        messages.
+
+        @param messages: A C{list} of C{(stream, datatype, timestamp, data)}
+            tuples.
+        """
+        dispatchMessage = self.dispatchMessage
+
+        for args in messages:
+            dispatchMessage(*args)
+
+
 
     def bytesInterval(self, bytes):
         """
@@ -108,11 +137,76 @@ class BaseStreamer(object):
     Provides all the base functionality for handling an RTMP input/output.
 
     @ivar decoder: RTMP Decoder that is fed data via L{dataReceived}
+    @cvar decodingBuffer: The class used to buffer raw RTMP data for the
+        decoder. Set to L{buffer.ByteBuffer} to decode frame bodies as
+        C{memoryview}s instead of copying them out of the buffer.
+    @cvar encodingBuffer: The class used to buffer encoded RTMP data before
+        it is written. Set to L{buffer.SequenceBuffer} to write the encoded
+        headers and frame bodies with a single C{writeSequence} call, the
+        writer must support it.
+    @cvar decodingBytesBudget: The maximum number of bytes the decoder will
+        drain per cooperative iteration. C{0} (and no time budget) means one
+        frame per iteration. See L{codec.Decoder.drain}.
+    @cvar decodingTimeBudget: The maximum number of seconds the decoder will
+        spend draining per cooperative iteration.
+    @cvar inlineDecodingBudget: If the decoder is idle and no more than this
+        many bytes are waiting to be decoded, they are decoded right away in
+        L{dataReceived} instead of waiting for the cooperator. Keeps small
+        control and RPC messages from waiting a reactor turn. C{0} disables
+        inline decoding.
+    @cvar decodingBufferLimit: The maximum number of bytes of partially
+        received messages the decoder will hold. The connection is dropped if
+        the peer exceeds it. See L{codec.ChannelDemuxer.setLimits}.
+    @cvar decodingChannelLimit: The maximum number of channels that can have a
+        partially received message at the same time. The connection is
+        dropped if the peer exceeds it.
+    @cvar decodingMessageLimits: The maximum body length per datatype (C{None}
+        for any other datatype, C{0} for no limit). Larger messages are
+        discarded.
+    @cvar highWatermark: The number of bytes waiting to be sent by the writer
+        at which it is asked to pause encoding, see L{pauseEncoding}.
+    @ivar encodingPaused: Whether encoding has been paused, see
+        L{pauseEncoding}.
+    @cvar sendWindowScale: The number of send windows that may be
+        unacknowledged before the encoder is throttled. The peer only
+        acknowledges once per window so this must be more than 1.
+    @ivar sendWindow: The acknowledgement window that the peer has been asked
+        to use, see L{setSendWindow}. C{0} disables flow control.
+    @ivar bytesAcknowledged: The number of encoded bytes that the peer has
+        acknowledged receiving.
+    @ivar pinger: Measures the round trip time to the peer, see
+        L{buildPinger}.
+    @type pinger: L{ping.Pinger} or C{None}
+    @ivar shaper: Caps the rate at which data is sent to the peer, see
+        L{setShaper}.
+    @type shaper: L{shaping.TokenBucket} or C{None}
+    @ivar frameSizePolicy: Picks the outbound frame size from the measured
+        egress bitrate, see L{setFrameSizePolicy}.
+    @type frameSizePolicy: L{codec.FrameSizePolicy} or C{None}
     """
 
     implements(message.IMessageListener)
 
     dispatcher = MessageDispatcher
+    decodingBuffer = BufferedByteStream
+    encodingBuffer = BufferedByteStream
+    decodingBytesBudget = 0
+    decodingTimeBudget = 0
+    inlineDecodingBudget = 0
+    decodingBufferLimit = 16 * 1024 * 1024
+    decodingChannelLimit = 128
+    decodingMessageLimits = {
+        message.AUDIO_DATA: 1024 * 1024,
+        message.VIDEO_DATA: 0,
+        message.FLV_DATA: 0,
+        None: 4 * 1024 * 1024,
+    }
+    highWatermark = 128 * 1024
+    encodingPaused = False
+    sendWindowScale = 2
+    sendWindow = 0
+    _decodingTask = None
+    _encodingTask = None
 
 
     @property
@@ -122,7 +216,9 @@ class BaseStreamer(object):
 
         If all the input buffer has been consumed, this will be C{False}.
         """
-        return getattr(self, 'decoding_task', None) is not None
+        task = self._decodingTask
+
+        return task is not None and not task.done
 
 
     @property
@@ -130,7 +226,33 @@ class BaseStreamer(object):
         """
         Whether this streamer is currently encoding RTMP message/s.
         """
-        return getattr(self, 'encoding_task', None) is not None
+        task = self._encodingTask
+
+        return task is not None and not task.done
+
+
+    @property
+    def decoder_task(self):
+        """
+        A C{Deferred} that fires once the decoder has consumed all the input
+        buffer (or errbacks if decoding failed), C{None} if not decoding.
+        """
+        if not self.decoding:
+            return None
+
+        return self._decodingTask.whenDone()
+
+
+    @property
+    def encoder_task(self):
+        """
+        A C{Deferred} that fires once the encoder has nothing more to write
+        (or errbacks if encoding failed), C{None} if not encoding.
+        """
+        if not self.encoding:
+            return None
+
+        return self._encodingTask.whenDone()
 
 
     def getWriter(self):
@@ -159,6 +281,30 @@ class BaseStreamer(object):
         return self.dispatcher(self)
 
 
+    def getCooperator(self):
+        """
+        Returns the L{cooperator.Cooperator} that runs the decoder and the
+        encoder. Shared by all the streamers in the process.
+        """
+        return cooperator.getCooperator()
+
+
+    def buildScheduler(self):
+        """
+        Returns the scheduler for the encoder, see L{codec.PriorityScheduler}.
+        C{None} means that the active channels are encoded in turn.
+        """
+        return None
+
+
+    def buildPinger(self):
+        """
+        Returns the L{ping.Pinger} for this streamer. C{None} means that the
+        peer is not pinged (its pings are still answered).
+        """
+        return None
+
+
     def bytesInterval(self, bytes):
         """
         """
@@ -172,16 +318,38 @@ class BaseStreamer(object):
         self.streamManager = self.buildStreamManager()
         self.controlStream = self.streamManager.getControlStream()
 
-        self._decodingBuffer = BufferedByteStream()
-        self._encodingBuffer = BufferedByteStream()
+        self._decodingBuffer = self.decodingBuffer()
+        self._encodingBuffer = self.encodingBuffer()
 
         self.decoder = codec.Decoder(self.getDispatcher(), self.streamManager,
-            stream=self._decodingBuffer)
+            stream=self._decodingBuffer, bytesBudget=self.decodingBytesBudget,
+            timeBudget=self.decodingTimeBudget)
+        self.decoder.setLimits(self.decodingBufferLimit,
+            self.decodingChannelLimit, self.decodingMessageLimits)
+
         self.encoder = codec.Encoder(self.getWriter(),
             stream=self._encodingBuffer)
+        self.encoder.scheduler = self.buildScheduler()
+
+        # time budgets and deadlines use the clock that calls are scheduled
+        # with
+        self.decoder.clock = self.encoder.clock = \
+            self.getCooperator().reactor.seconds
 
-        self.decoder_task = None
-        self.encoder_task = None
+        self._decodingTask = None
+        self._encodingTask = None
+
+        self.bytesAcknowledged = 0
+        self._lastBytesRead = 0
+        self.shaper = None
+        self._shapedBytes = 0
+        self._shapingCall = None
+        self._updateSendLimit()
+
+        self.frameSizePolicy = None
+        self._frameSizeCall = None
+
+        self.pinger = self.buildPinger()
 
 
     def stopStreaming(self, reason=None):
@@ -189,14 +357,32 @@ class BaseStreamer(object):
         """
         self.streamManager.closeAllStreams()
 
+        if self.pinger is not None:
+            self.pinger.stop()
+
+        del self.pinger
+
+        if self._shapingCall is not None:
+            self._shapingCall.cancel()
+            self._shapingCall = None
+
+        if self._frameSizeCall is not None:
+            self._frameSizeCall.cancel()
+            self._frameSizeCall = None
+
         self._decodingBuffer.truncate()
         self._encodingBuffer.truncate()
 
         del self._decodingBuffer
         del self._encodingBuffer
 
-        del self.decoder_task, self.decoder
-        del self.encoder_task, self.encoder
+        # queued work for this connection must not keep running
+        for task in (self._decodingTask, self._encodingTask):
+            if task is not None:
+                task.stop()
+
+        del self._decodingTask, self.decoder
+        del self._encodingTask, self.encoder
 
 
     def dataReceived(self, data):
@@ -205,50 +391,136 @@ class BaseStreamer(object):
         """
         self.decoder.send(data)
 
-        if not self.decoding:
-            self.startDecoding()
+        if self.decoding:
+            return
 
+        budget = self.inlineDecodingBudget
 
-    def startDecoding(self):
+        if budget and self.decoder.stream.remaining() <= budget:
+            self.decodeInline()
+        else:
+            self.readyDecoder()
+
+
+    def decodeInline(self):
         """
-        Called to start the decoding process.
+        Decodes (and dispatches) everything in the decoder buffer now.
+        """
+        for _ in self.decoder:
+            pass
 
-        @return: A C{Deferred} which will kill the task once the decoding is
-            done or on error.
+
+    def readyDecoder(self):
+        """
+        Puts the decoder in the cooperator's ready queue. The decoding task is
+        created the first time and then reused, it goes idle whenever the
+        input buffer has been consumed.
         """
-        def cullTask(result):
-            self.decoder_task = None
+        task = self._decodingTask
 
-            return result
+        if task is None:
+            self._decodingTask = self.getCooperator().decode(self.decoder,
+                self.decodingDone)
+        else:
+            task.wake()
 
-        self.decoder_task = task.coiterate(self.decoder)
 
-        self.decoder_task.addBoth(cullTask)
+    def readyEncoder(self):
+        """
+        Puts the encoder in the cooperator's ready queue, unless encoding has
+        been paused. Like L{readyDecoder}, the task is reused.
+        """
+        task = self._encodingTask
 
-        return self.decoder_task
+        if task is None:
+            task = self._encodingTask = self.getCooperator().encode(
+                self.encoder, self.encodingDone)
+
+            if self.encodingPaused:
+                task.pause()
+        else:
+            task.wake()
+
+
+    def startDecoding(self):
+        """
+        Called to start the decoding process.
+
+        @return: A C{Deferred} that fires once the decoder has consumed all
+            the input buffer, see L{decoder_task}.
+        """
+        self.readyDecoder()
+
+        return self._decodingTask.whenDone()
 
 
     def startEncoding(self):
         """
         Called to start asynchronously iterate the encoder.
 
-        @return: A C{Deferred} which will kill the task once the encoder is
-            done or on error will kill the connection.
-        @todo: See _startDecoding todo. The same applies here.
+        @return: A C{Deferred} that fires once the encoder has nothing more to
+            write, see L{encoder_task}.
         """
-        def cullTask(result):
-            self.encoder_task = None
+        self.readyEncoder()
+
+        return self._encodingTask.whenDone()
+
+
+    def decodingDone(self, result):
+        """
+        Called each time the decoding task goes idle.
+
+        @param result: The decoder, or a C{Failure} if decoding failed.
+        """
+        if isinstance(result, failure.Failure):
+            log.err(result)
+
+
+    def encodingDone(self, result):
+        """
+        Called each time the encoding task goes idle.
+
+        @param result: The encoder, or a C{Failure} if encoding failed.
+        """
+        if isinstance(result, failure.Failure):
+            log.err(result)
+
+            return
+
+        if result is getattr(self, 'encoder', None) and result.active:
+            # stopped by the send limit
+            self.resumeSending()
+
+
+    def pauseEncoding(self):
+        """
+        Stops the encoder writing to the output until L{resumeEncoding} is
+        called. Messages sent in the meantime are queued by the encoder,
+        protocol control messages are still written immediately.
+        """
+        if self.encodingPaused:
+            return
 
-            return result
+        self.encodingPaused = True
 
-        self.encoder_task = task.coiterate(self.encoder)
+        if self._encodingTask is not None:
+            self._encodingTask.pause()
 
-        self.encoder_task.addBoth(cullTask)
 
-        return self.encoder_task
+    def resumeEncoding(self):
+        """
+        Resumes encoding after L{pauseEncoding}.
+        """
+        if not self.encodingPaused:
+            return
+
+        self.encodingPaused = False
 
+        if self._encodingTask is not None:
+            self._encodingTask.resume()
 
-    def sendMessage(self, msg, stream, whenDone=None):
+
+    def sendMessage(self, msg, stream, whenDone=None, deadline=None):
         """
         Sends an RTMP message to the peer. Not part of a public api, use
         C{stream.sendMessage} instead.
@@ -258,7 +530,10 @@ class BaseStreamer(object):
         @param stream: The stream instance that is sending the message.
         @type stream: L{NetStream}
         @param whenDone: A callback fired when the message has been written to
-            the RTMP stream. See L{BaseStream.sendMessage}
+            the RTMP stream (or dropped, see C{deadline}). See
+            L{BaseStream.sendMessage}
+        @param deadline: If the message has not started to be written by this
+            (reactor) time, it is dropped. See L{codec.Encoder.send}.
         """
         buf = BufferedByteStream()
         e = self.encoder
@@ -269,10 +544,10 @@ class BaseStreamer(object):
         msg.encode(buf)
 
         e.send(buf.getvalue(), msg.__data_type__,
-            stream.streamId, stream.timestamp, whenDone)
+            stream.streamId, stream.timestamp, whenDone, deadline)
 
-        if e.active and not self.encoder_task:
-            self.startEncoding()
+        if e.active and not self.encoding and not self.isThrottled():
+            self.readyEncoder()
 
 
     def setFrameSize(self, size):
@@ -280,6 +555,60 @@ class BaseStreamer(object):
         self.encoder.setFrameSize(size)
 
 
+    def setFrameSizePolicy(self, policy, bitrate, interval=0):
+        """
+        Sets the outbound frame size with C{policy}.
+
+        @type policy: L{codec.FrameSizePolicy}
+        @param bitrate: The expected egress bitrate (bits per second) of this
+            connection, used until it has been measured.
+        @param interval: The number of seconds between measurements of the
+            egress bitrate, after each one the frame size is picked again (see
+            L{updateFrameSize}). C{0} keeps the first frame size.
+        """
+        if self._frameSizeCall is not None:
+            self._frameSizeCall.cancel()
+            self._frameSizeCall = None
+
+        self.frameSizePolicy = policy
+        self.setFrameSize(policy.getFrameSize(bitrate))
+
+        if interval and policy.adaptive:
+            self._frameSizeInterval = interval
+            self._frameSizeMark = (self.encoder.bytes, self._getTime())
+            self._frameSizeCall = self.getCooperator().reactor.callLater(
+                interval, self.updateFrameSize)
+
+
+    def _getTime(self):
+        return self.getCooperator().reactor.seconds()
+
+
+    def updateFrameSize(self):
+        """
+        Measures the egress bitrate since the last call and switches to the
+        frame size that L{frameSizePolicy} picks for it. The
+        L{message.FrameSize} message is a command so it is written right away,
+        ahead of any frame of the new size.
+        """
+        self._frameSizeCall = self.getCooperator().reactor.callLater(
+            self._frameSizeInterval, self.updateFrameSize)
+
+        e = self.encoder
+        bytes, then = self._frameSizeMark
+        now = self._getTime()
+
+        if e.bytes > bytes and now > then:
+            size = self.frameSizePolicy.getFrameSize(
+                (e.bytes - bytes) * 8.0 / (now - then))
+
+            if size != e.frameSize:
+                self.setFrameSize(size)
+
+        # if nothing was sent, the frame size is kept for when it is
+        self._frameSizeMark = (e.bytes, now)
+
+
     def getStreamingChannel(self, stream):
         """
         """
@@ -287,6 +616,133 @@ class BaseStreamer(object):
             self.getWriter())
 
 
+    def setSendWindow(self, size):
+        """
+        Enables flow control. C{size} is the acknowledgement window sent to
+        the peer (see L{message.DownstreamBandwidth}), the encoder is throttled
+        once more than L{sendWindowScale} windows are unacknowledged.
+        """
+        self.sendWindow = size
+
+        self._updateSendLimit()
+
+
+    def setShaper(self, shaper):
+        """
+        Caps the rate at which data is sent to the peer. C{None} removes the
+        cap.
+
+        The encoder is allowed to write as many bytes as there are tokens in
+        the bucket, the bucket is only charged once that limit has been
+        reached. So there is no per write overhead.
+
+        @type shaper: L{shaping.TokenBucket}
+        """
+        self.shaper = shaper
+        self._shapedBytes = self.encoder.bytes
+
+        self._updateSendLimit()
+        self.resumeSending()
+
+
+    def _updateSendLimit(self):
+        e = self.encoder
+        limits = []
+
+        if self.sendWindow:
+            limits.append(self.bytesAcknowledged +
+                self.sendWindow * self.sendWindowScale)
+
+        if self.shaper is not None:
+            self.shaper.consume(e.bytes - self._shapedBytes)
+            self._shapedBytes = e.bytes
+
+            limits.append(e.bytes + max(0, int(self.shaper.tokens)))
+
+        if limits:
+            # a limit of 0 means no limit
+            e.bytesLimit = max(1, min(limits))
+        else:
+            e.bytesLimit = 0
+
+
+    def _tokensAvailable(self):
+        self._shapingCall = None
+
+        self.resumeSending()
+
+
+    def getBytesInFlight(self):
+        """
+        Returns the number of bytes that have been encoded but not yet
+        acknowledged by the peer.
+        """
+        return self.encoder.bytes - self.bytesAcknowledged
+
+
+    def isThrottled(self):
+        """
+        Whether the peer has to acknowledge more bytes (see L{setSendWindow})
+        or the L{shaper} has to refill before any more messages are sent.
+
+        Settles with the L{shaper} once the limit has been reached and
+        schedules a call to L{resumeSending} for when there are enough tokens
+        for a frame. C{False} once streaming has stopped, there is nothing to
+        throttle.
+        """
+        e = getattr(self, 'encoder', None)
+
+        if e is None:
+            return False
+
+        limit = e.bytesLimit
+
+        if not limit or e.bytes < limit:
+            return False
+
+        if self.shaper is None:
+            return True
+
+        self._updateSendLimit()
+
+        if e.bytes < e.bytesLimit:
+            return False
+
+        if self._shapingCall is None:
+            delay = self.shaper.getDelay(e.frameSize)
+
+            if delay:
+                self._shapingCall = self.getCooperator().reactor.callLater(
+                    delay, self._tokensAvailable)
+
+        return True
+
+
+    def resumeSending(self):
+        """
+        Called when more data may be sent to the peer, after an
+        acknowledgement or once the L{shaper} has refilled. Restarts the
+        encoder if it has messages waiting.
+        """
+        e = self.encoder
+
+        if e.active and not self.encoding and not self.isThrottled():
+            self.readyEncoder()
+
+
+    def isWritable(self):
+        """
+        Whether data written now would be sent to the peer without waiting,
+        i.e. the writer has not asked for encoding to be paused (see
+        L{pauseEncoding}) and the encoder is not throttled. C{False} once
+        streaming has stopped.
+        """
+        if getattr(self, 'encoder', None) is None:
+            return False
+
+        return not self.encodingPaused and not self.isThrottled()
+
+
     def onFrameSize(self, size, timestamp):
         """
         Called when the peer sets its RTMP frame size.
@@ -314,6 +770,44 @@ class BaseStreamer(object):
         self.decoder.setBytesInterval(interval)
 
 
+    def onBytesRead(self, bytes, timestamp):
+        """
+        Called when the peer acknowledges the bytes it has received. Restarts
+        the encoder if it was waiting on the send window.
+
+        @param bytes: The total number of bytes the peer has received, as a
+            32 bit counter. This includes the handshake so the acknowledged
+            bytes are capped at the number of bytes encoded.
+        """
+        delta = (bytes - self._lastBytesRead) & 0xffffffff
+        self._lastBytesRead = bytes
+
+        self.bytesAcknowledged = min(self.bytesAcknowledged + delta,
+            self.encoder.bytes)
+        self._updateSendLimit()
+
+        self.resumeSending()
+
+
+    def onControlMessage(self, msg, timestamp):
+        """
+        Answers pings from the peer and hands the answers to our pings to the
+        L{pinger}. Other control messages are ignored.
+        """
+        if msg.type == message.ControlMessage.PING:
+            self.sendMessage(message.ControlMessage(
+                message.ControlMessage.PONG, msg.value1), self.controlStream)
+        elif msg.type == message.ControlMessage.PONG:
+            if self.pinger is not None:
+                self.pinger.pong(msg.value1)
+
+
+    def pingTimedOut(self):
+        """
+        Called when the peer has stopped answering pings, see L{pinger}.
+        """
+
+
 
 class StateEngine(BaseStreamer):
     """
@@ -526,10 +1020,50 @@ class ProtocolMessageDispatcher(MessageDispatcher):
 
 class RTMPProtocol(StateEngine, protocol.Protocol):
     """
+    Registers itself with the transport as a streaming producer once
+    streaming starts so that encoding is paused while the transport has more
+    than L{highWatermark} bytes waiting to be sent.
+
+    @ivar producing: Whether this protocol is registered with the transport
+        as its producer.
     """
 
+    implements(IPushProducer)
+
     streamId = 0
     timestamp = 0
+    producing = False
+
+
+
+    def connectionLost(self, reason):
+        """
+        """
+        self.unregisterProducer()
+
+        StateEngine.connectionLost(self, reason)
+
+
+    def unregisterProducer(self):
+        """
+        Unregisters this protocol as the producer of the transport. This must
+        be done before the connection is closed, a transport with a paused
+        producer waits for it to resume instead of closing once it has
+        written everything.
+        """
+        if not self.producing:
+            return
+
+        self.producing = False
+        self.transport.unregisterProducer()
+
+
+    def loseConnection(self):
+        """
+        Closes the connection once everything has been written.
+        """
+        self.unregisterProducer()
+        self.transport.loseConnection()
 
 
     def logAndDisconnect(self, reason, *args, **kwargs):
@@ -538,7 +1072,7 @@ class RTMPProtocol(StateEngine, protocol.Protocol):
         connection.
         """
         log.err(reason)
-        self.transport.loseConnection()
+        self.loseConnection()
 
         return reason
 
@@ -559,21 +1093,82 @@ class RTMPProtocol(StateEngine, protocol.Protocol):
             self.logAndDisconnect(failure.Failure())
 
 
-    def startDecoding(self):
+    def pauseProducing(self):
         """
+        Called by the transport when its buffer is full.
         """
-        d = StateEngine.startDecoding(self)
+        self.pauseEncoding()
 
-        d.addErrback(self.logAndDisconnect)
 
-        return d
+    def resumeProducing(self):
+        """
+        Called by the transport when its buffer has been drained.
+        """
+        self.resumeEncoding()
 
 
-    def startEncoding(self):
+    def stopProducing(self):
+        """
+        Called by the transport when the connection is lost,
+        L{connectionLost} handles the clean up.
+        """
+
+
+    def pingTimedOut(self):
         """
+        The peer is gone, drop the connection without waiting for the data
+        that it will not read.
         """
-        d = StateEngine.startEncoding(self)
+        log.msg('Ping timeout, dropping connection to %r' % (
+            self.transport.getPeer(),))
+
+        self.unregisterProducer()
+
+        abort = getattr(self.transport, 'abortConnection',
+            self.transport.loseConnection)
 
-        d.addErrback(self.logAndDisconnect)
+        abort()
+
+
+    def decodeInline(self):
+        """
+        """
+        try:
+            StateEngine.decodeInline(self)
+        except:
+            self.logAndDisconnect(failure.Failure())
+
+
+    def startStreaming(self):
+        """
+        """
+        transport = self.transport
+
+        if hasattr(transport, 'bufferSize'):
+            # the transport pauses its producer once this is exceeded
+            transport.bufferSize = self.highWatermark
+
+        transport.registerProducer(self, True)
+        self.producing = True
+
+        return StateEngine.startStreaming(self)
+
+
+    def decodingDone(self, result):
+        """
+        Drops the connection if decoding failed.
+        """
+        if isinstance(result, failure.Failure):
+            self.logAndDisconnect(result)
+
+
+    def encodingDone(self, result):
+        """
+        Drops the connection if encoding failed.
+        """
+        if isinstance(result, failure.Failure):
+            self.logAndDisconnect(result)
+
+            return
 
-        return d
+        StateEngine.encodingDone(self, result)
@@ -0,0 +1,331 @@
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Byte buffers for the RTMP codec.
+
+L{ByteBuffer} is a drop in replacement for the read side of
+L{pyamf.util.BufferedByteStream} that avoids copying frame bodies out of the
+buffer. It is used by L{codec.FrameReader} when decoding in I{view} mode.
+
+L{SequenceBuffer} replaces the write side for L{codec.Encoder}, the encoded
+headers and frame bodies are handed to the transport in one C{writeSequence}
+call instead of being copied in to a single string first.
+"""
+
+import struct
+
+
+__all__ = [
+    'ByteBuffer',
+    'SequenceBuffer',
+    'tobytes',
+    'join',
+]
+
+
+#: The default number of consumed bytes that a L{ByteBuffer} will hold on to
+#: before it compacts itself.
+COMPACT_THRESHOLD = 64 * 1024
+
+
+
+class ByteBuffer(object):
+    """
+    A byte buffer backed by a single growable C{bytearray} and a pair of
+    cursors. Data is appended to the end and read from the current position.
+
+    Reading a chunk of bytes returns a C{memoryview} slice of the underlying
+    storage, no bytes are copied. Consumed data is not discarded immediately,
+    the dead prefix is only dropped once it grows beyond C{compactThreshold}.
+
+    Any views handed out remain valid after the buffer has been compacted or
+    grown, a new storage object is allocated if the current one has
+    outstanding views.
+
+    @ivar endian: The byte order used by the C{read_*} methods. Only network
+        (C{'!'}) and little endian (C{'<'}) are supported.
+    @ivar compactThreshold: The number of consumed bytes to accumulate before
+        compacting the buffer.
+    @type compactThreshold: C{int}
+    """
+
+    endian = '!'
+
+
+    def __init__(self, data=None, compactThreshold=COMPACT_THRESHOLD):
+        self.compactThreshold = compactThreshold
+
+        self._data = bytearray()
+        # start of the live data
+        self._start = 0
+        # the read cursor
+        self._pos = 0
+
+        if data:
+            self.append(data)
+
+
+    def __len__(self):
+        return len(self._data) - self._start
+
+
+    def tell(self):
+        """
+        Returns the position of the read cursor.
+        """
+        return self._pos - self._start
+
+
+    def seek(self, pos, whence=0):
+        """
+        Moves the read cursor. Same semantics as C{file.seek}.
+        """
+        if whence == 1:
+            pos += self.tell()
+        elif whence == 2:
+            pos += len(self)
+
+        if pos < 0 or pos > len(self):
+            raise IOError('Attempted to seek outside the buffer (pos=%r)' % (
+                pos,))
+
+        self._pos = self._start + pos
+
+
+    def remaining(self):
+        """
+        Returns the number of bytes available to be read.
+        """
+        return len(self._data) - self._pos
+
+
+    def at_eof(self):
+        """
+        Whether all the data in the buffer has been read.
+        """
+        return self._pos >= len(self._data)
+
+
+    def append(self, data):
+        """
+        Appends C{data} to the end of the buffer without moving the cursor.
+
+        @type data: C{str}, C{bytearray} or C{memoryview}
+        """
+        try:
+            self._data.extend(data)
+        except BufferError:
+            # a view into the storage is still alive so it cannot be resized,
+            # start again with a copy of the live data.
+            self._compact()
+            self._data.extend(data)
+
+
+    def consume(self):
+        """
+        Marks everything before the read cursor as consumed. The storage is
+        only compacted once C{compactThreshold} dead bytes have accumulated.
+        """
+        self._start = self._pos
+
+        if self._start >= self.compactThreshold:
+            self._compact()
+
+
+    def _compact(self):
+        """
+        Copies the live data into new storage, dropping the dead prefix.
+        """
+        self._data = self._data[self._start:]
+        self._pos -= self._start
+        self._start = 0
+
+
+    def _check(self, size):
+        if self._pos + size > len(self._data):
+            raise IOError('Buffer underflow (needed %d bytes, %d available)' % (
+                size, self.remaining()))
+
+
+    def read(self, size=-1):
+        """
+        Reads C{size} bytes from the buffer. If C{size} is negative, everything
+        up to the end of the buffer is read.
+
+        @return: A read only view of the bytes.
+        @rtype: C{memoryview}
+        @raise IOError: Not enough data in the buffer.
+        """
+        if size < 0:
+            size = self.remaining()
+        else:
+            self._check(size)
+
+        pos = self._pos
+        self._pos += size
+
+        return memoryview(self._data)[pos:pos + size]
+
+
+    def peek(self, size=1):
+        """
+        Returns up to C{size} bytes from the buffer without moving the cursor.
+
+        @rtype: C{str}
+        """
+        return str(self._data[self._pos:self._pos + size])
+
+
+    def getvalue(self):
+        """
+        Returns a copy of all the live data in the buffer.
+
+        @rtype: C{str}
+        """
+        return str(self._data[self._start:])
+
+
+    def truncate(self, size=0):
+        """
+        Truncates the live data to C{size} bytes.
+        """
+        self._compact()
+
+        if size < len(self._data):
+            self._data = self._data[:size]
+
+        self._pos = min(self._pos, size)
+
+
+    def _unpack(self, fmt, size):
+        self._check(size)
+
+        value, = struct.unpack_from(self.endian + fmt, self._data, self._pos)
+        self._pos += size
+
+        return value
+
+
+    def read_uchar(self):
+        """
+        Reads an unsigned byte.
+        """
+        self._check(1)
+
+        value = self._data[self._pos]
+        self._pos += 1
+
+        return value
+
+
+    def read_ushort(self):
+        """
+        Reads a 2 byte unsigned integer.
+        """
+        return self._unpack('H', 2)
+
+
+    def read_24bit_uint(self):
+        """
+        Reads a 3 byte unsigned integer.
+        """
+        self._check(3)
+
+        a, b, c = self._data[self._pos:self._pos + 3]
+        self._pos += 3
+
+        if self.endian == '<':
+            return a | (b << 8) | (c << 16)
+
+        return (a << 16) | (b << 8) | c
+
+
+    def read_ulong(self):
+        """
+        Reads a 4 byte unsigned integer.
+        """
+        return self._unpack('L', 4)
+
+
+
+class SequenceBuffer(object):
+    """
+    A write only buffer that keeps a list of the strings written to it.
+
+    @ivar chunks: The strings written since the buffer was last consumed.
+    @type chunks: C{list}
+    """
+
+
+    def __init__(self):
+        self.consume()
+
+
+    def __len__(self):
+        return sum(map(len, self.chunks))
+
+
+    def getvalue(self):
+        """
+        Returns the contents of the buffer as a single C{str}.
+        """
+        return join(self.chunks)
+
+
+    def consume(self):
+        """
+        Empties the buffer. A new C{chunks} list is started, the old one may
+        have been handed to a transport.
+        """
+        self.chunks = []
+        # written strings are not copied
+        self.write = self.chunks.append
+
+
+    def truncate(self, size=0):
+        """
+        Empties the buffer. Only truncating to C{0} is supported.
+        """
+        if size != 0:
+            raise IOError('SequenceBuffer can only be truncated to 0')
+
+        self.consume()
+
+
+
+def tobytes(data):
+    """
+    Returns C{data} as a C{str}. Views and C{bytearray}s returned by a
+    L{ByteBuffer} are copied, strings are returned as is.
+    """
+    if data.__class__ is str:
+        return data
+
+    if isinstance(data, memoryview):
+        return data.tobytes()
+
+    return str(data)
+
+
+
+def join(chunks):
+    """
+    Joins a list of chunks (C{str}s and/or views) into a single C{str}.
+    """
+    try:
+        return ''.join(chunks)
+    except TypeError:
+        return ''.join([tobytes(x) for x in chunks])
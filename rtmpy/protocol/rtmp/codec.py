@@ -27,10 +27,11 @@ The Encoder/Decoder is not thread safe.
 """
 
 import collections
+import time
 
 from pyamf.util import BufferedByteStream
 
-from rtmpy.protocol.rtmp import header
+from rtmpy.protocol.rtmp import header, buffer
 from rtmpy import message
 
 
@@ -39,8 +40,13 @@ __all__ = [
     'Encoder',
     'Decoder',
     'DecodeError',
+    'MemoryLimitError',
     'EncodeError',
-    'StreamingChannel'
+    'StreamingChannel',
+    'PriorityScheduler',
+    'FixedFrameSize',
+    'BitrateFrameSize',
+    'LatencyFrameSize',
 ]
 
 
@@ -53,6 +59,12 @@ MAX_CHANNELS = 0xffff + 64 - 2
 #  stream. It cannot be deleted and is integral to the RTMP protocol.
 COMMAND_CHANNEL_ID = 0
 
+#: Scheduling classes used by L{PriorityScheduler}, highest priority first.
+PRIORITY_COMMAND = 0
+PRIORITY_AUDIO = 1
+PRIORITY_VIDEO = 2
+PRIORITY_BULK = 3
+
 
 
 class BaseError(Exception):
@@ -69,6 +81,14 @@ class DecodeError(BaseError):
 
 
 
+class MemoryLimitError(DecodeError):
+    """
+    Raised if the peer has exceeded the memory limits of the decoder, see
+    L{ChannelDemuxer.setLimits}.
+    """
+
+
+
 class EncodeError(BaseError):
     """
     Raised if there is an error encoding an RTMP byte stream.
@@ -126,19 +146,18 @@ class BaseChannel(object):
     def setHeader(self, new):
         """
         Applies a new header to this channel. If this channel already has a
-        header, then the new values are merged with the existing.
+        header, then the new values are merged in to it (in place, see
+        L{header.update}).
 
         @param new: The header to apply to this channel.
         @type new: L{header.Header}
-        @return: The previous header, if there is one.
-        @rtype: L{header.Header} or C{None}
+        @return: The header of this channel.
+        @rtype: L{header.Header}
         """
-        old = self.header
-
         if self.header is None:
             self.header = new
         else:
-            self.header = header.merge(self.header, new)
+            header.update(self.header, new)
 
         if new.timestamp == -1:
             # receiving a new message and no timestamp has been supplied means
@@ -151,7 +170,25 @@ class BaseChannel(object):
 
         self._bodyRemaining = self.header.bodyLength - self.bytes
 
-        return old
+        return self.header
+
+
+    def continueHeader(self):
+        """
+        Applies a continuation (type 3) header to this channel, i.e. the
+        values of the current header are repeated. Equivalent to calling
+        L{setHeader} with a continuation header, without creating one.
+        """
+        h = self.header
+
+        # see L{header.update}
+        h.full = False
+        h.continuation = False
+
+        if self.bytes == 0:
+            self.setTimestamp(self._lastDelta, True)
+
+        self._bodyRemaining = h.bodyLength - self.bytes
 
 
     def marshallFrame(self, size):
@@ -165,6 +202,13 @@ class BaseChannel(object):
         raise NotImplementedError
 
 
+    def getFrameLength(self):
+        """
+        Returns the number of body bytes in the next frame to be marshalled.
+        """
+        return min(self.frameRemaining, self.frameSize, self._bodyRemaining)
+
+
     def marshallOneFrame(self):
         """
         Marshalls one RTMP frame and adjusts internal counters accordingly.
@@ -253,6 +297,9 @@ class ConsumingChannel(BaseChannel):
         """
         Reads an RTMP frame from the stream and returns the content of the body.
 
+        If the stream is a L{buffer.ByteBuffer} then the body is returned as a
+        C{memoryview} into the stream, otherwise a C{str}.
+
         If there is not enough data to fulfill the frame requirements then
         C{IOError} will be raised.
         """
@@ -265,7 +312,12 @@ class ProducingChannel(BaseChannel):
     Writes RTMP frames.
 
     @ivar buffer: Any data waiting to be written to the underlying stream.
-    @type buffer: L{BufferedByteStream}
+        Each frame is written as a slice of this, i.e. a copy of the frame.
+        Only a body that fits in to a single frame is written as is.
+        C{buffer}/C{memoryview} slices would avoid the copy but neither
+        C{BufferedByteStream.write} nor Twisted's C{writeSequence} accept
+        them.
+    @type buffer: C{str}
     @ivar acquired: Whether this channel is acquired. See L{ChannelMuxer.
         acquireChannel}
     """
@@ -274,10 +326,12 @@ class ProducingChannel(BaseChannel):
     def __init__(self, channelId, stream, frameSize):
         BaseChannel.__init__(self, channelId, stream, frameSize)
 
-        self.buffer = BufferedByteStream()
+        self.buffer = ''
         self.acquired = False
         self.callback = None
 
+        self._offset = 0
+
 
     def setCallback(self, cb):
         """
@@ -293,23 +347,32 @@ class ProducingChannel(BaseChannel):
         """
         BaseChannel.reset(self)
 
-        self.buffer.seek(0)
-        self.buffer.truncate()
+        self.buffer = ''
+        self._offset = 0
         self.header = None
+        self.callback = None
 
 
     def append(self, data):
         """
         Appends data to the buffer in preparation of encoding in RTMP.
         """
-        self.buffer.append(data)
+        if self.buffer:
+            self.buffer = self.buffer[self._offset:] + data
+            self._offset = 0
+        else:
+            self.buffer = data
 
 
     def marshallFrame(self, size):
         """
-        Writes a section of the buffer as part of the RTMP frame.
+        Writes a section of the buffer as part of the RTMP frame. The section
+        is copied, unless it is the whole buffer.
         """
-        self.stream.write(self.buffer.read(size))
+        offset = self._offset
+
+        self.stream.write(self.buffer[offset:offset + size])
+        self._offset = offset + size
 
 
 
@@ -326,7 +389,10 @@ class Codec(object):
 
 
     def __init__(self, stream=None):
-        self.stream = stream or BufferedByteStream()
+        if stream is None:
+            stream = BufferedByteStream()
+
+        self.stream = stream
 
         self.channels = {}
         self.frameSize = FRAME_SIZE
@@ -391,6 +457,15 @@ class FrameReader(Codec):
 
 
     _currentChannel = None
+    #: The number of bytes that the stream is known to be short of in order to
+    #: read the next frame. Set by L{readFrame}.
+    needed = 0
+
+
+    def __init__(self, stream=None):
+        Codec.__init__(self, stream=stream)
+
+        self._byteBuffer = isinstance(self.stream, buffer.ByteBuffer)
 
 
     def buildChannel(self, channelId):
@@ -410,6 +485,15 @@ class FrameReader(Codec):
         orig_pos = self.stream.tell()
 
         try:
+            if self._byteBuffer:
+                # header.decode is typed for a BufferedByteStream when
+                # compiled, decode from the peeked bytes instead
+                h, size = header.decode_from(
+                    self.stream.peek(header.MAX_HEADER_SIZE))
+                self.stream.seek(size, 1)
+
+                return h
+
             return header.decode(self.stream)
         except IOError:
             raise
@@ -422,8 +506,8 @@ class FrameReader(Codec):
 
             # yes, print, bog off :P
             print 'Attempted to decode header for %r' % (self._currentChannel,)
-            print 'Stream bytes was: %r' % (
-                self.stream.read(boom_pos - orig_pos + 1),)
+            print 'Stream bytes was: %r' % (buffer.tobytes(
+                self.stream.read(boom_pos - orig_pos + 1)),)
 
             print 'Channel state: %r' % (self.channels,)
 
@@ -447,38 +531,67 @@ class FrameReader(Codec):
            received)
          * An L{IChannelMeta} instance.
 
-        If an attempt to read from the stream comes to a natural end then
-        C{StopIteration} is raised, otherwise C{IOError}.
+        The meta is the channel's own header, which is updated in place by the
+        next header on that channel. Use C{meta.copy()} to keep it.
+
+        Before anything is read, the size of the header (from its first byte)
+        and of the frame body (from the channel state) are checked against the
+        bytes available in the stream. If the frame is incomplete then C{None}
+        is returned and L{needed} is set to the number of bytes still missing.
+        No exceptions are raised and the stream is never rewound, a complete
+        header is consumed even if the body of its frame is not available.
         """
-        pos = self.stream.tell()
+        stream = self.stream
+        available = stream.remaining()
         channel = self._currentChannel
 
         if channel is None:
-            try:
+            if available == 0:
+                self.needed = 1
+
+                return None
+
+            buf = stream.peek(header.MAX_HEADER_SIZE)
+            size = header.get_size(buf)
+
+            if size > available:
+                self.needed = size - available
+
+                return None
+
+            self.bytes += size
+            available -= size
+
+            if size == 1:
+                # a continuation header for a channel id < 62, there is
+                # nothing to decode
+                channel = self.getChannel((ord(buf[0]) & 0x3f) - 2)
+
+            if size == 1 and channel.header is not None:
+                stream.seek(1, 1)
+
+                channel.continueHeader()
+            else:
                 h = self.readHeader()
-            except IOError:
-                self.stream.seek(pos, 0)
 
-                raise
+                channel = self.getChannel(h.channelId)
+                channel.setHeader(h)
 
-            new_pos = self.stream.tell()
-            self.bytes += new_pos - pos
-            pos = new_pos
+            self._currentChannel = channel
 
-            channel = self._currentChannel = self.getChannel(h.channelId)
+        size = channel.getFrameLength()
 
-            channel.setHeader(h)
+        if size > available:
+            self.needed = size - available
 
-        try:
-            bytes = channel.marshallOneFrame()
-        except IOError:
-            self.stream.seek(pos, 0)
+            return None
 
-            raise
-        else:
-            self._currentChannel = None
+        bytes = channel.marshallOneFrame()
+
+        self._currentChannel = None
+        self.needed = 0
+        self.bytes += size
 
-        self.bytes += self.stream.tell() - pos
         complete = channel.complete()
         h = channel.header
 
@@ -513,15 +626,80 @@ class ChannelDemuxer(FrameReader):
     else is not. This means that the raw data is buffered until the channel is
     complete.
 
-    @ivar bucket: Buffers any incomplete channel data.
-    @type bucket: channel -> buffered data.
+    @ivar bucket: Buffers any incomplete channel data. Each frame body is
+        appended to a list which is joined exactly once, when the channel is
+        complete.
+    @type bucket: channelId -> C{list} of frame bodies.
+    @ivar bufferedBytes: The number of bytes held in L{bucket}.
+    @ivar discarding: The channel ids whose current message is being read and
+        thrown away because it is larger than allowed.
+    @ivar discardedMessages: The number of messages that have been thrown
+        away.
+    @ivar maxBufferedBytes: See L{setLimits}.
+    @ivar maxOpenChannels: See L{setLimits}.
+    @ivar maxMessageSizes: See L{setLimits}.
+    @note: Frame bodies may be C{memoryview}s (see L{buffer.ByteBuffer}). A
+        message that fits in a single frame is returned as is, anything that
+        needs to be reassembled is returned as a C{str}.
     """
 
+    maxBufferedBytes = 0
+    maxOpenChannels = 0
+    maxMessageSizes = None
+
 
     def __init__(self, stream=None):
         FrameReader.__init__(self, stream=stream)
 
         self.bucket = {}
+        self.bufferedBytes = 0
+        self.discarding = set()
+        self.discardedMessages = 0
+
+
+    @property
+    def openChannels(self):
+        """
+        The number of channels with a partially received message.
+        """
+        return len(self.bucket)
+
+
+    def setLimits(self, maxBufferedBytes=0, maxOpenChannels=0,
+                  maxMessageSizes=None):
+        """
+        Limits the memory that the peer can make this demuxer hold on to.
+        C{0} (or C{None}) means no limit.
+
+        @param maxBufferedBytes: The maximum number of bytes buffered for
+            partially received messages, across all channels. Exceeding it
+            raises L{MemoryLimitError}.
+        @param maxOpenChannels: The maximum number of channels that can have a
+            partially received message at the same time. Exceeding it raises
+            L{MemoryLimitError}.
+        @param maxMessageSizes: A C{dict} of datatype -> maximum body length.
+            The key C{None} applies to any other datatype. A message that is
+            too large is read (the stream must stay in sync) but thrown away
+            and its channel is aborted, see L{discarding}.
+        """
+        self.maxBufferedBytes = maxBufferedBytes
+        self.maxOpenChannels = maxOpenChannels
+        self.maxMessageSizes = maxMessageSizes
+
+
+    def isTooLarge(self, meta):
+        """
+        Whether the message described by C{meta} is larger than allowed by
+        L{maxMessageSizes}.
+        """
+        sizes = self.maxMessageSizes
+
+        if not sizes:
+            return False
+
+        limit = sizes.get(meta.datatype, sizes.get(None, 0))
+
+        return bool(limit) and meta.bodyLength > limit
 
 
     def readFrame(self):
@@ -535,23 +713,80 @@ class ChannelDemuxer(FrameReader):
         * The associated L{IChannelMeta} instance
 
         C{None, None} will be returned if a frame was read, but no channel was
-        complete.
+        complete. C{None} is returned if there was not enough data in the
+        stream to read a frame (see L{FrameReader.readFrame}).
         """
-        data, complete, meta = FrameReader.readFrame(self)
+        frame = FrameReader.readFrame(self)
+
+        if frame is None:
+            return None
+
+        data, complete, meta = frame
+        channelId = meta.channelId
+
+        if channelId in self.discarding:
+            if complete:
+                self.discarding.remove(channelId)
+
+            return None, None
+
+        chunks = self.bucket.get(channelId, None)
+
+        if chunks is None and self.maxMessageSizes and self.isTooLarge(meta):
+            self.discardedMessages += 1
+
+            if not complete:
+                self.discarding.add(channelId)
+
+            return None, None
 
         if complete:
-            data = self.bucket.pop(meta.channelId, '') + data
+            if chunks is not None:
+                del self.bucket[channelId]
+
+                self.bufferedBytes -= sum(map(len, chunks))
+
+                chunks.append(data)
+                data = buffer.join(chunks)
 
             return data, meta
 
-        channelId = meta.channelId
+        self.bufferedBytes += len(data)
 
-        self.bucket[channelId] = self.bucket.get(channelId, '') + data
+        if chunks is None:
+            self.bucket[channelId] = [data]
+
+            if (self.maxOpenChannels and
+                    len(self.bucket) > self.maxOpenChannels):
+                raise MemoryLimitError('Too many open channels (%d)' % (
+                    len(self.bucket),))
+        else:
+            chunks.append(data)
+
+        if self.maxBufferedBytes and self.bufferedBytes > self.maxBufferedBytes:
+            raise MemoryLimitError('Buffered %d bytes of incomplete '
+                'messages (limit %d)' % (self.bufferedBytes,
+                self.maxBufferedBytes))
 
         # nothing was available
         return None, None
 
 
+    def abort(self, channelId):
+        """
+        Aborts the message currently being read on C{channelId}. Any data
+        buffered for the channel is discarded.
+        """
+        FrameReader.abort(self, channelId)
+
+        chunks = self.bucket.pop(channelId, None)
+
+        if chunks is not None:
+            self.bufferedBytes -= sum(map(len, chunks))
+
+        self.discarding.discard(channelId)
+
+
 
 class Decoder(ChannelDemuxer):
     """
@@ -564,18 +799,32 @@ class Decoder(ChannelDemuxer):
     @type dispatcher: Provides L{interfaces.IMessageDispatcher}
     @ivar stream_factory: Builds stream listener objects.
     @type stream_factory: L{interfaces.IStreamManager}
+    @ivar bytesBudget: The maximum number of bytes to decode per call to
+        L{next}. See L{drain}.
+    @type bytesBudget: C{int}
+    @ivar timeBudget: The maximum number of seconds to spend decoding per call
+        to L{next}. See L{drain}.
+    @type timeBudget: C{float}
+    @cvar clock: Returns the current time in seconds. A streamer replaces it
+        with the C{seconds} method of its reactor.
     """
 
 
     channel_class = ConsumingChannel
+    #: Messages that change how the rest of the stream is decoded. These are
+    #: never held back in a batch.
+    flushTypes = (message.FRAME_SIZE, message.ABORT)
+    clock = staticmethod(time.time)
 
 
     def __init__(self, dispatcher, stream_factory, stream=None,
-                 bytesInterval=0):
+                 bytesInterval=0, bytesBudget=0, timeBudget=0):
         ChannelDemuxer.__init__(self, stream=stream)
 
         self.dispatcher = dispatcher
         self.stream_factory = stream_factory
+        self.bytesBudget = bytesBudget
+        self.timeBudget = timeBudget
 
         self.setBytesInterval(bytesInterval)
 
@@ -595,19 +844,25 @@ class Decoder(ChannelDemuxer):
         C{dispatcher}.
 
         This function does not return anything. Call it iteratively to pump RTMP
-        messages out of the stream.
+        messages out of the stream. One frame is read per call unless a
+        L{bytesBudget} or L{timeBudget} has been set, in which case L{drain} is
+        used.
 
-        If C{IOError} is raised, something went wrong decoding the stream,
-        otherwise C{StopIteration} will be raised if the end of the stream is
-        reached.
+        C{StopIteration} will be raised once there is not enough data left in
+        the stream to read a complete frame.
         """
-        try:
-            data, meta = ChannelDemuxer.readFrame(self)
-        except IOError:
+        if self.bytesBudget or self.timeBudget:
+            return self.drain()
+
+        frame = ChannelDemuxer.readFrame(self)
+
+        if frame is None:
             self.stream.consume()
 
             raise StopIteration
 
+        data, meta = frame
+
         if self.bytesInterval and self.bytes >= self._nextInterval:
             self.dispatcher.bytesInterval(self.bytes)
             self._nextInterval += self.bytesInterval
@@ -621,6 +876,65 @@ class Decoder(ChannelDemuxer):
             stream, meta.datatype, meta.timestamp, data)
 
 
+    def drain(self):
+        """
+        Reads every complete frame in the stream until either the stream runs
+        dry or the byte/time budget for this call has been spent. The messages
+        that were completed are then handed to the dispatcher in one batch via
+        C{dispatchMessages}.
+
+        Control messages that affect the decoding of the stream (see
+        L{flushTypes}) flush the batch immediately.
+
+        @raise StopIteration: The stream did not contain a complete frame.
+        """
+        bytesBudget = self.bytesBudget
+        deadline = None
+
+        if self.timeBudget:
+            deadline = self.clock() + self.timeBudget
+
+        start = self.bytes
+        limit = start + bytesBudget
+        flushTypes = self.flushTypes
+        getStream = self.stream_factory.getStream
+        batch = []
+
+        while True:
+            frame = ChannelDemuxer.readFrame(self)
+
+            if frame is None:
+                self.stream.consume()
+
+                if self.bytes == start:
+                    raise StopIteration
+
+                break
+
+            data, meta = frame
+
+            if self.bytesInterval and self.bytes >= self._nextInterval:
+                self.dispatcher.bytesInterval(self.bytes)
+                self._nextInterval += self.bytesInterval
+
+            if data is not None:
+                batch.append((getStream(meta.streamId), meta.datatype,
+                    meta.timestamp, data))
+
+                if meta.datatype in flushTypes:
+                    self.dispatcher.dispatchMessages(batch)
+                    batch = []
+
+            if bytesBudget and self.bytes >= limit:
+                break
+
+            if deadline is not None and self.clock() >= deadline:
+                break
+
+        if batch:
+            self.dispatcher.dispatchMessages(batch)
+
+
     __next__ = next
 
 
@@ -629,32 +943,55 @@ class ChannelMuxer(Codec):
     Manages RTMP channels and marshalls the data so that the channels can be
     interleaved.
 
+    @ivar pending: A fifo queue of messages that are waiting to be assigned a
+        channel.
+    @type pending: C{collections.deque}
     @ivar releasedChannels: A list of channel ids that have been released.
     @type releasedChannels: C{collections.deque}
     @ivar channelsInUse: Number of RTMP channels currently in use.
-    @ivar activeChannels: A list of L{BaseChannel} objects that are active (and
-        therefore unavailable)
+    @ivar activeChannels: The L{BaseChannel} objects that are active (and
+        therefore unavailable), in the order they became active.
+    @type activeChannels: C{collections.OrderedDict}
     @ivar nextHeaders: A collection of L{header.Header}s to be applied to the
         channel the next time it is asked to marshall a frame.
     @ivar timestamps: A collection of last known timestamps for a given channel.
         If the timestamp differs then the relative value is written assuming
         that the streamId hasn't changed.
     @ivar callbacks: A collection of channel->callback (if any).
+    @ivar scheduler: Decides the order in which the active channels are
+        encoded and how many frames each gets per call to L{next}. C{None}
+        means one frame from every channel in turn. See L{PriorityScheduler}.
+    @ivar deadlines: A collection of channel -> deadline for the messages that
+        were sent with one.
+    @ivar skipped: The number of messages that were dropped because their
+        deadline passed before they were started.
+    @cvar clock: Returns the current time in seconds, deadlines are compared
+        to it. A streamer replaces it with the C{seconds} method of its
+        reactor.
     """
 
 
+    clock = staticmethod(time.time)
+
+
     def __init__(self, stream=None):
         Codec.__init__(self, stream=stream)
 
-        self.pending = []
+        self.pending = collections.deque()
 
         self.releasedChannels = collections.deque()
-        self.activeChannels = {}
+        self.activeChannels = collections.OrderedDict()
         self.channelsInUse = 0
 
         self.nextHeaders = {}
         self.timestamps = {}
 
+        self.scheduler = None
+        self.deadlines = {}
+        self.skipped = 0
+
+        self._scatter = isinstance(self.stream, buffer.SequenceBuffer)
+
 
     def buildChannel(self, channelId):
         """
@@ -714,13 +1051,19 @@ class ChannelMuxer(Codec):
         Encodes the next header for C{channel}.
         """
         h = self.nextHeaders.pop(channel, None)
+        previous = channel.header
+
+        if h is None:
+            h = previous
 
-        if h is not None:
-            h = channel.setHeader(h)
+        # the channel header is updated in place, so encode against it first
+        if self._scatter:
+            self.stream.write(header.encode_bytes(h, previous))
         else:
-            h = channel.header
+            header.encode(self.stream, h, previous)
 
-        header.encode(self.stream, channel.header, h)
+        if h is not previous:
+            channel.setHeader(h)
 
 
     def flush(self):
@@ -745,7 +1088,8 @@ class ChannelMuxer(Codec):
         return c
 
 
-    def send(self, data, datatype, streamId, timestamp, whenDone=None):
+    def send(self, data, datatype, streamId, timestamp, whenDone=None,
+             deadline=None):
         """
         Queues an RTMP message to be encoded. Call C{next} to do the encoding.
 
@@ -760,6 +1104,10 @@ class ChannelMuxer(Codec):
         @param timestamp: The current timestamp for the stream that this message
             was sent.
         @type timestamp: C{int}
+        @param whenDone: Called with no arguments once the message has been
+            encoded, or dropped (see C{deadline}).
+        @param deadline: If the message has not started to be encoded by this
+            time (as returned by L{clock}), it is dropped.
         """
         if is_command_type(datatype):
             # we have to special case command types because a channel only be
@@ -767,13 +1115,28 @@ class ChannelMuxer(Codec):
             # written right away
             channel = self.getChannel(COMMAND_CHANNEL_ID)
         else:
-            channel = self.acquireChannel()
+            channel = None
+
+            # messages already waiting for a channel go first
+            if not self.pending:
+                channel = self.acquireChannel()
 
             if not channel:
-                self.pending.append((data, datatype, streamId, timestamp, whenDone))
+                self.pending.append((data, datatype, streamId, timestamp,
+                    whenDone, deadline))
 
                 return
 
+        self._sendOnChannel(channel, data, datatype, streamId, timestamp,
+            whenDone, deadline)
+
+
+    def _sendOnChannel(self, channel, data, datatype, streamId, timestamp,
+                       whenDone, deadline=None):
+        """
+        Queues the message on C{channel}, command messages are encoded
+        immediately.
+        """
         h = header.Header(
             channel.channelId,
             timestamp - channel.timestamp,
@@ -798,27 +1161,91 @@ class ChannelMuxer(Codec):
 
         self.activeChannels[channel] = channel.channelId
 
+        if deadline is not None:
+            self.deadlines[channel] = deadline
+
+        if self.scheduler is not None:
+            self.scheduler.add(channel, datatype, len(data))
+
+
+    def _deactivate(self, channel):
+        """
+        Releases C{channel} once it has finished (or dropped) its message.
+        """
+        self.releaseChannel(channel.channelId)
+        del self.activeChannels[channel]
+
+        self.deadlines.pop(channel, None)
+
+        if self.scheduler is not None:
+            self.scheduler.remove(channel)
+
+
+    def _dropStale(self):
+        """
+        Drops the messages whose deadline has passed and that have not been
+        started. The C{whenDone} callback of a dropped message is still
+        fired so that nothing waits on it forever.
+        """
+        now = self.clock()
+
+        for channel, deadline in self.deadlines.items():
+            if deadline > now or channel not in self.nextHeaders:
+                continue
+
+            del self.nextHeaders[channel]
+
+            if channel.callback is not None:
+                try:
+                    channel.callback()
+                except:
+                    pass
+
+            channel.reset()
+
+            self._deactivate(channel)
+            self.skipped += 1
+
 
     def next(self):
         """
         Encodes one RTMP frame from all the active channels.
         """
-        while self.pending and self.channelsInUse <= MAX_CHANNELS:
-            self.send(*self.pending.pop(0))
+        pending = self.pending
+
+        while pending:
+            channel = self.acquireChannel()
+
+            if channel is None:
+                break
 
-        if not bool(self.activeChannels):
+            self._sendOnChannel(channel, *pending.popleft())
+
+        if not self.activeChannels:
             raise StopIteration
 
+        if self.deadlines:
+            self._dropStale()
+
         to_release = []
 
-        for channel in self.activeChannels:
-            if self._encodeOneFrame(channel):
-                channel.reset()
-                to_release.append(channel)
+        if self.scheduler is None:
+            for channel in self.activeChannels:
+                if self._encodeOneFrame(channel):
+                    channel.reset()
+                    to_release.append(channel)
+        else:
+            for channel, frames in self.scheduler.schedule(
+                    self.activeChannels):
+                for i in xrange(frames):
+                    if self._encodeOneFrame(channel):
+                        channel.reset()
+                        to_release.append(channel)
+
+                        break
 
         for channel in to_release:
-            self.releaseChannel(channel.channelId)
-            del self.activeChannels[channel]
+            self._deactivate(channel)
 
 
 
@@ -832,11 +1259,13 @@ class Encoder(ChannelMuxer):
     To think about::
         - Stale messages; A timestamp less than the last known timestamp.
 
-    @ivar pending: An fifo queue of messages that are waiting to be assigned a
-        channel.
     @ivar output: A C{write}able object that will receive the final encoded RTMP
         stream. The instance only needs to implement C{write} and accept 1 param
-        (the data).
+        (the data). If C{stream} is a L{buffer.SequenceBuffer}, C{output} must
+        also implement C{writeSequence}.
+    @ivar bytesLimit: If set, L{next} stops (raises C{StopIteration}) once
+        L{bytes} has reached it, leaving the active channels queued. Command
+        messages are still written. Used for flow control by the streamer.
     """
 
 
@@ -844,12 +1273,16 @@ class Encoder(ChannelMuxer):
         ChannelMuxer.__init__(self, stream=stream)
 
         self.output = output
+        self.bytesLimit = 0
 
 
     def next(self):
         """
         Called iteratively to produce an RTMP encoded stream.
         """
+        if self.bytesLimit and self.bytes >= self.bytesLimit:
+            raise StopIteration
+
         ChannelMuxer.next(self)
 
         self.flush()
@@ -858,7 +1291,21 @@ class Encoder(ChannelMuxer):
     def flush(self):
         """
         Flushes the internal buffer to C{output}.
+
+        If the buffer is a L{buffer.SequenceBuffer}, the headers and body
+        slices are handed to C{output.writeSequence} as is.
         """
+        if self._scatter:
+            chunks = self.stream.chunks
+
+            if chunks:
+                self.output.writeSequence(chunks)
+                self.stream.consume()
+
+                self.bytes += sum(map(len, chunks))
+
+            return
+
         s = self.stream.getvalue()
 
         self.output.write(s)
@@ -878,8 +1325,195 @@ class Encoder(ChannelMuxer):
 
 
 
+class PriorityScheduler(object):
+    """
+    A weighted round robin scheduler for L{ChannelMuxer}.
+
+    Each message is put in to a class when it is sent: commands, audio, video
+    or bulk data. Large commands (e.g. a big RPC result) and anything else are
+    bulk data. On every call to L{ChannelMuxer.next} the active channels are
+    encoded highest priority class first, each channel getting up to the
+    weight of its class in frames. Every channel gets at least one frame so
+    bulk data is never starved.
+
+    @ivar weights: A C{dict} of priority class -> frames per iteration.
+    @ivar bulkSize: Commands larger than this (in bytes) are bulk data.
+    @ivar priorities: A collection of channel -> priority class.
+    """
+
+    weights = {
+        PRIORITY_COMMAND: 8,
+        PRIORITY_AUDIO: 4,
+        PRIORITY_VIDEO: 2,
+        PRIORITY_BULK: 1,
+    }
+
+    bulkSize = 16 * 1024
+
+    commandTypes = (message.INVOKE, message.NOTIFY, message.FLEX_MESSAGE)
+
+
+    def __init__(self, weights=None, bulkSize=None):
+        if weights is not None:
+            self.weights = dict(self.weights, **weights)
+
+        if bulkSize is not None:
+            self.bulkSize = bulkSize
+
+        self.priorities = {}
+
+
+    def classify(self, datatype, size):
+        """
+        Returns the priority class for a message.
+        """
+        if datatype == message.AUDIO_DATA:
+            return PRIORITY_AUDIO
+
+        if datatype == message.VIDEO_DATA:
+            return PRIORITY_VIDEO
+
+        if size <= self.bulkSize and (datatype in self.commandTypes or
+                is_command_type(datatype)):
+            return PRIORITY_COMMAND
+
+        return PRIORITY_BULK
+
+
+    def add(self, channel, datatype, size):
+        """
+        Called when a message has been queued on C{channel}.
+        """
+        self.priorities[channel] = self.classify(datatype, size)
+
+
+    def remove(self, channel):
+        """
+        Called when C{channel} has finished its message.
+        """
+        self.priorities.pop(channel, None)
+
+
+    def schedule(self, channels):
+        """
+        Returns a list of C{(channel, frames)} in the order that C{channels}
+        should be encoded. Channels in the same class keep their order.
+        """
+        priorities = self.priorities
+        weights = self.weights
+
+        return [(channel, weights[priorities[channel]])
+            for channel in sorted(channels, key=priorities.__getitem__)]
+
+
+
+class FrameSizePolicy(object):
+    """
+    Decides the outbound RTMP frame size for a connection.
+
+    @cvar minimum: The smallest frame size that will be returned.
+    @cvar maximum: The largest frame size that will be returned.
+    @cvar adaptive: Whether the frame size depends on the bitrate, i.e. is
+        worth picking again as the measured bitrate changes.
+    """
+
+    minimum = FRAME_SIZE
+    maximum = 64 * 1024
+    adaptive = True
+
+
+    def getFrameSize(self, bitrate):
+        """
+        Returns the frame size to use.
+
+        @param bitrate: The rate at which data is sent to the peer in bits per
+            second.
+        """
+        raise NotImplementedError
+
+
+    def clamp(self, size):
+        """
+        Rounds C{size} down to a multiple of L{FRAME_SIZE} and keeps it between
+        L{minimum} and L{maximum}.
+        """
+        size = int(size) // FRAME_SIZE * FRAME_SIZE
+
+        return max(self.minimum, min(self.maximum, size))
+
+
+
+class FixedFrameSize(FrameSizePolicy):
+    """
+    Always uses the same frame size.
+    """
+
+    size = 4096
+    adaptive = False
+
+
+    def __init__(self, size=None):
+        if size is not None:
+            self.size = size
+
+
+    def getFrameSize(self, bitrate):
+        return self.clamp(self.size)
+
+
+
+class BitrateFrameSize(FrameSizePolicy):
+    """
+    Sizes frames so that an average video frame fits in to a single RTMP
+    frame, i.e. one header per video frame.
+
+    @ivar frameRate: The expected video frame rate.
+    """
+
+    frameRate = 25
+
+
+    def __init__(self, frameRate=None):
+        if frameRate is not None:
+            self.frameRate = frameRate
+
+
+    def getFrameSize(self, bitrate):
+        return self.clamp(bitrate / 8.0 / self.frameRate)
+
+
+
+class LatencyFrameSize(FrameSizePolicy):
+    """
+    Sizes frames so that writing a single RTMP frame takes no longer than
+    L{latency} at the connection bitrate. This bounds how long a message
+    (e.g. audio) waits behind another channel's frame when the two are
+    interleaved.
+
+    @ivar latency: The maximum time (in seconds) to spend writing a frame.
+    """
+
+    latency = 0.01
+
+
+    def __init__(self, latency=None):
+        if latency is not None:
+            self.latency = latency
+
+
+    def getFrameSize(self, bitrate):
+        return self.clamp(bitrate / 8.0 * self.latency)
+
+
+
 class StreamingChannel(object):
     """
+    Writes audio/video data for a stream directly to the output, bypassing the
+    encoder queue.
+
+    Each payload is written as the (per channel) first header followed by the
+    chunked body. The chunked body only depends on the frame size and channel
+    id so it can be shared between channels, see L{sendData}.
     """
 
 
@@ -896,63 +1530,103 @@ class StreamingChannel(object):
         self.type = None
         self.streamId = streamId
         self.output = output
-        self.stream = BufferedByteStream()
 
-        self._lastHeader = None
-        self._oldStream = self.channel.stream
-        self.channel.stream = self.stream
+        # the timestamp delta, body length and type of the last header sent,
+        # None until the first (full) header has been sent.
+        self._lastDelta = None
+        self._lastLength = None
+        self._lastType = None
 
-        h = header.Header(self.channel.channelId)
+        # the basic headers never change, only the timestamp delta and body
+        # length are packed per message.
+        channelId = self.channel.channelId
 
-        # encode a continuation header for speed
-        header.encode(self.stream, h, h)
-
-        self._continuationHeader = self.stream.getvalue()
-        self.stream.consume()
-
-
-    def __del__(self):
-        try:
-            self.channel.stream = self._oldStream
-        except:
-            pass
+        self._mediumHeader = header.get_basic_header(channelId, 0x40)
+        self._smallHeader = header.get_basic_header(channelId, 0x80)
+        self._continuationHeader = header.get_basic_header(channelId, 0xc0)
 
 
     def setType(self, type):
         self.type = type
 
 
-    def sendData(self, data, timestamp):
+    def getChunkedBody(self, data, chunks=None):
+        """
+        Returns C{data} split into frames for this channel, i.e. with a
+        continuation header between each frame.
+
+        @param chunks: A C{dict} shared between the channels that are sending
+            the same C{data}. The chunked body is cached in it per
+            C{(frameSize, channelId)} so that the payload is only chunked once
+            per group.
+        """
         c = self.channel
 
-        if timestamp < c.timestamp:
-            relTimestamp = timestamp
+        if chunks is not None:
+            key = (c.frameSize, c.channelId)
+            body = chunks.get(key, None)
+
+            if body is not None:
+                return body
+
+        frameSize = c.frameSize
+
+        if len(data) <= frameSize:
+            body = data
         else:
-            relTimestamp = timestamp - c.timestamp
+            body = self._continuationHeader.join([data[i:i + frameSize]
+                for i in xrange(0, len(data), frameSize)])
 
-        h = header.Header(c.channelId, relTimestamp, self.type, len(data), self.streamId)
+        if chunks is not None:
+            chunks[key] = body
 
-        if self._lastHeader is None:
-            h.full = True
+        return body
 
-        c.setHeader(h)
-        c.append(data)
 
-        header.encode(self.stream, h, self._lastHeader)
-        self._lastHeader = h
+    def sendData(self, data, timestamp, chunks=None):
+        """
+        Writes C{data} to the output.
 
-        c.marshallOneFrame()
+        The first message gets a full header. After that a type 3 header is
+        written if the timestamp delta and the body length are the same as the
+        previous message, type 2 if only the body length is and type 1
+        otherwise. No L{header.Header} objects are created past the first
+        message.
 
-        while not c.complete():
-            self.stream.write(self._continuationHeader)
-            c.marshallOneFrame()
+        @param chunks: See L{getChunkedBody}.
+        """
+        c = self.channel
+        bodyLength = len(data)
 
-        c.reset()
-        s = self.stream.getvalue()
-        self.output.write(s)
-        self.encoder.bytes += len(s)
+        if timestamp < c.timestamp:
+            delta = timestamp
+        else:
+            delta = timestamp - c.timestamp
 
-        self.stream.consume()
+        if self._lastDelta is None:
+            first = header.encode_bytes(header.Header(c.channelId, delta,
+                self.type, bodyLength, self.streamId, True))
+
+            c.setTimestamp(delta, False)
+        else:
+            if bodyLength != self._lastLength or self.type != self._lastType:
+                first = self._mediumHeader + header.pack_medium(delta,
+                    bodyLength, self.type)
+            elif delta != self._lastDelta:
+                first = self._smallHeader + header.pack_small(delta)
+            else:
+                first = self._continuationHeader
+
+            c.setTimestamp(delta)
+
+        self._lastDelta = delta
+        self._lastLength = bodyLength
+        self._lastType = self.type
+
+        body = self.getChunkedBody(data, chunks)
+
+        self.output.writeSequence([first, body])
+        self.encoder.bytes += len(first) + len(body)
 
 
 
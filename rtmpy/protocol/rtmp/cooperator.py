@@ -0,0 +1,355 @@
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+A cooperative scheduler for the decoders and encoders of all the RTMP
+connections in the process.
+
+Connections with work to do are kept in a ready queue (one for decoding, one
+for encoding). On every reactor turn, each ready connection is run for up to
+L{Cooperator.timeSlice} seconds, in turn, until the time budget of the queue
+has been spent. A connection that still has work to do goes to the back of
+its queue.
+
+Unlike C{twisted.internet.task.coiterate}, a task outlives its iterator being
+exhausted. It goes idle and is put back in its ready queue by
+L{CooperativeTask.wake} when there is more work, so each connection keeps the
+same task for as long as it is streaming. The time that connections wait in
+the ready queues is sampled, see L{Cooperator.getDelay}.
+"""
+
+import collections
+import time
+
+from twisted.internet import defer
+from twisted.python import failure, log
+
+
+__all__ = [
+    'Cooperator',
+    'getCooperator',
+]
+
+
+#: The ready queues of a L{Cooperator}.
+DECODE = 0
+ENCODE = 1
+
+
+
+class CooperativeTask(object):
+    """
+    An iterator that is run by a L{Cooperator}. Mirrors the parts of
+    C{twisted.internet.task.CooperativeTask} that are used by the streamers.
+
+    The task is not thrown away when its iterator is exhausted, it goes idle
+    until L{wake} is called.
+
+    @ivar iterator: The iterator being run, one C{next} call at a time.
+    @ivar queue: L{DECODE} or L{ENCODE}.
+    @ivar callback: Called with the iterator each time it is exhausted, or
+        with a C{Failure} if it raised. May be C{None}.
+    @ivar paused: Whether the task has been paused.
+    @ivar done: Whether the iterator is exhausted (or failed), i.e. the task
+        is idle.
+    @ivar stopped: Whether the task has been taken off the cooperator for
+        good, see L{stop}.
+    @ivar readySince: When the task was put in its ready queue.
+    """
+
+
+    def __init__(self, cooperator, iterator, queue, callback=None):
+        self.cooperator = cooperator
+        self.iterator = iterator
+        self.queue = queue
+        self.callback = callback
+
+        self.paused = False
+        self.done = False
+        self.stopped = False
+        self.readySince = None
+
+        self._result = None
+        self._deferred = None
+
+
+    def whenDone(self):
+        """
+        Returns a C{Deferred} that fires with the iterator when it is next
+        exhausted, or errbacks with the exception it raised. The same
+        C{Deferred} is returned until then. It is only created when asked for.
+        """
+        if self.done:
+            return defer.succeed(self._result)
+
+        if self._deferred is None:
+            self._deferred = defer.Deferred()
+
+        return self._deferred
+
+
+    def wake(self):
+        """
+        Puts an idle task back in its ready queue, e.g. when there is more data
+        to decode. Does nothing if the task is busy or has been stopped.
+        """
+        if not self.done or self.stopped:
+            return
+
+        self.done = False
+        self._result = None
+
+        if not self.paused:
+            self.cooperator.ready(self)
+
+
+    def pause(self):
+        """
+        Takes this task out of its ready queue until L{resume} is called. An
+        idle task stays out of the queue if it is woken in the meantime.
+        """
+        if self.paused or self.stopped:
+            return
+
+        self.paused = True
+        self.cooperator.unready(self)
+
+
+    def resume(self):
+        """
+        Puts this task back in its ready queue.
+        """
+        if not self.paused:
+            return
+
+        self.paused = False
+
+        if not self.done and not self.stopped:
+            self.cooperator.ready(self)
+
+
+    def stop(self):
+        """
+        Takes this task off the cooperator for good. Any work still queued is
+        not run.
+        """
+        self.stopped = True
+        self.cooperator.unready(self)
+
+
+    def finish(self, result):
+        """
+        Called by the cooperator when the iterator is exhausted (or failed).
+        The task goes idle.
+        """
+        self.done = True
+        self._result = result
+
+        if self.callback is not None:
+            try:
+                self.callback(result)
+            except:
+                log.err()
+
+        d, self._deferred = self._deferred, None
+
+        if d is not None:
+            d.callback(result)
+
+
+
+class Cooperator(object):
+    """
+    Runs L{CooperativeTask}s in turn from the reactor.
+
+    @cvar timeSlice: The maximum number of seconds a task is run for before
+        the next task gets its turn.
+    @cvar decodeBudget: The number of seconds per reactor turn that may be
+        spent running decoders.
+    @cvar encodeBudget: The number of seconds per reactor turn that may be
+        spent running encoders.
+    @cvar sampleSize: The number of scheduling delays kept per queue.
+    @ivar queues: The ready queues, indexed by L{DECODE} and L{ENCODE}.
+    @ivar delays: The most recent scheduling delays (the time between a task
+        being put in its ready queue and it being run), per queue.
+    """
+
+    timeSlice = 0.002
+    decodeBudget = 0.01
+    encodeBudget = 0.01
+    sampleSize = 1024
+
+    clock = staticmethod(time.time)
+
+
+    def __init__(self, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+
+        self.reactor = reactor
+
+        self.queues = (collections.OrderedDict(), collections.OrderedDict())
+        self.delays = (collections.deque(maxlen=self.sampleSize),
+            collections.deque(maxlen=self.sampleSize))
+
+        self._call = None
+
+
+    def cooperate(self, iterator, queue=ENCODE, callback=None):
+        """
+        Starts running C{iterator}.
+
+        @param callback: See L{CooperativeTask.callback}.
+        @rtype: L{CooperativeTask}
+        """
+        task = CooperativeTask(self, iterator, queue, callback)
+
+        self.ready(task)
+
+        return task
+
+
+    def decode(self, iterator, callback=None):
+        """
+        Starts running the decoder C{iterator}.
+        """
+        return self.cooperate(iterator, DECODE, callback)
+
+
+    def encode(self, iterator, callback=None):
+        """
+        Starts running the encoder C{iterator}.
+        """
+        return self.cooperate(iterator, ENCODE, callback)
+
+
+    def ready(self, task):
+        """
+        Puts C{task} at the back of its ready queue.
+        """
+        task.readySince = self.clock()
+        self.queues[task.queue][task] = None
+
+        if self._call is None:
+            self._call = self.reactor.callLater(0, self.tick)
+
+
+    def unready(self, task):
+        """
+        Takes C{task} out of its ready queue.
+        """
+        self.queues[task.queue].pop(task, None)
+
+
+    def tick(self):
+        """
+        Runs the ready tasks, decoders first.
+        """
+        self._call = None
+
+        self.run(DECODE, self.decodeBudget)
+        self.run(ENCODE, self.encodeBudget)
+
+        if (self.queues[DECODE] or self.queues[ENCODE]) and self._call is None:
+            self._call = self.reactor.callLater(0, self.tick)
+
+
+    def run(self, queue, budget):
+        """
+        Runs the tasks in C{queue} in turn until C{budget} seconds have been
+        spent. Each task gets at most one turn.
+        """
+        ready = self.queues[queue]
+        delays = self.delays[queue]
+        clock = self.clock
+        timeSlice = self.timeSlice
+
+        now = clock()
+        end = now + budget
+
+        for i in xrange(len(ready)):
+            if not ready or now >= end:
+                break
+
+            task = ready.popitem(False)[0]
+            iterator = task.iterator
+
+            delays.append(now - task.readySince)
+            sliceEnd = min(now + timeSlice, end)
+
+            try:
+                while not (task.paused or task.stopped):
+                    iterator.next()
+
+                    now = clock()
+
+                    if now >= sliceEnd:
+                        break
+            except StopIteration:
+                task.finish(iterator)
+            except:
+                task.finish(failure.Failure())
+            else:
+                if not (task.paused or task.stopped) and task not in ready:
+                    task.readySince = now
+                    ready[task] = None
+
+            now = clock()
+
+
+    def getDelay(self, queue, percentile):
+        """
+        Returns the scheduling delay (in seconds) at C{percentile} (0-100) of
+        the sampled delays for C{queue}, or C{None} if nothing has been run.
+        """
+        delays = sorted(self.delays[queue])
+
+        if not delays:
+            return None
+
+        return delays[min(len(delays) - 1, len(delays) * percentile // 100)]
+
+
+    def getStats(self):
+        """
+        Returns the number of ready tasks and the p50/p99 scheduling delay per
+        queue.
+        """
+        stats = {}
+
+        for name, queue in (('decode', DECODE), ('encode', ENCODE)):
+            stats[name] = {
+                'ready': len(self.queues[queue]),
+                'p50': self.getDelay(queue, 50),
+                'p99': self.getDelay(queue, 99),
+            }
+
+        return stats
+
+
+
+_cooperator = None
+
+
+def getCooperator():
+    """
+    Returns the process wide L{Cooperator}.
+    """
+    global _cooperator
+
+    if _cooperator is None:
+        _cooperator = Cooperator()
+
+    return _cooperator
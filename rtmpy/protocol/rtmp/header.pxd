@@ -32,6 +32,18 @@ cdef class Header:
 @cython.locals(mask=cython.int, channelId=cython.int)
 cpdef object encode(cBufferedByteStream stream, Header header, Header previous=?)
 
+@cython.locals(mask=cython.int, timestamp=cython.long, bodyLength=cython.long,
+    streamId=cython.long)
+cpdef bytes encode_bytes(Header header, Header previous=?)
+
+@cython.locals(first=cython.int, bits=cython.int, size=cython.int,
+    ts=cython.Py_ssize_t)
+cpdef int get_size(object buf, Py_ssize_t offset=?) except -1
+
+@cython.locals(bits=cython.int, channelId=cython.int, pos=cython.Py_ssize_t,
+    timestamp=cython.long, header=Header)
+cpdef tuple decode_from(object buf, Py_ssize_t offset=?)
+
 @cython.locals(channelId=cython.int, bits=cython.int, header=Header)
 cpdef Header decode(cBufferedByteStream stream)
 
@@ -20,11 +20,14 @@ Utility/helper functions for encoding and decoding RTMP headers.
     #rtmp_packet_structure>}
 """
 
+import struct
+
 __all__ = [
     'Header',
     'encode',
     'decode',
-    'merge'
+    'merge',
+    'update',
 ]
 
 
@@ -52,6 +55,14 @@ class Header(object):
         self.full = full
         self.continuation = continuation
 
+    def copy(self):
+        """
+        Returns a copy of this header. Channels update their header in place,
+        a copy must be taken if it needs to outlive the current frame.
+        """
+        return Header(self.channelId, self.timestamp, self.datatype,
+            self.bodyLength, self.streamId, self.full, self.continuation)
+
     def __repr__(self):
         attrs = []
 
@@ -70,6 +81,143 @@ class Header(object):
             id(self))
 
 
+#: The largest possible encoded header (3 byte channel id, full header and an
+#: extended timestamp).
+MAX_HEADER_SIZE = 18
+#: The number of bytes following the channel id for each of the header types,
+#: indexed by the 2 bit header type (excluding any extended timestamp).
+HEADER_SIZES = (11, 7, 3, 0)
+
+# Precompiled structs for each of the header types. 24 bit values are packed
+# as a 32 bit int that shares its low byte with the next field.
+_uchar = struct.Struct('!B')
+_ushort_le = struct.Struct('<H')
+_full = struct.Struct('!IHB4B')
+_full_ext = struct.Struct('!IHB4BI')
+_medium = struct.Struct('!IHB')
+_medium_ext = struct.Struct('!IHBI')
+_small = struct.Struct('!HB')
+_small_ext = struct.Struct('!HBI')
+_ulong = struct.Struct('!I')
+
+#: Encoded channel ids that fit in 1 or 2 bytes, indexed by header type then
+#: channelId.
+_basicHeaders = []
+#: Cache of encoded 3 byte channel ids, built on demand.
+_largeBasicHeaders = {}
+
+
+def _encode_basic_header(channelId, mask):
+    """
+    Returns the encoded mask and channel id (the I{basic header}).
+    """
+    channelId += 2
+
+    if channelId < 64:
+        return chr(mask | channelId)
+
+    if channelId < 320:
+        return chr(mask) + chr(channelId - 64)
+
+    channelId -= 64
+
+    return chr(mask | 1) + _ushort_le.pack(channelId)
+
+
+for mask in (0x00, 0x40, 0x80, 0xc0):
+    _basicHeaders.append([_encode_basic_header(channelId, mask)
+        for channelId in xrange(0, 318)])
+
+del mask
+
+
+def get_basic_header(channelId, mask):
+    """
+    Returns the (precomputed) encoded mask and channel id bytes.
+
+    @param channelId: The id of the channel.
+    @param mask: The header type mask, one of C{0x00}, C{0x40}, C{0x80} or
+        C{0xc0}.
+    """
+    if channelId < 318:
+        return _basicHeaders[mask >> 6][channelId]
+
+    key = (channelId, mask)
+
+    try:
+        return _largeBasicHeaders[key]
+    except KeyError:
+        ret = _largeBasicHeaders[key] = _encode_basic_header(channelId, mask)
+
+        return ret
+
+
+def encode_bytes(header, previous=None):
+    """
+    Returns the encoded bytes for C{header}. See L{encode}.
+
+    @rtype: C{str}
+    """
+    if previous is None:
+        mask = 0
+    else:
+        if header.continuation:
+            mask = 0xc0
+        else:
+            mask = get_size_mask(header, previous)
+
+    basic = get_basic_header(header.channelId, mask)
+
+    if mask == 0xc0:
+        return basic
+
+    timestamp = header.timestamp
+
+    if mask == 0x80:
+        return basic + pack_small(timestamp)
+
+    bodyLength = header.bodyLength
+
+    if mask == 0x40:
+        return basic + pack_medium(timestamp, bodyLength, header.datatype)
+
+    streamId = header.streamId
+
+    if timestamp >= 0xffffff:
+        return basic + _full_ext.pack(0xffffff00 | (bodyLength >> 16),
+            bodyLength & 0xffff, header.datatype, streamId & 0xff,
+            (streamId >> 8) & 0xff, (streamId >> 16) & 0xff, streamId >> 24,
+            timestamp)
+
+    return basic + _full.pack((timestamp << 8) | (bodyLength >> 16),
+        bodyLength & 0xffff, header.datatype, streamId & 0xff,
+        (streamId >> 8) & 0xff, (streamId >> 16) & 0xff, streamId >> 24)
+
+
+def pack_medium(timestamp, bodyLength, datatype):
+    """
+    Returns the bytes that follow the basic header of a type 1 (medium)
+    header, including any extended timestamp.
+    """
+    if timestamp >= 0xffffff:
+        return _medium_ext.pack(0xffffff00 | (bodyLength >> 16),
+            bodyLength & 0xffff, datatype, timestamp)
+
+    return _medium.pack((timestamp << 8) | (bodyLength >> 16),
+        bodyLength & 0xffff, datatype)
+
+
+def pack_small(timestamp):
+    """
+    Returns the bytes that follow the basic header of a type 2 (small)
+    header, including any extended timestamp.
+    """
+    if timestamp >= 0xffffff:
+        return _small_ext.pack(0xffff, 0xff, timestamp)
+
+    return _small.pack(timestamp >> 8, timestamp & 0xff)
+
+
 def encode(stream, header, previous=None):
     """
     Encodes a RTMP header to C{stream}.
@@ -78,12 +226,14 @@ def encode(stream, header, previous=None):
 
     The channel id can be encoded in up to 3 bytes. The first byte is special as
     it contains the size of the rest of the header as described in
-    L{getHeaderSize}.
+    L{get_size_mask}.
 
     0 >= channelId > 64: channelId
     64 >= channelId > 320: 0, channelId - 64
     320 >= channelId > 0xffff + 64: 1, channelId - 64 (written as 2 byte int)
 
+    Use L{encode_bytes} for streams that only implement C{write}.
+
     @param stream: The stream to write the encoded header.
     @type stream: L{util.BufferedByteStream}
     @param header: The L{Header} to encode.
@@ -134,6 +284,101 @@ def encode(stream, header, previous=None):
             stream.write_ulong(header.timestamp)
 
 
+def get_size(buf, offset=0):
+    """
+    Returns the number of bytes required to decode the header starting at
+    C{offset} in C{buf}. Only the first byte is required to determine the
+    size, the extended timestamp (if any) is only accounted for once the
+    timestamp field is available.
+
+    @param buf: Any object supporting the buffer interface. Must contain at
+        least one byte from C{offset}.
+    @return: The size of the header or, if C{buf} does not contain enough
+        bytes to determine whether there is an extended timestamp, the
+        minimum size of the header.
+    @rtype: C{int}
+    """
+    first, = _uchar.unpack_from(buf, offset)
+    bits = first >> 6
+    first &= 0x3f
+
+    if first > 1:
+        size = 1
+    else:
+        size = first + 2
+
+    if bits == 3:
+        return size
+
+    ts = offset + size
+    size += HEADER_SIZES[bits]
+
+    if buf[ts:ts + 3] == '\xff\xff\xff':
+        size += 4
+
+    return size
+
+
+def decode_from(buf, offset=0):
+    """
+    Decodes a header from C{buf}, starting at C{offset}. Each of the header
+    types is unpacked with a single precompiled struct.
+
+    @param buf: Any object supporting the buffer interface (C{str},
+        C{bytearray} etc.)
+    @return: A tuple containing the decoded L{Header} and the number of bytes
+        that it occupied in C{buf}.
+    @raise IOError: Not enough bytes in C{buf} to decode the header.
+    """
+    try:
+        channelId, = _uchar.unpack_from(buf, offset)
+        bits = channelId >> 6
+        channelId &= 0x3f
+
+        if channelId > 1:
+            pos = offset + 1
+        elif channelId == 0:
+            channelId, = _uchar.unpack_from(buf, offset + 1)
+            channelId += 64
+            pos = offset + 2
+        else:
+            channelId, = _ushort_le.unpack_from(buf, offset + 1)
+            channelId += 64
+            pos = offset + 3
+
+        channelId -= 2
+
+        if bits == 3:
+            return Header(channelId, -1, -1, -1, -1, False, True), pos - offset
+
+        if bits == 2:
+            a, b = _small.unpack_from(buf, pos)
+            timestamp = (a << 8) | b
+            header = Header(channelId, timestamp)
+            pos += 3
+        elif bits == 1:
+            a, b, datatype = _medium.unpack_from(buf, pos)
+            timestamp = a >> 8
+            header = Header(channelId, timestamp, datatype,
+                ((a & 0xff) << 16) | b)
+            pos += 7
+        else:
+            a, b, datatype, s0, s1, s2, s3 = _full.unpack_from(buf, pos)
+            timestamp = a >> 8
+            header = Header(channelId, timestamp, datatype,
+                ((a & 0xff) << 16) | b,
+                s0 | (s1 << 8) | (s2 << 16) | (s3 << 24), True)
+            pos += 11
+
+        if timestamp == 0xffffff:
+            header.timestamp, = _ulong.unpack_from(buf, pos)
+            pos += 4
+    except struct.error:
+        raise IOError('Not enough data to decode header')
+
+    return header, pos - offset
+
+
 def decode(stream):
     """
     Reads a header from the incoming stream.
@@ -141,45 +386,59 @@ def decode(stream):
     A header can be of varying lengths and the properties that get updated
     depend on the length.
 
+    Use L{decode_from} to decode from any other buffer.
+
     @param stream: The byte stream to read the header from.
     @type stream: C{pyamf.util.BufferedByteStream}
     @return: The read header from the stream.
     @rtype: L{Header}
+    @raise IOError: Not enough data in the stream. The stream position is
+        left untouched.
     """
-    # read the size and channelId
-    channelId = stream.read_uchar()
-    bits = channelId >> 6
-    channelId &= 0x3f
+    pos = stream.tell()
 
-    if channelId == 0:
-        channelId = stream.read_uchar() + 64
+    try:
+        # read the size and channelId
+        channelId = stream.read_uchar()
+        bits = channelId >> 6
+        channelId &= 0x3f
 
-    if channelId == 1:
-        channelId = stream.read_uchar() + 64 + (stream.read_uchar() << 8)
+        if channelId == 0:
+            channelId = stream.read_uchar() + 64
 
-    header = Header(channelId - 2)
+        if channelId == 1:
+            channelId = stream.read_uchar() + 64 + (stream.read_uchar() << 8)
 
-    if bits == 3:
-        header.continuation = True
+        header = Header(channelId - 2)
 
-        return header
+        if bits == 3:
+            header.continuation = True
 
-    header.timestamp = stream.read_24bit_uint()
+            return header
 
-    if bits < 2:
-        header.bodyLength = stream.read_24bit_uint()
-        header.datatype = stream.read_uchar()
+        header.timestamp = stream.read_24bit_uint()
 
-    if bits < 1:
-        # streamId is little endian
-        stream.endian = '<'
-        header.streamId = stream.read_ulong()
-        stream.endian = '!'
+        if bits < 2:
+            header.bodyLength = stream.read_24bit_uint()
+            header.datatype = stream.read_uchar()
+
+        if bits < 1:
+            # streamId is little endian
+            stream.endian = '<'
 
-        header.full = True
+            try:
+                header.streamId = stream.read_ulong()
+            finally:
+                stream.endian = '!'
 
-    if header.timestamp == 0xffffff:
-        header.timestamp = stream.read_ulong()
+            header.full = True
+
+        if header.timestamp == 0xffffff:
+            header.timestamp = stream.read_ulong()
+    except IOError:
+        stream.seek(pos)
+
+        raise
 
     return header
 
@@ -222,6 +481,37 @@ def merge(old, new):
     return merged
 
 
+def update(old, new):
+    """
+    Merges the values of C{new} in to C{old}, like L{merge} but without
+    creating a new header.
+
+    @type old: L{Header}
+    @type new: L{Header}
+    @return: C{old}
+    """
+    if old.channelId != new.channelId:
+        raise HeaderError('channelId mismatch on update old=%r, new=%r' % (
+            old.channelId, new.channelId))
+
+    if new.streamId != -1:
+        old.streamId = new.streamId
+
+    if new.bodyLength != -1:
+        old.bodyLength = new.bodyLength
+
+    if new.datatype != -1:
+        old.datatype = new.datatype
+
+    if new.timestamp != -1:
+        old.timestamp = new.timestamp
+
+    old.full = False
+    old.continuation = False
+
+    return old
+
+
 def get_size_mask(old, new):
     """
     Returns the number of bytes needed to de/encode the header based on the
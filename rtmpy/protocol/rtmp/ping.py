@@ -0,0 +1,201 @@
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Round trip time measurement using ping control messages.
+
+The peer answers a L{message.ControlMessage.PING} with a
+L{message.ControlMessage.PONG} carrying the same value. The round trip time
+is smoothed the same way TCP does (RFC 6298), the mean deviation is used as
+the jitter.
+"""
+
+import collections
+
+from rtmpy import message
+
+
+__all__ = [
+    'Pinger',
+]
+
+
+
+class Pinger(object):
+    """
+    Pings the peer of a streamer every L{interval} seconds.
+
+    @cvar interval: The number of seconds between pings.
+    @cvar timeout: The number of seconds a ping may go unanswered before
+        C{streamer.pingTimedOut} is called. C{0} disables the timeout.
+    @ivar rtt: The smoothed round trip time in seconds, C{None} until the
+        first ping has been answered.
+    @ivar jitter: The mean deviation of the round trip time in seconds.
+    @ivar lastRTT: The round trip time of the last answered ping.
+    @ivar outstanding: Ping value -> time sent, for the pings that have not
+        been answered, oldest first.
+    """
+
+    interval = 10.0
+    timeout = 30.0
+
+
+    def __init__(self, streamer, interval=None, timeout=None, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+
+        self.streamer = streamer
+        self.reactor = reactor
+
+        if interval is not None:
+            self.interval = interval
+
+        if timeout is not None:
+            self.timeout = timeout
+
+        self.rtt = None
+        self.jitter = None
+        self.lastRTT = None
+        self.outstanding = collections.OrderedDict()
+
+        self._sequence = 0
+        self._call = None
+        self._timeoutCall = None
+
+
+    def clock(self):
+        """
+        Returns the current time of the reactor that the pings are scheduled
+        with, so that round trip times and timeouts agree.
+        """
+        return self.reactor.seconds()
+
+
+    @property
+    def running(self):
+        return self._call is not None
+
+
+    def start(self):
+        """
+        Sends the first ping and schedules the rest.
+        """
+        if self.running:
+            return
+
+        self.ping()
+
+
+    def stop(self):
+        """
+        Stops pinging. Pings that are still outstanding are forgotten.
+        """
+        for call in (self._call, self._timeoutCall):
+            if call is not None and call.active():
+                call.cancel()
+
+        self._call = None
+        self._timeoutCall = None
+        self.outstanding.clear()
+
+
+    def ping(self):
+        """
+        Sends a ping to the peer and schedules the next one.
+        """
+        self._call = self.reactor.callLater(self.interval, self.ping)
+
+        self._sequence = (self._sequence + 1) & 0xffffffff
+        self.outstanding[self._sequence] = self.clock()
+
+        self.streamer.sendMessage(message.ControlMessage(
+            message.ControlMessage.PING, self._sequence),
+            self.streamer.controlStream)
+
+        if self.timeout and self._timeoutCall is None:
+            self._timeoutCall = self.reactor.callLater(self.timeout,
+                self.timedOut)
+
+
+    def pong(self, value):
+        """
+        Called when the peer answers the ping with C{value}. Unknown values
+        are ignored.
+        """
+        sent = self.outstanding.pop(value, None)
+
+        if sent is None:
+            return
+
+        now = self.clock()
+
+        # control messages are answered in order, older pings have been lost
+        while self.outstanding:
+            oldest, oldestSent = next(self.outstanding.iteritems())
+
+            if oldestSent > sent:
+                break
+
+            del self.outstanding[oldest]
+
+        self.update(now - sent)
+
+        if self._timeoutCall is not None:
+            self._timeoutCall.cancel()
+            self._timeoutCall = None
+
+        if self.outstanding and self.timeout:
+            oldestSent = next(self.outstanding.itervalues())
+
+            self._timeoutCall = self.reactor.callLater(
+                max(0, self.timeout - (now - oldestSent)), self.timedOut)
+
+
+    def update(self, rtt):
+        """
+        Adds a round trip time sample to the estimates.
+        """
+        self.lastRTT = rtt
+
+        if self.rtt is None:
+            self.rtt = rtt
+            self.jitter = rtt / 2.0
+
+            return
+
+        self.jitter = 0.75 * self.jitter + 0.25 * abs(self.rtt - rtt)
+        self.rtt = 0.875 * self.rtt + 0.125 * rtt
+
+
+    def timedOut(self):
+        """
+        A ping has not been answered within L{timeout} seconds.
+        """
+        self._timeoutCall = None
+
+        self.stop()
+        self.streamer.pingTimedOut()
+
+
+    def getStats(self):
+        """
+        Returns the round trip time estimates, in seconds.
+        """
+        return {
+            'rtt': self.rtt,
+            'jitter': self.jitter,
+            'last': self.lastRTT,
+            'outstanding': len(self.outstanding),
+        }
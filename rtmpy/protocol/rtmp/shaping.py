@@ -0,0 +1,88 @@
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Bandwidth shaping for the output of a streamer.
+
+The bytes written are not charged one write at a time. The streamer lets the
+encoder write up to the tokens that are available and only settles with the
+bucket once that limit has been reached, see
+L{rtmpy.protocol.rtmp.BaseStreamer.setShaper}.
+"""
+
+import time
+
+
+__all__ = [
+    'TokenBucket',
+]
+
+
+
+class TokenBucket(object):
+    """
+    A token bucket, one token per byte.
+
+    @ivar rate: The number of tokens added per second.
+    @ivar burst: The maximum number of tokens the bucket holds, i.e. the
+        number of bytes that can be sent in one go after being idle.
+    @ivar tokens: The number of tokens in the bucket when it was last
+        L{refill}ed. Goes negative if more bytes were sent than allowed.
+    """
+
+    clock = staticmethod(time.time)
+
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or rate
+
+        self.tokens = self.burst
+        self.updated = None
+
+
+    def refill(self):
+        """
+        Adds the tokens earned since the last refill.
+        """
+        now = self.clock()
+
+        if self.updated is not None:
+            self.tokens = min(self.burst,
+                self.tokens + (now - self.updated) * self.rate)
+
+        self.updated = now
+
+
+    def consume(self, size):
+        """
+        Takes C{size} tokens from the bucket, whether they are there or not.
+        """
+        self.refill()
+
+        self.tokens -= size
+
+
+    def getDelay(self, size):
+        """
+        Returns the number of seconds until C{size} tokens (no more than
+        L{burst}) are available, as of the last L{refill}.
+        """
+        size = min(size, self.burst)
+
+        if self.tokens >= size:
+            return 0
+
+        return (size - self.tokens) / float(self.rate)
@@ -17,6 +17,7 @@
 Server implementation.
 """
 import urlparse
+import collections
 
 from zope.interface import Interface, Attribute, implements
 from twisted.internet import protocol, defer
@@ -24,8 +25,9 @@ from twisted.python import failure, log
 import pyamf
 
 from rtmpy import util, exc, versions
-from rtmpy import message, rpc, status, core
+from rtmpy import message, rpc, status, core, flv
 from rtmpy.protocol import rtmp, handshake, version
+from rtmpy.protocol.rtmp import codec, ping, shaping
 from rtmpy.status import codes
 
 
@@ -196,6 +198,49 @@ class Client(object):
         self.nc = nc
         self.id = None
 
+    def getPinger(self):
+        """
+        Returns the L{ping.Pinger} of the connection, or C{None}.
+        """
+        protocol = getattr(self.nc, 'protocol', None)
+
+        return getattr(protocol, 'pinger', None)
+
+    @property
+    def rtt(self):
+        """
+        The smoothed round trip time to the peer in seconds, C{None} if it is
+        not known (yet).
+        """
+        pinger = self.getPinger()
+
+        return pinger.rtt if pinger is not None else None
+
+    @property
+    def jitter(self):
+        """
+        The mean deviation of the round trip time in seconds, C{None} if it is
+        not known (yet).
+        """
+        pinger = self.getPinger()
+
+        return pinger.jitter if pinger is not None else None
+
+    def setBandwidthLimit(self, rate, burst=None):
+        """
+        Caps the rate at which data is sent to this client, overriding the
+        limit set by the application.
+
+        @param rate: Bytes per second, C{0} removes the limit.
+        @param burst: See L{shaping.TokenBucket.burst}.
+        """
+        shaper = None
+
+        if rate:
+            shaper = shaping.TokenBucket(rate, burst)
+
+        self.nc.protocol.setShaper(shaper)
+
     def call(self, name, *args, **kwargs):
         return self.nc.call(name, *args, **kwargs)
 
@@ -215,14 +260,29 @@ class NetStream(core.NetStream):
         receive the audio/video/meta data events from the peer. See
         L{StreamPublisher} for now.
     @type publisher: L{IPublishingStream}
+    @ivar queue: Audio/video waiting to be written while playing, see
+        L{flushQueue}.
+    @type queue: L{MediaQueue}
+    @ivar replaying: Whether the publisher's GOP cache is being replayed. Any
+        replayed a/v that has to be queued is pinned in the L{queue}.
+    @ivar source: When playing, the publisher this stream is subscribed to.
+    @type source: L{StreamPublisher}
+    @cvar maxQueueBytes: See L{MediaQueue.maxBytes}.
+    @cvar maxQueueDuration: See L{MediaQueue.maxDuration}.
     """
 
+    maxQueueBytes = 1024 * 1024
+    maxQueueDuration = 3000
+
     def __init__(self, nc, streamId):
         core.NetStream.__init__(self, nc, streamId)
 
         self.state = None
         self.name = None
         self.publisher = None
+        self.queue = MediaQueue(self.maxQueueBytes, self.maxQueueDuration)
+        self.replaying = False
+        self.source = None
 
     def publishingStarted(self, publisher, name):
         """
@@ -295,6 +355,15 @@ class NetStream(core.NetStream):
 
             d.addBoth(send_status)
 
+        if self.source is not None:
+            # stop receiving a/v from the publisher
+            try:
+                self.source.removeSubscriber(self)
+            except KeyError:
+                pass
+
+            self.source = None
+
         def clear_state(res):
             self.state = None
 
@@ -309,6 +378,8 @@ class NetStream(core.NetStream):
         Called when the producer stream has gone away. Perform clean up here.
         """
         # todo inform the nc that the stream went away
+        self.source = None
+
         self.sendStatus('NetStream.Play.UnpublishNotify')
 
     def onVideoData(self, data, timestamp):
@@ -379,6 +450,8 @@ class NetStream(core.NetStream):
             """
             The stream has started playing
             """
+            self.source = res
+
             self._audioChannel = self.nc.getStreamingChannel(self)
             self._audioChannel.setType(message.AUDIO_DATA)
 
@@ -401,6 +474,18 @@ class NetStream(core.NetStream):
 
             self.nc.call('onStatus', {'code': 'NetStream.Data.Start'})
 
+            # send the cached GOP (if any) so the peer can start decoding
+            # immediately
+            replay = getattr(res, 'replay', None)
+
+            if replay is not None:
+                self.replaying = True
+
+                try:
+                    replay(self)
+                finally:
+                    self.replaying = False
+
             return res
 
         def eb(fail):
@@ -414,8 +499,6 @@ class NetStream(core.NetStream):
         d.addErrback(eb)
         d.addCallback(cb)
 
-        self._firstPacketReceived = False
-
         return d
 
     def onMetaData(self, data):
@@ -423,16 +506,50 @@ class NetStream(core.NetStream):
         """
         self.call('onMetaData', data)
 
-    def videoDataReceived(self, data, timestamp):
-        if not self._firstPacketReceived:
-            # set the framesize
-            self.nc.protocol.setFrameSize(len(data))
-            self._firstPacketReceived = True
+    def videoDataReceived(self, data, timestamp, chunks=None):
+        """
+        @param chunks: Shared between the subscribers of a publisher, see
+            L{codec.StreamingChannel.getChunkedBody}.
+        """
+        if not self.queue and self.isWritable():
+            self._videoChannel.sendData(data, timestamp, chunks)
 
-        self._videoChannel.sendData(data, timestamp)
+            return
 
-    def audioDataReceived(self, data, timestamp):
-        self._audioChannel.sendData(data, timestamp)
+        self.queue.push(message.VIDEO_DATA, data, timestamp, chunks,
+            self.replaying)
+        self.flushQueue()
+
+    def audioDataReceived(self, data, timestamp, chunks=None):
+        if not self.queue and self.isWritable():
+            self._audioChannel.sendData(data, timestamp, chunks)
+
+            return
+
+        self.queue.push(message.AUDIO_DATA, data, timestamp, chunks,
+            self.replaying)
+        self.flushQueue()
+
+    def isWritable(self):
+        """
+        Whether audio/video can be written to the transport without queueing,
+        see L{rtmp.BaseStreamer.isWritable}.
+        """
+        return self.nc.protocol.isWritable()
+
+    def flushQueue(self):
+        """
+        Writes as much of the L{queue} as the transport will take.
+        """
+        queue = self.queue
+
+        while queue and self.isWritable():
+            datatype, data, timestamp, chunks = queue.pop()
+
+            if datatype == message.VIDEO_DATA:
+                self._videoChannel.sendData(data, timestamp, chunks)
+            else:
+                self._audioChannel.sendData(data, timestamp, chunks)
 
 
 
@@ -593,10 +710,28 @@ class NetConnection(core.NetConnection):
 
             f = self.protocol.factory
 
+            policy = f.buildFrameSizePolicy()
+
+            if policy is not None:
+                self.protocol.setFrameSizePolicy(policy, f.egressBitrate,
+                    f.frameSizeInterval)
+
             # begin negotiating bandwidth
             self.sendMessage(message.DownstreamBandwidth(f.downstreamBandwidth))
+
+            if f.flowControl:
+                self.protocol.setSendWindow(f.downstreamBandwidth)
+
             self.sendMessage(message.UpstreamBandwidth(f.upstreamBandwidth, 2))
 
+            if self.protocol.pinger is not None:
+                self.protocol.pinger.start()
+
+            buildShaper = getattr(self.application, 'buildShaper', None)
+
+            if buildShaper is not None:
+                self.protocol.setShaper(buildShaper(self.client))
+
             return res
 
         def return_success(res):
@@ -614,7 +749,7 @@ class NetConnection(core.NetConnection):
                 {'mode': 1, 'capabilities': 31, 'fmsVer': 'FMS/3,5,1,516'})
 
         def lose_connection():
-            self.protocol.transport.loseConnection()
+            self.protocol.loseConnection()
 
 
         @rpc.after(lose_connection)
@@ -681,16 +816,29 @@ class NetConnection(core.NetConnection):
 
         return d
 
-    def sendMessage(self, msg, stream=None, whenDone=None):
+    def sendMessage(self, msg, stream=None, whenDone=None, deadline=None):
         """
         """
-        self.protocol.sendMessage(msg, stream or self, whenDone=whenDone)
+        self.protocol.sendMessage(msg, stream or self, whenDone=whenDone,
+            deadline=deadline)
 
 
     def getStreamingChannel(self, stream):
         return self.protocol.getStreamingChannel(stream)
 
 
+    def flushQueues(self):
+        """
+        Writes any audio/video queued by the streams, see
+        L{NetStream.flushQueue}.
+        """
+        for stream in self.streams.values():
+            flushQueue = getattr(stream, 'flushQueue', None)
+
+            if flushQueue is not None:
+                flushQueue()
+
+
 
 class ServerProtocol(rtmp.RTMPProtocol):
     """
@@ -699,6 +847,7 @@ class ServerProtocol(rtmp.RTMPProtocol):
     """
 
     netconnection = NetConnection
+    inlineDecodingBudget = 4096
 
 
     def buildStreamManager(self):
@@ -720,6 +869,31 @@ class ServerProtocol(rtmp.RTMPProtocol):
     def onConnect(self, params, *args):
         return self.nc.onConnect(params, *args)
 
+    def buildScheduler(self):
+        """
+        The scheduler is configured by the factory.
+        """
+        return self.factory.buildScheduler()
+
+    def buildPinger(self):
+        """
+        Pinging is configured by the factory, it starts once the connection
+        has been accepted.
+        """
+        return self.factory.buildPinger(self)
+
+    def resumeEncoding(self):
+        """
+        Playing streams queue audio/video while the transport is congested,
+        write it out now that there is room.
+        """
+        paused = self.encodingPaused
+
+        rtmp.RTMPProtocol.resumeEncoding(self)
+
+        if paused:
+            self.nc.flushQueues()
+
     def onDownstreamBandwidth(self, interval, timestamp):
         """
         """
@@ -749,14 +923,282 @@ class ServerProtocol(rtmp.RTMPProtocol):
         self.nc.onNotify(name, args, timestamp)
 
 
-    def onControlMessage(self, *args):
+    def resumeSending(self):
+        """
+        Playing streams queue audio/video while sending is throttled, write it
+        out now that there is room.
+        """
+        rtmp.RTMPProtocol.resumeSending(self)
+
+        self.nc.flushQueues()
+
+
+
+class CacheLimit(object):
+    """
+    A memory budget shared between a number of L{GOPCache}s.
+
+    @ivar maxBytes: The maximum number of bytes that may be held. C{0} means
+        unlimited.
+    @ivar size: The number of bytes currently held.
+    """
+
+    def __init__(self, maxBytes=0):
+        self.maxBytes = maxBytes
+        self.size = 0
+
+    def reserve(self, size):
+        """
+        Reserves C{size} bytes. Returns whether the bytes could be reserved.
+        """
+        if self.maxBytes and self.size + size > self.maxBytes:
+            return False
+
+        self.size += size
+
+        return True
+
+    def release(self, size):
+        """
+        Releases C{size} previously reserved bytes.
+        """
+        self.size -= size
+
+
+
+class GOPCache(object):
+    """
+    Holds the last group of pictures of a published stream so that a new
+    subscriber can start decoding straight away rather than waiting for the
+    next keyframe.
+
+    The cache contains every audio/video frame since the most recent keyframe.
+    Nothing is cached until the first keyframe is seen. Sequence headers are
+    not passed to the cache, they are kept by the L{StreamPublisher}.
+
+    @ivar maxBytes: The maximum number of bytes of frames to cache. If the
+        current GOP grows larger than this (or the L{limit} is exhausted), it
+        is dropped until the next keyframe. C{0} means unlimited.
+    @ivar limit: An optional L{CacheLimit} shared with other caches.
+    @ivar frames: A C{list} of C{(datatype, data, timestamp)} tuples.
+    @ivar size: The number of bytes in L{frames}.
+    """
+
+    def __init__(self, maxBytes=0, limit=None):
+        self.maxBytes = maxBytes
+        self.limit = limit
+
+        self.frames = []
+        self.size = 0
+
+    def add(self, datatype, data, timestamp):
+        """
+        Adds an audio/video payload to the cache.
+        """
+        if datatype == message.VIDEO_DATA and flv.is_keyframe(data):
+            self.clear()
+        elif not self.frames:
+            # waiting for a keyframe
+            return
+
+        size = len(data)
+
+        if self.maxBytes and self.size + size > self.maxBytes:
+            self.clear()
+
+            return
+
+        if self.limit is not None and not self.limit.reserve(size):
+            self.clear()
+
+            return
+
+        self.frames.append((datatype, data, timestamp))
+        self.size += size
+
+    def clear(self):
+        """
+        Empties the cache.
+        """
+        if self.limit is not None:
+            self.limit.release(self.size)
+
+        self.frames = []
+        self.size = 0
+
+    def getStartTimestamp(self):
+        """
+        Returns the timestamp of the first cached frame or C{None}.
+        """
+        if not self.frames:
+            return None
+
+        return self.frames[0][2]
+
+
+
+class MediaQueue(object):
+    """
+    A bounded queue of audio/video packets waiting to be written to a
+    subscriber whose connection cannot keep up.
+
+    When the queue overflows, disposable (non-reference) video frames are
+    dropped first. If that is not enough, the queued video is dropped up to
+    the last keyframe, or entirely if there is none, in which case incoming
+    video is discarded until the next keyframe. Audio and sequence headers
+    are never dropped.
+
+    Frames replayed from a L{GOPCache} are pushed as I{pinned}. They stay at
+    the head of the queue, are never dropped and do not count towards the
+    limits. Shedding them would throw away the frames that depend on the
+    keyframe that started the replay.
+
+    @ivar maxBytes: The maximum number of bytes to queue. C{0} means
+        unlimited.
+    @ivar maxDuration: The maximum span of media (in milliseconds) to queue.
+        C{0} means unlimited.
+    @ivar frames: A C{deque} of C{(datatype, data, timestamp, chunks)}
+        tuples.
+    @ivar size: The number of bytes in L{frames}.
+    @ivar pinned: The number of pinned frames at the head of L{frames}.
+    @ivar pinnedSize: The number of bytes in the pinned frames.
+    @ivar waitingForKeyframe: Whether video is being discarded until the next
+        keyframe.
+    @ivar droppedFrames: The number of video frames dropped.
+    @ivar droppedDisposableFrames: How many of L{droppedFrames} were
+        disposable.
+    @ivar droppedBytes: The number of bytes dropped.
+    """
+
+    def __init__(self, maxBytes=0, maxDuration=0):
+        self.maxBytes = maxBytes
+        self.maxDuration = maxDuration
+
+        self.frames = collections.deque()
+        self.size = 0
+        self.pinned = 0
+        self.pinnedSize = 0
+        self.waitingForKeyframe = False
+
+        self.droppedFrames = 0
+        self.droppedDisposableFrames = 0
+        self.droppedBytes = 0
+
+    def __len__(self):
+        return len(self.frames)
+
+    def isFull(self):
+        """
+        Whether the queue is over its byte or duration limit. Pinned frames
+        are not counted.
         """
+        if self.maxBytes and self.size - self.pinnedSize > self.maxBytes:
+            return True
+
+        if self.maxDuration and len(self.frames) - self.pinned > 1:
+            return (self.frames[-1][2] - self.frames[self.pinned][2] >
+                self.maxDuration)
+
+        return False
+
+    def push(self, datatype, data, timestamp, chunks=None, pinned=False):
+        """
+        Adds a packet to the end of the queue, shedding video if the queue
+        overflows.
+
+        @param pinned: Whether the packet is part of a replay. Only honoured
+            while every queued packet is pinned, as pinned packets must stay
+            at the head of the queue.
         """
+        if pinned and self.pinned == len(self.frames):
+            self.frames.append((datatype, data, timestamp, chunks))
+            self.size += len(data)
+            self.pinned += 1
+            self.pinnedSize += len(data)
+
+            return
+
+        if datatype == message.VIDEO_DATA and self.waitingForKeyframe:
+            if flv.is_keyframe(data):
+                self.waitingForKeyframe = False
+            elif not flv.is_video_sequence_header(data):
+                self._dropped(data)
+
+                return
+
+        self.frames.append((datatype, data, timestamp, chunks))
+        self.size += len(data)
+
+        if self.isFull():
+            self.shed()
+
+    def pop(self):
+        """
+        Removes and returns the packet at the head of the queue.
+        """
+        frame = self.frames.popleft()
+        self.size -= len(frame[1])
+
+        if self.pinned:
+            self.pinned -= 1
+            self.pinnedSize -= len(frame[1])
+
+        return frame
+
+    def shed(self):
+        """
+        Drops queued video until the queue is within its limits (or there is
+        no more video that can be dropped). Pinned frames are kept.
+        """
+        self._drop(lambda i, data: (
+            flv.frame_type(data) == flv.DISPOSABLE_INTER_FRAME))
+
+        if not self.isFull():
+            return
+
+        keyframe = None
+
+        for i, (datatype, data, timestamp, chunks) in enumerate(self.frames):
+            if (i > self.pinned and datatype == message.VIDEO_DATA and
+                    flv.is_keyframe(data)):
+                keyframe = i
 
+        if keyframe is not None:
+            self._drop(lambda i, data: i < keyframe)
 
-    def onBytesRead(self, *args):
+            if not self.isFull():
+                return
+
+        self._drop(lambda i, data: True)
+        self.waitingForKeyframe = True
+
+    def _drop(self, predicate):
         """
+        Drops the queued video frames for which C{predicate(index, data)} is
+        true. Sequence headers and pinned frames are kept.
         """
+        frames = collections.deque()
+        pinned = self.pinned
+
+        for i, frame in enumerate(self.frames):
+            data = frame[1]
+
+            if (i >= pinned and frame[0] == message.VIDEO_DATA and
+                    predicate(i, data) and
+                    not flv.is_video_sequence_header(data)):
+                self.size -= len(data)
+                self._dropped(data)
+            else:
+                frames.append(frame)
+
+        self.frames = frames
+
+    def _dropped(self, data):
+        self.droppedFrames += 1
+        self.droppedBytes += len(data)
+
+        if flv.frame_type(data) == flv.DISPOSABLE_INTER_FRAME:
+            self.droppedDisposableFrames += 1
 
 
 
@@ -769,14 +1211,22 @@ class StreamPublisher(object):
     @ivar stream: The publishing L{NetStream}
     @ivar client: The linked L{Client} object. Not used right now.
     @ivar subscribers: A list of subscribers that are listening to the stream.
-    @ivar
+    @ivar cache: Replayed to new subscribers, see L{replay}.
+    @type cache: L{GOPCache} or C{None}
+    @ivar videoSequenceHeader: The last AVC sequence header (decoder
+        configuration record) published, or C{None}.
+    @ivar audioSequenceHeader: The last AAC sequence header (audio specific
+        config) published, or C{None}.
     """
 
     implements(IPublishingStream)
 
-    def __init__(self, stream, client):
+    def __init__(self, stream, client, cache=None):
         self.stream = stream
         self.client = client
+        self.cache = cache
+        self.videoSequenceHeader = None
+        self.audioSequenceHeader = None
 
         self.subscribers = {}
         self.meta = {}
@@ -798,13 +1248,46 @@ class StreamPublisher(object):
         """
         Adds a subscriber to this publisher.
         """
+        timestamp = None
+
+        if self.cache is not None:
+            timestamp = self.cache.getStartTimestamp()
+
+        if timestamp is None:
+            timestamp = self.timestamp
+
         self.subscribers[subscriber] = {
-            'timestamp': self.timestamp
+            'timestamp': timestamp
         }
 
         if self.meta:
             subscriber.onMetaData(self.meta)
 
+    def replay(self, subscriber):
+        """
+        Sends the sequence headers and then the contents of the L{cache} to
+        C{subscriber}. Called once the subscriber is ready to receive
+        audio/video data, before any live frames.
+        """
+        if self.videoSequenceHeader is not None:
+            subscriber.videoDataReceived(self.videoSequenceHeader, 0)
+
+        if self.audioSequenceHeader is not None:
+            subscriber.audioDataReceived(self.audioSequenceHeader, 0)
+
+        if self.cache is None:
+            return
+
+        base = self.subscribers[subscriber]['timestamp']
+
+        for datatype, data, timestamp in self.cache.frames:
+            timestamp = max(0, timestamp - base)
+
+            if datatype == message.VIDEO_DATA:
+                subscriber.videoDataReceived(data, timestamp)
+            else:
+                subscriber.audioDataReceived(data, timestamp)
+
     def removeSubscriber(self, subscriber):
         """
         Removes the subscriber from this publisher.
@@ -823,13 +1306,20 @@ class StreamPublisher(object):
         """
         timestamp = self._updateTimestamp(timestamp)
 
+        if flv.is_video_sequence_header(data):
+            self.videoSequenceHeader = data
+        elif self.cache is not None:
+            self.cache.add(message.VIDEO_DATA, data, timestamp)
+
         to_remove = []
+        # the payload is only chunked once per frame size/channel id
+        chunks = {}
 
         for subscriber, context in self.subscribers.iteritems():
             relTimestamp = max(0, timestamp - context['timestamp'])
 
             try:
-                subscriber.videoDataReceived(data, relTimestamp)
+                subscriber.videoDataReceived(data, relTimestamp, chunks)
             except:
                 log.err()
                 to_remove.append(subscriber)
@@ -847,11 +1337,19 @@ class StreamPublisher(object):
         @param timestamp: The timestamp at which this data was received.
         """
         timestamp = self._updateTimestamp(timestamp)
+
+        if flv.is_audio_sequence_header(data):
+            self.audioSequenceHeader = data
+        elif self.cache is not None:
+            self.cache.add(message.AUDIO_DATA, data, timestamp)
+
         to_remove = []
+        chunks = {}
 
         for subscriber, context in self.subscribers.iteritems():
             try:
-                subscriber.audioDataReceived(data, timestamp - context['timestamp'])
+                subscriber.audioDataReceived(data,
+                    timestamp - context['timestamp'], chunks)
             except:
                 log.err()
                 to_remove.append(subscriber)
@@ -880,6 +1378,10 @@ class StreamPublisher(object):
             a.unpublish()
 
         self.subscribers = {}
+        self.videoSequenceHeader = self.audioSequenceHeader = None
+
+        if self.cache is not None:
+            self.cache.clear()
 
 
 class Application(object):
@@ -890,12 +1392,25 @@ class Application(object):
     implements(IApplication)
 
     client = Client
+    #: The maximum number of bytes cached per published stream, see
+    #: L{GOPCache}. Set to C{0} to disable caching.
+    gopCacheSize = 4 * 1024 * 1024
+    #: The maximum number of bytes cached across all the published streams of
+    #: this application. C{0} means no limit.
+    gopCacheTotalSize = 64 * 1024 * 1024
+    #: The maximum number of bytes per second sent to each client, see
+    #: L{buildShaper}. C{0} means no limit.
+    clientBandwidth = 0
+    #: The number of bytes that may be sent to a client in one go after it
+    #: has been idle. C{0} allows one second of L{clientBandwidth}.
+    clientBurst = 0
 
     def __init__(self):
         self.clients = {}
         self.streams = {}
         self._streamingClients = {}
         self._pendingPublishedCallbacks = {}
+        self.gopCacheLimit = CacheLimit(self.gopCacheTotalSize)
 
 
     def startup(self):
@@ -928,7 +1443,7 @@ class Application(object):
         """
         self._disconnect(client)
 
-        client.nc.protocol.transport.loseConnection()
+        client.nc.protocol.loseConnection()
 
 
     def _disconnect(self, client):
@@ -941,7 +1456,7 @@ class Application(object):
             name = publisher.stream.name
 
             try:
-                self.unpublishStream(publisher, name)
+                self.unpublishStream(name, publisher.stream)
             except exc.BadNameError:
                 pass
             except:
@@ -1053,7 +1568,8 @@ class Application(object):
 
         if stream is None:
             # brand new publish
-            stream = self.streams[name] = StreamPublisher(requestor, client)
+            stream = self.streams[name] = StreamPublisher(requestor, client,
+                self.buildGOPCache())
             self._streamingClients[client] = stream
 
         if client.id != stream.client.id:
@@ -1064,6 +1580,30 @@ class Application(object):
         return stream
 
 
+    def buildShaper(self, client):
+        """
+        Returns the L{shaping.TokenBucket} that caps the rate at which data is
+        sent to a newly accepted C{client}, or C{None}. See
+        L{Client.setBandwidthLimit} to change it per client.
+        """
+        if not self.clientBandwidth:
+            return None
+
+        return shaping.TokenBucket(self.clientBandwidth,
+            self.clientBurst or None)
+
+
+    def buildGOPCache(self):
+        """
+        Returns the L{GOPCache} for a newly published stream, or C{None} if
+        caching is disabled.
+        """
+        if not self.gopCacheSize:
+            return None
+
+        return GOPCache(self.gopCacheSize, self.gopCacheLimit)
+
+
     def unpublishStream(self, name, stream):
         try:
             source = self.streams[name]
@@ -1165,10 +1705,41 @@ class ServerFactory(protocol.ServerFactory):
     @ivar _pendingApplications: A collection of applications that are pending
         activation.
     @type _pendingApplications: C{dict} of C{name} -> L{IApplication}
+    @cvar scheduler: Builds the scheduler that decides the order in which each
+        connection encodes its messages. C{None} (the default) encodes the
+        active channels in turn. Set to L{codec.PriorityScheduler} to favour
+        control and RPC messages over bulk data. Audio/video is written by
+        L{codec.StreamingChannel}s and is not scheduled either way.
+    @cvar frameSizePolicy: Builds the policy that picks the outbound frame
+        size of a connection, see L{codec.FrameSizePolicy}. C{None} keeps the
+        RTMP default of L{codec.FRAME_SIZE}.
+    @cvar egressBitrate: The bitrate (bits per second) that a connection is
+        expected to be sent data at, used to pick its frame size when it is
+        accepted. Unrelated to L{downstreamBandwidth}, which is the
+        acknowledgement window (in bytes) sent to the peer.
+    @cvar frameSizeInterval: The number of seconds between measurements of
+        the egress bitrate of each connection, the frame size is picked again
+        from it. C{0} keeps the frame size picked from L{egressBitrate}.
+    @cvar flowControl: Whether a connection stops sending once the peer has
+        not acknowledged L{downstreamBandwidth} bytes a few times over, see
+        L{rtmp.BaseStreamer.setSendWindow}. Off by default, a peer that does
+        not send acknowledgements would never be sent anything again.
+    @cvar pingInterval: The number of seconds between the pings sent to each
+        connection to measure its round trip time. C{0} (the default) disables
+        pinging.
+    @cvar pingTimeout: When pinging, connections that do not answer a ping
+        within this many seconds are dropped. C{0} disables the timeout.
     """
 
     protocol = ServerProtocol
     handshake = handshake.ServerNegotiator
+    scheduler = None
+    frameSizePolicy = codec.FixedFrameSize
+    egressBitrate = 2500000
+    frameSizeInterval = 5
+    flowControl = False
+    pingInterval = 0
+    pingTimeout = 30
 
     upstreamBandwidth = 2500000L
     downstreamBandwidth = 2500000L
@@ -1190,6 +1761,37 @@ class ServerFactory(protocol.ServerFactory):
         return self.handshake(observer, output)
 
 
+    def buildScheduler(self):
+        """
+        Returns a scheduler for a connection's encoder or C{None}.
+        """
+        if self.scheduler is None:
+            return None
+
+        return self.scheduler()
+
+
+    def buildFrameSizePolicy(self):
+        """
+        Returns the frame size policy for a newly accepted connection or
+        C{None} to leave its frame size alone.
+        """
+        if self.frameSizePolicy is None:
+            return None
+
+        return self.frameSizePolicy()
+
+
+    def buildPinger(self, protocol):
+        """
+        Returns a L{ping.Pinger} for C{protocol} or C{None}.
+        """
+        if not self.pingInterval:
+            return None
+
+        return ping.Pinger(protocol, self.pingInterval, self.pingTimeout)
+
+
     def getApplicationWithDefault(self, params, *args):
         """
         Checks if an application exists within the static table. If an
@@ -0,0 +1,181 @@
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests for L{rtmpy.protocol.rtmp.buffer}.
+"""
+
+import unittest
+
+from rtmpy.protocol.rtmp import buffer
+
+
+class ByteBufferTestCase(unittest.TestCase):
+    """
+    Tests for L{buffer.ByteBuffer}
+    """
+
+    def setUp(self):
+        self.buffer = buffer.ByteBuffer(compactThreshold=4)
+
+    def test_create(self):
+        self.assertEqual(self.buffer.getvalue(), '')
+        self.assertEqual(self.buffer.tell(), 0)
+        self.assertTrue(self.buffer.at_eof())
+
+    def test_append(self):
+        self.buffer.append('foo')
+        self.buffer.append(bytearray('bar'))
+
+        self.assertEqual(self.buffer.getvalue(), 'foobar')
+        self.assertEqual(self.buffer.tell(), 0)
+        self.assertEqual(self.buffer.remaining(), 6)
+
+    def test_read_view(self):
+        self.buffer.append('foobar')
+
+        view = self.buffer.read(3)
+
+        self.assertTrue(isinstance(view, memoryview))
+        self.assertEqual(view.tobytes(), 'foo')
+        self.assertEqual(self.buffer.tell(), 3)
+        self.assertEqual(self.buffer.read().tobytes(), 'bar')
+        self.assertTrue(self.buffer.at_eof())
+
+    def test_underflow(self):
+        self.buffer.append('fo')
+
+        self.assertRaises(IOError, self.buffer.read, 3)
+        self.assertRaises(IOError, self.buffer.read_ulong)
+        self.assertEqual(self.buffer.tell(), 0)
+
+    def test_seek(self):
+        self.buffer.append('foobar')
+        self.buffer.seek(4)
+
+        self.assertEqual(self.buffer.peek(2), 'ar')
+
+        self.buffer.seek(-3, 1)
+        self.assertEqual(self.buffer.tell(), 1)
+
+        self.assertRaises(IOError, self.buffer.seek, 7)
+
+    def test_consume(self):
+        self.buffer.append('abc')
+        self.buffer.read(2)
+        self.buffer.consume()
+
+        # below the threshold, the dead prefix is kept
+        self.assertEqual(len(self.buffer._data), 3)
+        self.assertEqual(self.buffer.getvalue(), 'c')
+        self.assertEqual(self.buffer.tell(), 0)
+
+        self.buffer.append('defg')
+        self.buffer.read(3)
+        self.buffer.consume()
+
+        self.assertEqual(self.buffer._data, bytearray('fg'))
+        self.assertEqual(self.buffer.getvalue(), 'fg')
+        self.assertEqual(self.buffer.tell(), 0)
+
+    def test_views_survive_growth(self):
+        self.buffer.append('spam')
+
+        view = self.buffer.read(2)
+
+        # the storage cannot be resized while the view is alive
+        self.buffer.append('eggs' * 10)
+
+        self.assertEqual(view.tobytes(), 'sp')
+        self.assertEqual(self.buffer.getvalue(), 'spam' + 'eggs' * 10)
+        self.assertEqual(self.buffer.read(2).tobytes(), 'am')
+
+    def test_integers(self):
+        self.buffer.append('\x01\x00\x02\x00\x00\x03\x04\x00\x00\x00\x05')
+
+        self.assertEqual(self.buffer.read_uchar(), 1)
+        self.assertEqual(self.buffer.read_ushort(), 2)
+        self.assertEqual(self.buffer.read_24bit_uint(), 3)
+
+        self.buffer.endian = '<'
+        self.assertEqual(self.buffer.read_ulong(), 4)
+        self.buffer.endian = '!'
+
+        self.assertEqual(self.buffer.read_uchar(), 5)
+
+    def test_truncate(self):
+        self.buffer.append('foobar')
+        self.buffer.read(2)
+        self.buffer.truncate()
+
+        self.assertEqual(self.buffer.getvalue(), '')
+        self.assertEqual(self.buffer.tell(), 0)
+
+
+class SequenceBufferTestCase(unittest.TestCase):
+    """
+    Tests for L{buffer.SequenceBuffer}
+    """
+
+    def setUp(self):
+        self.buffer = buffer.SequenceBuffer()
+
+    def test_write(self):
+        foo = 'foo' * 10
+
+        self.buffer.write(foo)
+        self.buffer.write('bar')
+
+        self.assertEqual(len(self.buffer), 33)
+        self.assertEqual(self.buffer.getvalue(), foo + 'bar')
+        self.assertTrue(self.buffer.chunks[0] is foo)
+        self.assertEqual(len(self.buffer.chunks), 2)
+
+    def test_consume(self):
+        self.buffer.write('foo')
+        chunks = self.buffer.chunks
+        self.buffer.consume()
+
+        self.assertEqual(len(self.buffer), 0)
+        self.assertEqual(self.buffer.chunks, [])
+        self.assertEqual(chunks, ['foo'])
+
+        self.buffer.write('bar')
+        self.assertEqual(self.buffer.chunks, ['bar'])
+
+    def test_truncate(self):
+        self.buffer.write('foo')
+        self.buffer.truncate()
+
+        self.assertEqual(self.buffer.getvalue(), '')
+        self.assertRaises(IOError, self.buffer.truncate, 1)
+
+
+
+class ToBytesTestCase(unittest.TestCase):
+    """
+    Tests for L{buffer.tobytes}
+    """
+
+    def test_str(self):
+        s = 'foo'
+
+        self.assertTrue(buffer.tobytes(s) is s)
+
+    def test_view(self):
+        self.assertEqual(buffer.tobytes(memoryview(bytearray('foo'))), 'foo')
+
+    def test_bytearray(self):
+        self.assertEqual(buffer.tobytes(bytearray('foo')), 'foo')
@@ -0,0 +1,210 @@
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests for L{rtmpy.protocol.rtmp.cooperator}.
+"""
+
+from twisted.trial import unittest
+from twisted.internet import task
+
+from rtmpy.protocol.rtmp import cooperator
+
+
+class Work(object):
+    """
+    An iterator that records each step in C{log} and advances the clock by
+    C{cost} seconds per step.
+    """
+
+    def __init__(self, test, name, steps, cost=0.25):
+        self.test = test
+        self.name = name
+        self.steps = steps
+        self.cost = cost
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if not self.steps:
+            raise StopIteration
+
+        self.steps -= 1
+        self.test.now += self.cost
+        self.test.log.append(self.name)
+
+
+
+class CooperatorTestCase(unittest.TestCase):
+    """
+    Tests for L{cooperator.Cooperator}
+    """
+
+    def setUp(self):
+        self.now = 0.0
+        self.log = []
+
+        self.reactor = task.Clock()
+        self.cooperator = cooperator.Cooperator(self.reactor)
+        self.cooperator.clock = lambda: self.now
+        self.cooperator.timeSlice = 0.5
+        self.cooperator.decodeBudget = 10
+        self.cooperator.encodeBudget = 10
+
+    def test_run(self):
+        work = Work(self, 'a', 3)
+        results = []
+
+        t = self.cooperator.encode(work)
+        t.whenDone().addCallback(results.append)
+
+        self.assertEqual(self.log, [])
+
+        self.reactor.advance(0)
+
+        self.assertEqual(self.log, ['a', 'a', 'a'])
+        self.assertEqual(results, [work])
+        self.assertTrue(t.done)
+        self.assertEqual(self.reactor.getDelayedCalls(), [])
+
+    def test_time_slice(self):
+        self.cooperator.encode(Work(self, 'a', 3))
+        self.cooperator.encode(Work(self, 'b', 3))
+
+        self.reactor.advance(0)
+
+        self.assertEqual(self.log, ['a', 'a', 'b', 'b', 'a', 'b'])
+
+    def test_budget(self):
+        """
+        Once the budget has been spent, the rest of the queue waits for the
+        next reactor turn.
+        """
+        self.cooperator.decodeBudget = 1.0
+
+        self.cooperator.decode(Work(self, 'a', 3))
+        self.cooperator.decode(Work(self, 'b', 3))
+        self.cooperator.decode(Work(self, 'c', 3))
+
+        call, = self.reactor.getDelayedCalls()
+        self.reactor.calls.remove(call)
+        call.func()
+
+        self.assertEqual(self.log, ['a', 'a', 'b', 'b'])
+        self.assertEqual([t.iterator.name for t in
+            self.cooperator.queues[cooperator.DECODE]], ['c', 'a', 'b'])
+        self.assertEqual(len(self.reactor.getDelayedCalls()), 1)
+
+        self.reactor.advance(0)
+
+        self.assertEqual(self.log[4:], ['c', 'c', 'a', 'b', 'c'])
+
+    def test_decode_first(self):
+        self.cooperator.encode(Work(self, 'e', 1))
+        self.cooperator.decode(Work(self, 'd', 1))
+
+        self.reactor.advance(0)
+
+        self.assertEqual(self.log, ['d', 'e'])
+
+    def test_pause(self):
+        t = self.cooperator.encode(Work(self, 'a', 3))
+        t.pause()
+
+        self.reactor.advance(0)
+
+        self.assertEqual(self.log, [])
+
+        t.resume()
+        self.reactor.advance(0)
+
+        self.assertEqual(self.log, ['a', 'a', 'a'])
+
+    def test_wake(self):
+        """
+        An exhausted task goes idle and runs again when it is woken.
+        """
+        work = Work(self, 'a', 1)
+        results = []
+
+        t = self.cooperator.encode(work, results.append)
+        self.reactor.advance(0)
+
+        self.assertTrue(t.done)
+        self.assertEqual(results, [work])
+        self.assertEqual(self.cooperator.queues[cooperator.ENCODE], {})
+
+        work.steps = 2
+        t.wake()
+
+        self.assertFalse(t.done)
+        self.reactor.advance(0)
+
+        self.assertEqual(self.log, ['a', 'a', 'a'])
+        self.assertEqual(results, [work, work])
+
+    def test_stop(self):
+        work = Work(self, 'a', 3)
+
+        t = self.cooperator.encode(work)
+        t.stop()
+
+        self.reactor.advance(0)
+
+        self.assertEqual(self.log, [])
+        self.assertEqual(self.cooperator.queues[cooperator.ENCODE], {})
+
+        t.finish(work)
+        t.wake()
+
+        self.assertEqual(self.cooperator.queues[cooperator.ENCODE], {})
+
+    def test_failure(self):
+        class Broken(object):
+            def next(self):
+                raise RuntimeError('boom')
+
+        d = self.cooperator.encode(Broken()).whenDone()
+
+        self.reactor.advance(0)
+
+        return self.assertFailure(d, RuntimeError)
+
+    def test_delays(self):
+        self.assertEqual(self.cooperator.getDelay(cooperator.ENCODE, 50),
+            None)
+
+        self.cooperator.encode(Work(self, 'a', 1))
+        self.now = 1.0
+        self.cooperator.encode(Work(self, 'b', 1))
+        self.now = 2.0
+
+        self.reactor.advance(0)
+
+        self.assertEqual(list(self.cooperator.delays[cooperator.ENCODE]),
+            [2.0, 1.25])
+        self.assertEqual(self.cooperator.getDelay(cooperator.ENCODE, 50), 2.0)
+
+        stats = self.cooperator.getStats()
+
+        self.assertEqual(stats['encode'],
+            {'ready': 0, 'p50': 2.0, 'p99': 2.0})
+        self.assertEqual(stats['decode'],
+            {'ready': 0, 'p50': None, 'p99': None})
+
+    def test_shared(self):
+        self.assertIdentical(cooperator.getCooperator(),
+            cooperator.getCooperator())
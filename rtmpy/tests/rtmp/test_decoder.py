@@ -21,7 +21,8 @@ from twisted.trial import unittest
 
 from pyamf.util import BufferedByteStream
 
-from rtmpy.protocol.rtmp import codec, header
+from rtmpy import message
+from rtmpy.protocol.rtmp import codec, header, buffer
 
 
 class MockChannel(object):
@@ -63,6 +64,10 @@ class MockFrameReader(object):
     def readFrame(cls, self):
         return self.events.pop(0)
 
+    @classmethod
+    def abort(cls, self, channelId):
+        self.aborted = channelId
+
 
 class MockChannelDemuxer(MockFrameReader):
     """
@@ -85,6 +90,7 @@ class DispatchTester(object):
     def __init__(self, test):
         self.test = test
         self.messages = []
+        self.batches = []
         self.intervals = []
 
     def dispatchMessage(self, *args):
@@ -95,6 +101,12 @@ class DispatchTester(object):
 
         self.messages.append(args)
 
+    def dispatchMessages(self, messages):
+        self.batches.append(list(messages))
+
+        for args in messages:
+            self.dispatchMessage(*args)
+
     def bytesInterval(self, bytes):
         self.intervals.append(bytes)
 
@@ -155,17 +167,41 @@ class FrameReaderTestCase(unittest.TestCase):
 
     def test_eof(self):
         self.assertTrue(self.stream.at_eof())
-        self.assertRaises(IOError, self.reader.readFrame)
+        self.assertEqual(self.reader.readFrame(), None)
+        self.assertEqual(self.reader.needed, 1)
 
-    def test_ioerror_seek(self):
+    def test_partial_header(self):
         self.stream.append('foo')
         self.stream.seek(1)
 
         self.assertEqual(self.stream.tell(), 1)
-        self.assertRaises(IOError, self.reader.readFrame)
+        self.assertEqual(self.reader.readFrame(), None)
 
+        # 'o' is a 1 byte channel id followed by a 7 byte header
+        self.assertEqual(self.reader.needed, 6)
         self.assertEqual(self.stream.tell(), 1)
 
+    def test_partial_body(self):
+        full = header.Header(3, datatype=2, bodyLength=5, streamId=1,
+            timestamp=10)
+
+        header.encode(self.stream, full)
+        self.stream.write('abc')
+        self.stream.seek(0)
+
+        self.assertEqual(self.reader.readFrame(), None)
+        self.assertEqual(self.reader.needed, 2)
+        self.assertEqual(self.stream.tell(), 12)
+
+        self.stream.append('de')
+
+        bytes, complete, meta = self.reader.readFrame()
+
+        self.assertEqual(bytes, 'abcde')
+        self.assertTrue(complete)
+        self.assertEqual(self.reader.needed, 0)
+        self.assertEqual(self.reader.bytes, 17)
+
     def test_simple(self):
         """
         Do a sanity check for a simple 4 frame 1 channel rtmp stream.
@@ -218,7 +254,7 @@ class FrameReaderTestCase(unittest.TestCase):
         self.assertTrue(complete)
         check_meta(meta, 10)
 
-        self.assertRaises(IOError, self.reader.readFrame)
+        self.assertEqual(self.reader.readFrame(), None)
 
 
     def test_reassign(self):
@@ -252,6 +288,87 @@ class FrameReaderTestCase(unittest.TestCase):
         self.assertTrue(complete)
         self.assertEqual(meta.timestamp, 100)
 
+    def test_header_reuse(self):
+        """
+        The channel header is updated in place, continuation headers do not
+        create a header at all.
+        """
+        full = header.Header(3, datatype=2, bodyLength=300, streamId=1,
+            timestamp=10)
+
+        header.encode(self.stream, full)
+        self.stream.write('a' * 128)
+        header.encode(self.stream, full, full)
+        self.stream.write('b' * 128)
+        header.encode(self.stream, full, full)
+        self.stream.write('c' * 44)
+        header.encode(self.stream, header.Header(3, timestamp=20,
+            bodyLength=10, datatype=2, streamId=1), full)
+        self.stream.write('d' * 10)
+
+        self.stream.seek(0)
+
+        _, _, first = self.reader.readFrame()
+
+        decode = header.decode
+        self.patch(header, 'decode', lambda stream: self.fail('decoded'))
+
+        self.assertIdentical(self.reader.readFrame()[2], first)
+
+        bytes, complete, meta = self.reader.readFrame()
+
+        self.assertIdentical(meta, first)
+        self.assertTrue(complete)
+        self.assertEqual(meta.timestamp, 10)
+
+        self.patch(header, 'decode', decode)
+        self.assertEqual(self.reader.readFrame(), ('d' * 10, True, first))
+        self.assertEqual(first.bodyLength, 10)
+        self.assertEqual(first.timestamp, 30)
+
+    def _continueNewMessage(self, timestamp):
+        """
+        Reads a complete message with a full header followed by a new message
+        on the same channel that only has a continuation header.
+        """
+        full = header.Header(3, datatype=2, bodyLength=10, streamId=1,
+            timestamp=timestamp)
+
+        header.encode(self.stream, full)
+        self.stream.write('a' * 10)
+        header.encode(self.stream, full, full)
+        self.stream.write('b' * 10)
+
+        self.stream.seek(0)
+
+        bytes, complete, meta = self.reader.readFrame()
+
+        self.assertEqual(bytes, 'a' * 10)
+        self.assertTrue(complete)
+        self.assertTrue(meta.full)
+        self.assertEqual(meta.timestamp, timestamp)
+
+        bytes, complete, meta = self.reader.readFrame()
+
+        self.assertEqual(bytes, 'b' * 10)
+        self.assertTrue(complete)
+        self.assertFalse(meta.full)
+        self.assertFalse(meta.continuation)
+        self.assertEqual(meta.timestamp, timestamp * 2)
+
+    def test_continue_new_message(self):
+        """
+        A continuation header that starts a new message resets the state of
+        the channel header, like any other header.
+        """
+        self._continueNewMessage(100)
+
+    def test_continue_new_message_extended(self):
+        """
+        As L{test_continue_new_message} but with an extended timestamp.
+        """
+        self._continueNewMessage(0x1000000)
+
 
 class DeMuxerTestCase(unittest.TestCase):
     """
@@ -279,14 +396,126 @@ class DeMuxerTestCase(unittest.TestCase):
             ('foo', False, meta), ('bar', False, meta), ('baz', True, meta))
 
         self.assertEqual(self.demuxer.readFrame(), (None, None))
-        self.assertEqual(self.demuxer.bucket, {1: 'foo'})
+        self.assertEqual(self.demuxer.bucket, {1: ['foo']})
 
         self.assertEqual(self.demuxer.readFrame(), (None, None))
-        self.assertEqual(self.demuxer.bucket, {1: 'foobar'})
+        self.assertEqual(self.demuxer.bucket, {1: ['foo', 'bar']})
 
         self.assertEqual(self.demuxer.readFrame(), ('foobarbaz', meta))
         self.assertEqual(self.demuxer.bucket, {})
 
+    def test_need_data(self):
+        self.add_events(None)
+
+        self.assertEqual(self.demuxer.readFrame(), None)
+        self.assertEqual(self.demuxer.bucket, {})
+
+    def test_single_frame(self):
+        meta = ChannelMeta(channelId=1)
+        data = 'foo'
+
+        self.add_events((data, True, meta))
+
+        ret, _ = self.demuxer.readFrame()
+
+        self.assertIdentical(ret, data)
+
+    def test_abort(self):
+        meta = ChannelMeta(channelId=1)
+
+        self.add_events(('foo', False, meta))
+
+        self.demuxer.readFrame()
+        self.demuxer.abort(1)
+
+        self.assertEqual(self.demuxer.aborted, 1)
+        self.assertEqual(self.demuxer.bucket, {})
+        self.assertEqual(self.demuxer.bufferedBytes, 0)
+
+
+
+class DeMuxerLimitsTestCase(DeMuxerTestCase):
+    """
+    Tests for L{codec.ChannelDemuxer.setLimits}
+    """
+
+    def test_buffered_bytes(self):
+        meta = ChannelMeta(channelId=1, datatype=message.VIDEO_DATA,
+            bodyLength=9)
+
+        self.add_events(
+            ('foo', False, meta), ('bar', False, meta), ('baz', True, meta))
+
+        self.demuxer.readFrame()
+        self.demuxer.readFrame()
+
+        self.assertEqual(self.demuxer.bufferedBytes, 6)
+        self.assertEqual(self.demuxer.openChannels, 1)
+
+        self.demuxer.readFrame()
+
+        self.assertEqual(self.demuxer.bufferedBytes, 0)
+        self.assertEqual(self.demuxer.openChannels, 0)
+
+    def test_max_buffered_bytes(self):
+        self.demuxer.setLimits(maxBufferedBytes=5)
+
+        self.add_events(('foo', False, ChannelMeta(channelId=1)),
+            ('bar', False, ChannelMeta(channelId=2)))
+
+        self.demuxer.readFrame()
+
+        self.assertRaises(codec.MemoryLimitError, self.demuxer.readFrame)
+
+    def test_max_open_channels(self):
+        self.demuxer.setLimits(maxOpenChannels=1)
+
+        self.add_events(('foo', False, ChannelMeta(channelId=1)),
+            ('bar', False, ChannelMeta(channelId=1)),
+            ('baz', False, ChannelMeta(channelId=2)))
+
+        self.demuxer.readFrame()
+        self.demuxer.readFrame()
+
+        self.assertRaises(codec.MemoryLimitError, self.demuxer.readFrame)
+
+    def test_message_size(self):
+        self.demuxer.setLimits(maxMessageSizes={message.AUDIO_DATA: 5,
+            None: 100})
+
+        audio = ChannelMeta(channelId=1, datatype=message.AUDIO_DATA,
+            bodyLength=6)
+        video = ChannelMeta(channelId=2, datatype=message.VIDEO_DATA,
+            bodyLength=6)
+
+        self.add_events(('foo', False, audio), ('abc', False, video),
+            ('bar', True, audio), ('def', True, video))
+
+        self.assertEqual(self.demuxer.readFrame(), (None, None))
+        self.assertEqual(self.demuxer.discarding, set([1]))
+        self.assertEqual(self.demuxer.readFrame(), (None, None))
+
+        self.assertEqual(self.demuxer.readFrame(), (None, None))
+        self.assertEqual(self.demuxer.discarding, set())
+        self.assertEqual(self.demuxer.discardedMessages, 1)
+
+        self.assertEqual(self.demuxer.readFrame(), ('abcdef', video))
+        self.assertEqual(self.demuxer.bufferedBytes, 0)
+
+    def test_single_frame_message_size(self):
+        self.demuxer.setLimits(maxMessageSizes={None: 2})
+
+        meta = ChannelMeta(channelId=1, datatype=message.INVOKE, bodyLength=3)
+
+        self.add_events(('foo', True, meta), ('foo', True, meta))
+
+        self.assertEqual(self.demuxer.readFrame(), (None, None))
+        self.assertEqual(self.demuxer.discarding, set())
+
+        self.demuxer.setLimits()
+
+        self.assertEqual(self.demuxer.readFrame(), ('foo', meta))
+
 
         
 class DecoderTestCase(unittest.TestCase):
@@ -343,6 +572,12 @@ class DecoderTestCase(unittest.TestCase):
 
         self.assertEqual(self.decoder.next(), None)
 
+    def test_need_data(self):
+        self.add_events(None)
+        self.failOnDispatch = True
+
+        self.assertRaises(StopIteration, self.decoder.next)
+
     def test_simple(self):
         meta = ChannelMeta(streamId=2, timestamp=3, datatype='bar')
 
@@ -395,3 +630,152 @@ class BytesIntervalTestCase(unittest.TestCase):
         self.assertEqual(self.decoder.bytes, 12)
         self.assertEqual(self.dispatcher.intervals, [12])
 
+
+
+class DrainTestCase(unittest.TestCase):
+    """
+    Tests for L{codec.Decoder.drain}
+    """
+
+    def setUp(self):
+        self.dispatcher = DispatchTester(self)
+        self.stream_factory = MockStreamFactory(self)
+        self.decoder = codec.Decoder(self.dispatcher, self.stream_factory,
+            bytesBudget=1024)
+
+        self.full = header.Header(3, datatype=message.INVOKE, bodyLength=3,
+            streamId=1, timestamp=10)
+
+    def getStream(self, streamId):
+        return MockStream()
+
+    def send(self, h, body, previous=None):
+        s = BufferedByteStream()
+
+        header.encode(s, h, previous)
+        s.write(body)
+
+        self.decoder.send(s.getvalue())
+
+    def test_batch(self):
+        self.send(self.full, 'foo')
+        self.send(self.full, 'bar', self.full)
+        self.send(self.full, 'baz', self.full)
+
+        self.assertEqual(self.decoder.next(), None)
+
+        self.assertEqual(len(self.dispatcher.batches), 1)
+        self.assertEqual([m[3] for m in self.dispatcher.messages],
+            ['foo', 'bar', 'baz'])
+        self.assertEqual(self.decoder.stream.getvalue(), '')
+
+        self.assertRaises(StopIteration, self.decoder.next)
+        self.assertEqual(len(self.dispatcher.batches), 1)
+
+    def test_bytes_budget(self):
+        self.decoder.bytesBudget = 18
+
+        for i in xrange(3):
+            self.send(self.full, 'foo', self.full if i else None)
+
+        # 15 + 4 + 4 bytes, the budget is exceeded by the second frame
+        self.assertEqual(self.decoder.next(), None)
+        self.assertEqual(self.dispatcher.batches, [self.dispatcher.messages])
+        self.assertEqual(len(self.dispatcher.messages), 2)
+
+        self.assertEqual(self.decoder.next(), None)
+        self.assertEqual(len(self.dispatcher.batches), 2)
+        self.assertEqual(len(self.dispatcher.messages), 3)
+
+    def test_time_budget(self):
+        ticks = [0, 0.5, 1.5]
+
+        self.decoder.bytesBudget = 0
+        self.decoder.timeBudget = 1
+        self.decoder.clock = lambda: ticks.pop(0)
+
+        for i in xrange(3):
+            self.send(self.full, 'foo', self.full if i else None)
+
+        self.assertEqual(self.decoder.next(), None)
+        self.assertEqual(len(self.dispatcher.messages), 2)
+
+    def test_frame_size_flush(self):
+        """
+        A frame size message must be dispatched before the next frame is
+        read, it changes how the rest of the stream is decoded.
+        """
+        self.dispatcher.dispatchMessage = lambda *args: (
+            self.decoder.setFrameSize(256))
+
+        h = header.Header(2, datatype=message.FRAME_SIZE, bodyLength=4,
+            streamId=0, timestamp=0)
+        self.send(h, '\x00\x00\x01\x00')
+
+        big = header.Header(3, datatype=message.INVOKE, bodyLength=200,
+            streamId=1, timestamp=0)
+        self.send(big, 'a' * 200)
+
+        self.assertEqual(self.decoder.next(), None)
+        self.assertEqual([len(b) for b in self.dispatcher.batches], [1, 1])
+
+
+
+class ViewFrameReaderTestCase(unittest.TestCase):
+    """
+    Tests for L{codec.FrameReader} when reading from a L{buffer.ByteBuffer}.
+    """
+
+    def setUp(self):
+        self.reader = codec.FrameReader(stream=buffer.ByteBuffer())
+
+    def encode(self, h, body, previous=None):
+        s = BufferedByteStream()
+
+        header.encode(s, h, previous)
+        s.write(body)
+
+        return s.getvalue()
+
+    def test_simple(self):
+        full = header.Header(3, datatype=2, bodyLength=5, streamId=1,
+            timestamp=10)
+
+        self.reader.send(self.encode(full, 'hello'))
+
+        bytes, complete, meta = self.reader.readFrame()
+
+        self.assertTrue(isinstance(bytes, memoryview))
+        self.assertEqual(bytes.tobytes(), 'hello')
+        self.assertTrue(complete)
+        self.assertEqual(meta.streamId, 1)
+        self.assertEqual(meta.timestamp, 10)
+
+    def test_partial(self):
+        full = header.Header(3, datatype=2, bodyLength=5, streamId=1,
+            timestamp=10)
+        data = self.encode(full, 'hello')
+
+        self.reader.send(data[:-2])
+        self.assertEqual(self.reader.readFrame(), None)
+        self.assertEqual(self.reader.needed, 2)
+
+        self.reader.send(data[-2:])
+
+        bytes, complete, meta = self.reader.readFrame()
+
+        self.assertEqual(bytes.tobytes(), 'hello')
+
+    def test_demux(self):
+        demuxer = codec.ChannelDemuxer(stream=buffer.ByteBuffer())
+        full = header.Header(3, datatype=2, bodyLength=130, streamId=1,
+            timestamp=10)
+
+        demuxer.send(self.encode(full, 'a' * 128))
+        demuxer.send(self.encode(full, 'b' * 2, full))
+
+        self.assertEqual(demuxer.readFrame(), (None, None))
+
+        data, meta = demuxer.readFrame()
+
+        self.assertEqual(data, 'a' * 128 + 'b' * 2)
@@ -21,8 +21,9 @@ import unittest
 
 from pyamf.util import BufferedByteStream
 
-from rtmpy.protocol.rtmp import codec
+from rtmpy.protocol.rtmp import codec, buffer
 from rtmpy import message
+from rtmpy.tests.util import StringTransport
 
 
 class BaseTestCase(unittest.TestCase):
@@ -51,12 +52,54 @@ class EncoderTestCase(BaseTestCase):
 
         self.encoder.send('bar', 12, 2, 3)
 
-        self.assertEqual(self.encoder.pending, [('bar', 12, 2, 3, None)])
+        self.assertEqual(list(self.encoder.pending),
+            [('bar', 12, 2, 3, None, None)])
 
         self.encoder.channelsInUse -= 1
         self.encoder.next()
 
-        self.assertEqual(self.encoder.pending, [])
+        self.assertEqual(list(self.encoder.pending), [])
+
+    def test_pending_order(self):
+        """
+        Pending messages are sent in the order they were queued, even if a
+        channel becomes available in the meantime.
+        """
+        self.encoder.channelsInUse = codec.MAX_CHANNELS
+
+        self.encoder.send('foo', 12, 2, 3)
+
+        self.encoder.channelsInUse -= 1
+        self.encoder.send('bar', 12, 2, 3)
+
+        self.assertEqual([m[0] for m in self.encoder.pending], ['foo', 'bar'])
+
+        self.encoder.next()
+
+        self.assertEqual([m[0] for m in self.encoder.pending], ['bar'])
+
+    def test_exhausted(self):
+        """
+        Messages stay queued while no channel can be acquired.
+        """
+        self.encoder.channelsInUse = codec.MAX_CHANNELS
+
+        for i in xrange(3):
+            self.encoder.send('bar', 12, 2, 3)
+
+        self.assertRaises(StopIteration, self.encoder.next)
+        self.assertEqual(len(self.encoder.pending), 3)
+
+    def test_active_order(self):
+        """
+        Active channels are encoded in the order they became active.
+        """
+        for i in xrange(20):
+            self.encoder.send('a', 12, 2, 3)
+
+        self.assertEqual(
+            [c.channelId for c in self.encoder.activeChannels],
+            range(1, 21))
 
 
 class AquireChannelTestCase(BaseTestCase):
@@ -212,6 +255,21 @@ class WritingTestCase(BaseTestCase):
 
         self.assertTrue(self.output.at_eof())
 
+    def test_reappropriate_callback(self):
+        """
+        The callback of a finished message is not fired again when its channel
+        is reused.
+        """
+        done = []
+
+        self.encoder.send('a' * 2, 8, 5, 0, lambda: done.append('a'))
+        self.encoder.next()
+
+        self.encoder.send('b' * 2, 9, 7, 0)
+        self.encoder.next()
+
+        self.assertEqual(done, ['a'])
+
 
 class TimestampTestCase(BaseTestCase):
     """
@@ -291,3 +349,317 @@ class CommandTypeTestCase(BaseTestCase):
         self.assertEqual(self.output.getvalue(), '')
         self.encoder.send('eggs', message.INVOKE, 0, 21)
         self.assertEqual(self.output.getvalue(), '')
+
+
+class PriorityScheduleTestCase(BaseTestCase):
+    """
+    Tests for encoding with a L{codec.PriorityScheduler}.
+    """
+
+    def setUp(self):
+        BaseTestCase.setUp(self)
+
+        self.scheduler = codec.PriorityScheduler(bulkSize=256)
+        self.encoder.scheduler = self.scheduler
+
+    def test_classify(self):
+        c = self.scheduler.classify
+
+        self.assertEqual(c(message.INVOKE, 10), codec.PRIORITY_COMMAND)
+        self.assertEqual(c(message.NOTIFY, 256), codec.PRIORITY_COMMAND)
+        self.assertEqual(c(message.INVOKE, 257), codec.PRIORITY_BULK)
+        self.assertEqual(c(message.AUDIO_DATA, 1000), codec.PRIORITY_AUDIO)
+        self.assertEqual(c(message.VIDEO_DATA, 10), codec.PRIORITY_VIDEO)
+        self.assertEqual(c(message.SHARED_OBJECT, 10), codec.PRIORITY_BULK)
+
+    def test_weights(self):
+        s = codec.PriorityScheduler(weights={codec.PRIORITY_BULK: 3})
+
+        self.assertEqual(s.weights[codec.PRIORITY_BULK], 3)
+        self.assertEqual(s.weights[codec.PRIORITY_AUDIO], 4)
+        self.assertEqual(codec.PriorityScheduler.weights[codec.PRIORITY_BULK],
+            1)
+
+    def test_order(self):
+        """
+        Audio is encoded before a large RPC result and gets more frames per
+        iteration.
+        """
+        self.encoder.send('r' * 1024, message.INVOKE, 0, 0)
+        self.encoder.send('a' * 1024, message.AUDIO_DATA, 1, 0)
+
+        bulk, audio = list(self.encoder.activeChannels)
+
+        self.encoder.next()
+
+        # audio is on channel id 2
+        self.assertEqual(self.output.getvalue()[0], '\x04')
+        self.assertEqual(audio.bytes, 128 * 4)
+        self.assertEqual(bulk.bytes, 128)
+
+        self.encoder.next()
+
+        self.assertFalse(audio in self.encoder.activeChannels)
+        self.assertEqual(bulk.bytes, 256)
+        self.assertEqual(self.scheduler.priorities, {bulk: codec.PRIORITY_BULK})
+
+    def test_deadline(self):
+        """
+        Messages whose deadline has passed are dropped if they have not been
+        started.
+        """
+        now = [10]
+        self.encoder.clock = lambda: now[0]
+
+        self.encoder.send('a' * 1000, message.AUDIO_DATA, 1, 0, deadline=11)
+        self.encoder.send('v' * 200, message.VIDEO_DATA, 1, 0, deadline=9)
+
+        audio, video = list(self.encoder.activeChannels)
+
+        self.encoder.next()
+
+        self.assertEqual(self.encoder.skipped, 1)
+        self.assertFalse(video in self.encoder.activeChannels)
+        self.assertEqual(self.encoder.deadlines, {audio: 11})
+
+        # started messages are finished
+        now[0] = 12
+        self.encoder.next()
+
+        self.assertEqual(self.encoder.skipped, 1)
+        self.assertEqual(self.encoder.activeChannels, {})
+        self.assertEqual(self.encoder.deadlines, {})
+        self.assertTrue(self.output.getvalue().endswith('\xc3' + 'a' * 104))
+        self.assertFalse('v' in self.output.getvalue())
+
+    def test_deadline_callback(self):
+        """
+        The callback of a dropped message is still fired.
+        """
+        self.encoder.clock = lambda: 10
+        done = []
+
+        self.encoder.send('v' * 200, message.VIDEO_DATA, 1, 0,
+            lambda: done.append(True), deadline=9)
+        self.encoder.next()
+
+        self.assertEqual(self.encoder.skipped, 1)
+        self.assertEqual(done, [True])
+
+    def test_pending_deadline(self):
+        self.encoder.channelsInUse = codec.MAX_CHANNELS
+
+        self.encoder.send('bar', 12, 2, 3, deadline=5)
+
+        self.assertEqual(list(self.encoder.pending),
+            [('bar', 12, 2, 3, None, 5)])
+
+
+
+class SequenceOutput(BufferedByteStream):
+    """
+    Records the calls to C{writeSequence}.
+    """
+
+    def __init__(self):
+        BufferedByteStream.__init__(self)
+
+        self.sequences = []
+
+    def writeSequence(self, seq):
+        self.sequences.append(list(seq))
+
+        for s in seq:
+            self.write(s)
+
+
+class ScatterTestCase(unittest.TestCase):
+    """
+    Tests for encoding to a L{buffer.SequenceBuffer}.
+    """
+
+    def setUp(self):
+        self.output = SequenceOutput()
+        self.encoder = codec.Encoder(self.output,
+            stream=buffer.SequenceBuffer())
+
+    def test_multiple_frames(self):
+        data = 'a' * 128 + 'b' * 128 + 'c' * 50
+
+        self.encoder.send(data, 10, 1, 0)
+
+        for _ in self.encoder:
+            pass
+
+        self.assertEqual(self.output.sequences, [
+            ['\x03\x00\x00\x00\x00\x01\x32\n\x01\x00\x00\x00', 'a' * 128],
+            ['\xc3', 'b' * 128],
+            ['\xc3', 'c' * 50],
+        ])
+
+        self.assertEqual(self.encoder.bytes, 12 + 128 + 1 + 128 + 1 + 50)
+        self.assertEqual(len(self.encoder.stream), 0)
+
+    def test_whole_body(self):
+        """
+        A body that fits in to a single frame is not copied.
+        """
+        data = 'foobar' * 10
+
+        self.encoder.send(data, 10, 1, 0)
+        self.encoder.next()
+
+        self.assertTrue(self.output.sequences[0][1] is data)
+
+    def test_command(self):
+        self.encoder.send('foo', message.FRAME_SIZE, 0, 10)
+
+        self.assertEqual(self.output.sequences, [
+            ['\x02\x00\x00\n\x00\x00\x03\x01\x00\x00\x00\x00', 'foo'],
+        ])
+
+    def test_same_output(self):
+        """
+        The encoded stream is the same as when encoding to a
+        L{BufferedByteStream}.
+        """
+        output = BufferedByteStream()
+        encoder = codec.Encoder(output)
+
+        for e in (encoder, self.encoder):
+            e.send('x' * 300, 9, 1, 0)
+            e.send('y' * 20, 9, 1, 40)
+
+            for _ in e:
+                pass
+
+        self.assertEqual(self.output.getvalue(), output.getvalue())
+
+
+
+class StreamingChannelTestCase(unittest.TestCase):
+    """
+    Tests for L{codec.StreamingChannel}
+    """
+
+    def setUp(self):
+        self.transport = StringTransport()
+        self.encoder = codec.Encoder(BufferedByteStream())
+
+    def buildChannel(self, streamId=1):
+        channel = codec.StreamingChannel(self.encoder, streamId,
+            self.transport)
+        channel.setType(message.VIDEO_DATA)
+
+        return channel
+
+    def test_send(self):
+        channel = self.buildChannel()
+
+        channel.sendData('a' * 300, 10)
+        channel.sendData('b' * 20, 50)
+        channel.sendData('c' * 20, 90)
+
+        self.assertEqual(self.transport.value(),
+            '\x03\x00\x00\n\x00\x01,\t\x01\x00\x00\x00' + 'a' * 128 +
+            '\xc3' + 'a' * 128 + '\xc3' + 'a' * 44 +
+            'C\x00\x00(\x00\x00\x14\t' + 'b' * 20 +
+            '\xc3' + 'c' * 20)
+        self.assertEqual(self.encoder.bytes, 363)
+
+    def test_header_types(self):
+        channel = self.buildChannel()
+
+        channel.sendData('a' * 10, 0)
+        channel.sendData('b' * 10, 40)
+        channel.sendData('c' * 10, 80)
+        channel.sendData('d' * 10, 100)
+        channel.sendData('e' * 12, 120)
+
+        channel.setType(message.AUDIO_DATA)
+        channel.sendData('f' * 12, 140)
+
+        self.assertEqual(self.transport.value(),
+            '\x03\x00\x00\x00\x00\x00\n\t\x01\x00\x00\x00' + 'a' * 10 +
+            '\x83\x00\x00(' + 'b' * 10 +
+            '\xc3' + 'c' * 10 +
+            '\x83\x00\x00\x14' + 'd' * 10 +
+            'C\x00\x00\x14\x00\x00\x0c\t' + 'e' * 12 +
+            'C\x00\x00\x14\x00\x00\x0c\x08' + 'f' * 12)
+        self.assertEqual(channel.channel.timestamp, 140)
+
+    def test_no_header_objects(self):
+        """
+        Only the first message creates a L{header.Header}.
+        """
+        channel = self.buildChannel()
+        channel.sendData('a' * 10, 0)
+
+        def Header(*args, **kwargs):
+            self.fail('Header created')
+
+        original = codec.header.Header
+        codec.header.Header = Header
+
+        try:
+            channel.sendData('b' * 20, 33)
+            channel.sendData('c' * 20, 66)
+            channel.sendData('d' * 20, 99)
+        finally:
+            codec.header.Header = original
+
+    def test_shared_chunks(self):
+        """
+        Channels with the same frame size and channel id share the chunked
+        body.
+        """
+        other = codec.Encoder(BufferedByteStream())
+
+        a = self.buildChannel()
+        b = codec.StreamingChannel(other, 2, self.transport)
+        b.setType(message.VIDEO_DATA)
+
+        chunks = {}
+        data = 'a' * 300
+
+        body = a.getChunkedBody(data, chunks)
+
+        self.assertEqual(chunks, {(128, 1): body})
+        self.assertTrue(b.getChunkedBody(data, chunks) is body)
+
+        other.setFrameSize(256)
+
+        self.assertEqual(b.getChunkedBody(data, chunks),
+            'a' * 256 + '\xc3' + 'a' * 44)
+        self.assertEqual(len(chunks), 2)
+
+    def test_single_frame(self):
+        channel = self.buildChannel()
+        data = 'a' * 128
+
+        self.assertTrue(channel.getChunkedBody(data) is data)
+
+
+
+class FrameSizePolicyTestCase(unittest.TestCase):
+    """
+    Tests for the frame size policies.
+    """
+
+    def test_fixed(self):
+        self.assertEqual(codec.FixedFrameSize().getFrameSize(2500000), 4096)
+        self.assertEqual(codec.FixedFrameSize(1000).getFrameSize(0), 896)
+
+    def test_bitrate(self):
+        policy = codec.BitrateFrameSize()
+
+        self.assertEqual(policy.getFrameSize(2500000), 12416)
+        self.assertEqual(policy.getFrameSize(64000), 256)
+        self.assertEqual(policy.getFrameSize(1000), 128)
+        self.assertEqual(policy.getFrameSize(100000000), 65536)
+
+    def test_latency(self):
+        policy = codec.LatencyFrameSize(latency=0.005)
+
+        self.assertEqual(policy.getFrameSize(2500000), 1536)
+        self.assertEqual(policy.getFrameSize(64000), 128)
@@ -269,6 +269,137 @@ class DecodeTestCase(unittest.TestCase):
         self.assertEqual(h.channelId, 65597)
 
 
+class DecodeFromTestCase(unittest.TestCase):
+    """
+    Tests for L{header.decode_from}
+    """
+
+    def test_offset(self):
+        buf = bytearray('foo\x95\x03\x92\xfabar')
+
+        h, size = header.decode_from(buf, 3)
+
+        self.assertEqual(size, 4)
+        self.assertEqual(h.channelId, 19)
+        self.assertEqual(h.timestamp, 234234)
+
+    def test_not_enough_data(self):
+        data = '\x15\x03\x92\xfa\x00z\n\x03-\x00\x00\x00'
+
+        for i in xrange(len(data)):
+            self.assertRaises(IOError, header.decode_from, data[:i])
+
+        self.assertRaises(IOError, header.decode_from, '\xa2\xff\xff\xff\x01')
+
+    def test_stream_untouched(self):
+        stream = util.BufferedByteStream('\x15\x03\x92')
+
+        self.assertRaises(IOError, header.decode, stream)
+        self.assertEqual(stream.tell(), 0)
+
+    def test_round_trip(self):
+        """
+        Every header type must decode to the same values that were encoded.
+        """
+        previous = header.Header(318, 10, 8, 100, 0x01020304)
+
+        headers = [
+            header.Header(318, 10, 8, 100, 0x01020304),
+            header.Header(318, 0x1000000, 8, 100, 0x01020304),
+            header.Header(318, 11, 9, 0xabcdef, 0x01020304),
+            header.Header(318, 0xffffff, 9, 0xabcdef, 0x01020304),
+            header.Header(318, 12, 8, 100, 0x01020304),
+            header.Header(318, 0xffffff, 8, 100, 0x01020304),
+        ]
+
+        for h in headers:
+            for p in (None, previous):
+                data = header.encode_bytes(h, p)
+                decoded, size = header.decode_from(data)
+
+                self.assertEqual(size, len(data))
+                self.assertEqual(decoded.channelId, h.channelId)
+
+                if p is not None and h.timestamp == p.timestamp:
+                    self.assertTrue(decoded.continuation)
+
+                    continue
+
+                self.assertEqual(decoded.timestamp, h.timestamp)
+
+                if p is None:
+                    self.assertEqual(decoded.streamId, h.streamId)
+                    self.assertEqual(decoded.bodyLength, h.bodyLength)
+                    self.assertEqual(decoded.datatype, h.datatype)
+
+
+class GetSizeTestCase(unittest.TestCase):
+    """
+    Tests for L{header.get_size}
+    """
+
+    def test_types(self):
+        self.assertEqual(header.get_size('\x03'), 12)
+        self.assertEqual(header.get_size('\x43'), 8)
+        self.assertEqual(header.get_size('\x83'), 4)
+        self.assertEqual(header.get_size('\xc3'), 1)
+
+    def test_channel_id(self):
+        self.assertEqual(header.get_size('\x00'), 13)
+        self.assertEqual(header.get_size('\x01'), 14)
+        self.assertEqual(header.get_size('foo\xc1', 3), 3)
+
+    def test_extended_timestamp(self):
+        self.assertEqual(header.get_size('\x83\xff\xff'), 4)
+        self.assertEqual(header.get_size('\x83\xff\xff\xff'), 8)
+
+    def test_matches_decode(self):
+        previous = header.Header(400, 10, 8, 100, 1)
+
+        for h in [header.Header(400, 10, 8, 100, 1),
+                  header.Header(400, 0xffffff, 8, 100, 2),
+                  header.Header(400, 0xffffff, 9, 100, 1),
+                  header.Header(400, 11, 8, 100, 1)]:
+            data = header.encode_bytes(h, previous)
+
+            self.assertEqual(header.get_size(data), len(data))
+            self.assertEqual(header.decode_from(data)[1], len(data))
+
+
+
+class BasicHeaderTestCase(unittest.TestCase):
+    """
+    Tests for L{header.get_basic_header}
+    """
+
+    def test_precomputed(self):
+        self.assertEqual(header.get_basic_header(1, 0xc0), '\xc3')
+        self.assertEqual(header.get_basic_header(62, 0x40), '\x40\x00')
+        self.assertEqual(header.get_basic_header(317, 0), '\x00\xff')
+
+    def test_large(self):
+        self.assertEqual(header.get_basic_header(318, 0x80), '\x81\x00\x01')
+        self.assertEqual(header.get_basic_header(65597, 0xc0), '\xc1\xff\xff')
+
+
+
+class PackTestCase(unittest.TestCase):
+    """
+    Tests for L{header.pack_medium} and L{header.pack_small}
+    """
+
+    def test_medium(self):
+        self.assertEqual(header.pack_medium(40, 20, 9),
+            '\x00\x00\x28\x00\x00\x14\x09')
+        self.assertEqual(header.pack_medium(0x1000000, 0x10203, 8),
+            '\xff\xff\xff\x01\x02\x03\x08\x01\x00\x00\x00')
+
+    def test_small(self):
+        self.assertEqual(header.pack_small(0x102), '\x00\x01\x02')
+        self.assertEqual(header.pack_small(0xffffff),
+            '\xff\xff\xff\x00\xff\xff\xff')
+
+
 class MergeTestCase(unittest.TestCase):
     """
     Tests for L{header.merge}
@@ -325,3 +456,36 @@ class MergeTestCase(unittest.TestCase):
 
         h = self.merge(streamId=15)
         self.assertEqual(h.streamId, 15)
+
+
+
+class UpdateTestCase(unittest.TestCase):
+    """
+    Tests for L{header.update}
+    """
+
+    def setUp(self):
+        self.absolute = header.Header(3, timestamp=1000,
+            bodyLength=2000, datatype=3, streamId=243, full=True)
+
+    def test_different_channels(self):
+        self.assertRaises(header.HeaderError, header.update, self.absolute,
+            header.Header(4))
+
+    def test_in_place(self):
+        h = header.update(self.absolute, header.Header(3, timestamp=10,
+            bodyLength=20))
+
+        self.assertTrue(h is self.absolute)
+        self.assertEqual(h.timestamp, 10)
+        self.assertEqual(h.bodyLength, 20)
+        self.assertEqual(h.datatype, 3)
+        self.assertEqual(h.streamId, 243)
+        self.assertFalse(h.full)
+
+    def test_copy(self):
+        h = self.absolute.copy()
+
+        self.assertFalse(h is self.absolute)
+        self.assertEqual(repr(h).split(' at ')[0],
+            repr(self.absolute).split(' at ')[0])
@@ -0,0 +1,145 @@
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests for L{rtmpy.protocol.rtmp.ping}.
+"""
+
+from twisted.trial import unittest
+from twisted.internet import task
+
+from rtmpy import message
+from rtmpy.protocol.rtmp import ping
+
+
+class Streamer(object):
+    """
+    Records the pings sent and whether the pinger timed out.
+    """
+
+    controlStream = object()
+
+    def __init__(self):
+        self.sent = []
+        self.timedOut = False
+
+    def sendMessage(self, msg, stream):
+        self.sent.append(msg)
+
+    def pingTimedOut(self):
+        self.timedOut = True
+
+
+
+class PingerTestCase(unittest.TestCase):
+    """
+    Tests for L{ping.Pinger}
+    """
+
+    def setUp(self):
+        self.streamer = Streamer()
+        self.clock = task.Clock()
+
+        self.pinger = ping.Pinger(self.streamer, 10, 30, self.clock)
+
+    def test_start(self):
+        self.pinger.start()
+
+        msg, = self.streamer.sent
+
+        self.assertIsInstance(msg, message.ControlMessage)
+        self.assertEqual(msg.type, message.ControlMessage.PING)
+        self.assertEqual(msg.value1, 1)
+        self.assertTrue(self.pinger.running)
+
+        self.clock.advance(10)
+
+        self.assertEqual([m.value1 for m in self.streamer.sent], [1, 2])
+
+        self.pinger.stop()
+
+        self.assertFalse(self.pinger.running)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_pong(self):
+        self.pinger.start()
+        self.clock.advance(0.2)
+        self.pinger.pong(1)
+
+        self.assertEqual(self.pinger.rtt, 0.2)
+        self.assertEqual(self.pinger.jitter, 0.1)
+        self.assertEqual(self.pinger.outstanding, {})
+
+        self.clock.advance(9.8)
+        self.clock.advance(0.6)
+        self.pinger.pong(2)
+
+        self.assertAlmostEqual(self.pinger.lastRTT, 0.6)
+        self.assertAlmostEqual(self.pinger.rtt, 0.25)
+        self.assertAlmostEqual(self.pinger.jitter, 0.175)
+
+        self.pinger.stop()
+
+    def test_unknown_pong(self):
+        self.pinger.start()
+        self.pinger.pong(123)
+
+        self.assertEqual(self.pinger.rtt, None)
+        self.assertEqual(list(self.pinger.outstanding), [1])
+
+        self.pinger.stop()
+
+    def test_lost(self):
+        """
+        Pings older than the one answered will not be answered.
+        """
+        self.pinger.start()
+        self.clock.advance(10)
+        self.clock.advance(1)
+        self.pinger.pong(2)
+
+        self.assertEqual(self.pinger.outstanding, {})
+        self.assertEqual(self.pinger.rtt, 1)
+
+        self.pinger.stop()
+
+    def test_timeout(self):
+        self.pinger.start()
+
+        self.clock.advance(20)
+        self.assertFalse(self.streamer.timedOut)
+
+        self.clock.advance(10)
+        self.assertTrue(self.streamer.timedOut)
+        self.assertFalse(self.pinger.running)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_timeout_reset(self):
+        """
+        The timeout is counted from the oldest ping that is still outstanding.
+        """
+        self.pinger.start()
+        self.clock.advance(10)
+        self.pinger.pong(1)
+
+        self.clock.advance(29)
+        self.assertFalse(self.streamer.timedOut)
+
+        self.clock.advance(1)
+        self.assertTrue(self.streamer.timedOut)
+
+    def test_stats(self):
+        self.assertEqual(self.pinger.getStats(), {'rtt': None,
+            'jitter': None, 'last': None, 'outstanding': 0})
@@ -20,10 +20,11 @@ Tests for L{rtmpy.protocol.rtmp}
 """
 
 from twisted.trial import unittest
-from twisted.internet import error, defer, reactor
+from twisted.internet import error, defer, reactor, task
 from twisted.test.proto_helpers import StringTransportWithDisconnection
 
 from rtmpy.protocol import rtmp
+from rtmpy.protocol.rtmp import buffer, codec, cooperator, shaping
 from rtmpy import message, core, exc, util
 
 
@@ -96,6 +97,66 @@ class SimpleProtocol(rtmp.RTMPProtocol, core.StreamManager):
         return core.NetStream(self, streamId)
 
 
+class MockListener(object):
+    """
+    Records the calls made by a L{rtmp.MessageDispatcher}.
+    """
+
+    def __init__(self):
+        self.calls = []
+
+    def onAudioData(self, data, timestamp):
+        self.calls.append(('audio', data, timestamp))
+
+    def onVideoData(self, data, timestamp):
+        self.calls.append(('video', data, timestamp))
+
+    def onFrameSize(self, size, timestamp):
+        self.calls.append(('frameSize', size, timestamp))
+
+
+class MessageDispatcherTestCase(unittest.TestCase):
+    """
+    Tests for L{rtmp.MessageDispatcher}
+    """
+
+    def setUp(self):
+        self.dispatcher = rtmp.MessageDispatcher(None)
+        self.listener = MockListener()
+
+    def test_pass_through(self):
+        """
+        Audio/video payloads are handed straight to the stream without
+        building a message.
+        """
+        def classByType(datatype):
+            self.fail('Message built for datatype %r' % (datatype,))
+
+        self.patch(message, 'classByType', classByType)
+
+        self.dispatcher.dispatchMessage(
+            self.listener, message.VIDEO_DATA, 10, 'foo')
+        self.dispatcher.dispatchMessage(
+            self.listener, message.AUDIO_DATA, 11, 'bar')
+
+        self.assertEqual(self.listener.calls, [
+            ('video', 'foo', 10), ('audio', 'bar', 11)])
+
+    def test_pass_through_view(self):
+        data = memoryview(bytearray('foobar'))[3:]
+
+        self.dispatcher.dispatchMessage(
+            self.listener, message.VIDEO_DATA, 0, data)
+
+        self.assertEqual(self.listener.calls, [('video', 'bar', 0)])
+
+    def test_message(self):
+        self.dispatcher.dispatchMessage(
+            self.listener, message.FRAME_SIZE, 5, '\x00\x00\x01\x00')
+
+        self.assertEqual(self.listener.calls, [('frameSize', 256, 5)])
+
+
 class ProtocolTestCase(unittest.TestCase):
     """
     """
@@ -162,21 +223,86 @@ class ConnectionLostTestCase(ProtocolTestCase):
         self.assertFalse(hasattr(self.protocol, 'decoder'))
         self.assertFalse(hasattr(self.protocol, 'encoder'))
 
+    def test_ping_timeout(self):
+        """
+        The connection is dropped if the peer stops answering pings.
+        """
+        self.protocol.handshakeSuccess('')
+        self.protocol.pingTimedOut()
+
+        self.assertFalse(self.transport.connected)
+        self.assertFalse(hasattr(self.protocol, 'pinger'))
+
+    def test_producer(self):
+        self.protocol.handshakeSuccess('')
+
+        self.assertIdentical(self.transport.producer, self.protocol)
+
+        self.protocol.connectionLost(error.ConnectionDone())
+
+        self.assertIdentical(self.transport.producer, None)
+
+    def test_lose_connection(self):
+        """
+        The producer is unregistered before the connection is closed, or a
+        paused producer would keep the transport open.
+        """
+        self.protocol.handshakeSuccess('')
+        self.protocol.pauseProducing()
+
+        producers = []
+
+        self.patch(self.transport, 'loseConnection',
+            lambda: producers.append(self.transport.producer))
+
+        self.protocol.logAndDisconnect(RuntimeError('boom'))
+
+        self.assertEqual(producers, [None])
+        self.assertFalse(self.protocol.producing)
+        self.flushLoggedErrors(RuntimeError)
+
     def test_decode_task(self):
         self.protocol.handshakeSuccess('')
         self.protocol.startDecoding()
 
-        self.assertTrue(hasattr(self.protocol, 'decoder_task'))
+        t = self.protocol._decodingTask
+        self.assertTrue(self.protocol.decoding)
+
         self.protocol.connectionLost(error.ConnectionDone())
-        self.assertFalse(hasattr(self.protocol, 'decoder_task'))
+
+        self.assertTrue(t.stopped)
+        self.assertNotIn(t, t.cooperator.queues[t.queue])
+        self.assertIdentical(self.protocol._decodingTask, None)
 
     def test_encode_task(self):
         self.protocol.handshakeSuccess('')
         self.protocol.startEncoding()
 
-        self.assertTrue(hasattr(self.protocol, 'encoder_task'))
+        t = self.protocol._encodingTask
+        self.assertTrue(self.protocol.encoding)
+
         self.protocol.connectionLost(error.ConnectionDone())
-        self.assertFalse(hasattr(self.protocol, 'encoder_task'))
+
+        self.assertTrue(t.stopped)
+        self.assertNotIn(t, t.cooperator.queues[t.queue])
+        self.assertIdentical(self.protocol._encodingTask, None)
+
+    def test_persistent_task(self):
+        """
+        The decoder keeps the same cooperative task between bursts of data.
+        """
+        self.protocol.handshakeSuccess('')
+        self.protocol.startDecoding()
+
+        t = self.protocol._decodingTask
+        t.finish(self.protocol.decoder)
+
+        self.assertFalse(self.protocol.decoding)
+
+        self.protocol.startDecoding()
+
+        self.assertIdentical(self.protocol._decodingTask, t)
+        self.assertTrue(self.protocol.decoding)
 
     def test_inform_application(self):
         self.protocol.handshakeSuccess('')
@@ -270,15 +396,321 @@ class DataReceivedTestCase(ProtocolTestCase):
         decoder = self.protocol.decoder
 
         self.assertEqual(self.protocol.decoder_task, None)
+        self.assertFalse(self.protocol.decoding)
         self.protocol.dataReceived('woot')
         self.assertNotEqual(self.protocol.decoder_task, None)
+        self.assertTrue(self.protocol.decoding)
 
         self.assertEqual(decoder.stream.getvalue(), 'woot')
 
+        # the running task picks up the new data
+        decoder_task = self.protocol.decoder_task
+        self.protocol.dataReceived('woot')
+        self.assertIdentical(self.protocol.decoder_task, decoder_task)
+
         self.protocol.decoder_task.addErrback(lambda x: None)
 
 
 
+class ProducerTestCase(ProtocolTestCase):
+    """
+    Tests for L{rtmp.RTMPProtocol} as a push producer for the transport.
+    """
+
+    def setUp(self):
+        ProtocolTestCase.setUp(self)
+
+        self.connect()
+        self.protocol.handshakeSuccess('')
+
+    def wait(self):
+        return task.deferLater(reactor, 0.01, lambda: None)
+
+    def test_register(self):
+        self.assertIdentical(self.transport.producer, self.protocol)
+        self.assertTrue(self.transport.streaming)
+
+    def test_pause(self):
+        self.transport.clear()
+        self.protocol.pauseProducing()
+
+        self.assertTrue(self.protocol.encodingPaused)
+
+        self.protocol.sendMessage(message.Notify('foo'),
+            self.protocol.controlStream)
+
+        d = self.wait()
+
+        def paused(res):
+            self.assertEqual(self.transport.value(), '')
+
+            self.protocol.resumeProducing()
+
+            self.assertFalse(self.protocol.encodingPaused)
+
+            return self.protocol.encoder_task
+
+        def resumed(res):
+            self.assertNotEqual(self.transport.value(), '')
+
+        d.addCallback(paused)
+        d.addCallback(resumed)
+
+        return d
+
+    def test_writable(self):
+        p = self.protocol
+
+        self.assertTrue(p.isWritable())
+
+        p.pauseProducing()
+        self.assertFalse(p.isWritable())
+
+        p.resumeProducing()
+        self.assertTrue(p.isWritable())
+
+
+
+class SendWindowTestCase(ProtocolTestCase):
+    """
+    Tests for flow control using the acknowledgements sent by the peer.
+    """
+
+    def setUp(self):
+        ProtocolTestCase.setUp(self)
+
+        self.connect()
+        self.protocol.handshakeSuccess('')
+
+        self.encoder = self.protocol.encoder
+
+    def test_disabled(self):
+        self.assertEqual(self.protocol.sendWindow, 0)
+        self.assertEqual(self.encoder.bytesLimit, 0)
+        self.assertFalse(self.protocol.isThrottled())
+
+    def test_full(self):
+        """
+        Encoding stops once more than C{sendWindowScale} windows are
+        unacknowledged and restarts when the peer acknowledges data.
+        """
+        p = self.protocol
+
+        p.setSendWindow(100)
+        self.assertEqual(self.encoder.bytesLimit, 200)
+
+        p.sendMessage(message.Notify('foo', 'a' * 300), p.controlStream)
+
+        def throttled(res):
+            self.assertTrue(p.isThrottled())
+            self.assertTrue(self.encoder.active)
+            self.assertEqual(p.encoder_task, None)
+
+            inFlight = p.getBytesInFlight()
+            self.assertEqual(inFlight, self.encoder.bytes)
+            self.assertTrue(inFlight >= 200)
+
+            p.sendMessage(message.Notify('bar'), p.controlStream)
+            self.assertEqual(p.encoder_task, None)
+
+            p.onBytesRead(inFlight, 0)
+
+            self.assertFalse(p.isThrottled())
+            self.assertEqual(p.getBytesInFlight(), 0)
+
+            return p.encoder_task
+
+        def resumed(res):
+            self.assertFalse(self.encoder.active)
+
+        d = p.encoder_task
+
+        d.addCallback(throttled)
+        d.addCallback(resumed)
+
+        return d
+
+    def test_acknowledged(self):
+        """
+        The peer counts the handshake and its counter wraps, the acknowledged
+        bytes never exceed the bytes that have been encoded.
+        """
+        p = self.protocol
+
+        self.encoder.bytes = 1000
+        p.onBytesRead(4000, 0)
+
+        self.assertEqual(p.bytesAcknowledged, 1000)
+        self.assertEqual(p.getBytesInFlight(), 0)
+
+        self.encoder.bytes = 1500
+        p._lastBytesRead = 0xffffff00
+        p.onBytesRead(0x10, 0)
+
+        self.assertEqual(p.bytesAcknowledged, 1272)
+        self.assertEqual(p.getBytesInFlight(), 228)
+
+
+
+class ShapingTestCase(ProtocolTestCase):
+    """
+    Tests for capping the rate at which data is sent with a token bucket.
+    """
+
+    def setUp(self):
+        ProtocolTestCase.setUp(self)
+
+        self.clock = task.Clock()
+        self.cooperator = cooperator.Cooperator(self.clock)
+
+        self.patch(self.protocol, 'getCooperator', lambda: self.cooperator)
+
+        self.connect()
+        self.protocol.handshakeSuccess('')
+
+        self.encoder = self.protocol.encoder
+
+        self.shaper = shaping.TokenBucket(1000, 200)
+        self.shaper.clock = self.clock.seconds
+
+    def test_limit(self):
+        p = self.protocol
+
+        p.setShaper(self.shaper)
+        self.assertEqual(self.encoder.bytesLimit, 200)
+
+        p.setShaper(None)
+        self.assertEqual(self.encoder.bytesLimit, 0)
+
+    def test_throttle(self):
+        """
+        Once the tokens have been spent the encoder waits for the bucket to
+        refill.
+        """
+        p = self.protocol
+        e = self.encoder
+
+        p.setShaper(self.shaper)
+        p.sendMessage(message.Notify('foo', 'a' * 1000), p.controlStream)
+
+        self.clock.advance(0)
+
+        self.assertTrue(e.active)
+        self.assertFalse(p.encoding)
+        self.assertTrue(200 <= e.bytes < 400)
+        self.assertTrue(p.isThrottled())
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+
+        while e.active:
+            self.clock.advance(0.1)
+
+        # 1000 bytes/s after a burst of 200
+        self.assertTrue(e.bytes > 1000)
+        self.assertTrue(0.6 <= self.clock.seconds() <= 1.0)
+
+    def test_connection_lost(self):
+        p = self.protocol
+
+        p.setShaper(self.shaper)
+        p.sendMessage(message.Notify('foo', 'a' * 1000), p.controlStream)
+
+        self.clock.advance(0)
+        p.connectionLost(error.ConnectionDone())
+
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+
+class ClockTestCase(ProtocolTestCase):
+    """
+    The codecs of a streamer use the time of its reactor.
+    """
+
+    def setUp(self):
+        ProtocolTestCase.setUp(self)
+
+        self.clock = task.Clock()
+        self.cooperator = cooperator.Cooperator(self.clock)
+
+        self.patch(self.protocol, 'getCooperator', lambda: self.cooperator)
+
+        self.connect()
+        self.protocol.handshakeSuccess('')
+
+    def test_clock(self):
+        self.clock.advance(5)
+
+        self.assertEqual(self.protocol.decoder.clock(), 5)
+        self.assertEqual(self.protocol.encoder.clock(), 5)
+
+
+
+class FrameSizePolicyTestCase(ProtocolTestCase):
+    """
+    Tests for picking the outbound frame size from the egress bitrate.
+    """
+
+    def setUp(self):
+        ProtocolTestCase.setUp(self)
+
+        self.clock = task.Clock()
+        self.cooperator = cooperator.Cooperator(self.clock)
+
+        self.patch(self.protocol, 'getCooperator', lambda: self.cooperator)
+
+        self.connect()
+        self.protocol.handshakeSuccess('')
+
+        self.encoder = self.protocol.encoder
+
+    def test_initial(self):
+        p = self.protocol
+
+        p.setFrameSizePolicy(codec.LatencyFrameSize(), 2500000)
+
+        self.assertEqual(self.encoder.frameSize, 3072)
+        self.assertTrue(self.transport.value().endswith('\x00\x00\x0c\x00'))
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_measured(self):
+        """
+        The frame size follows the measured egress bitrate.
+        """
+        p = self.protocol
+
+        p.setFrameSizePolicy(codec.LatencyFrameSize(), 2500000, 5)
+
+        written = len(self.transport.value())
+
+        # 1Mbit/s
+        self.encoder.bytes += 625000
+        self.clock.advance(5)
+
+        self.assertEqual(self.encoder.frameSize, 1152)
+        self.assertTrue(self.transport.value()[written:].endswith(
+            '\x00\x00\x04\x80'))
+
+        # nothing sent
+        self.clock.advance(5)
+
+        self.assertEqual(self.encoder.frameSize, 1152)
+
+    def test_fixed(self):
+        self.protocol.setFrameSizePolicy(codec.FixedFrameSize(), 2500000, 5)
+
+        self.assertEqual(self.encoder.frameSize, 4096)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_connection_lost(self):
+        p = self.protocol
+
+        p.setFrameSizePolicy(codec.LatencyFrameSize(), 2500000, 5)
+        p.connectionLost(error.ConnectionDone())
+
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+
 class BasicResponseTestCase(ProtocolTestCase):
     """
     Some RTMP messages are really low level. Test them.
@@ -347,6 +779,95 @@ class BasicResponseTestCase(ProtocolTestCase):
         self.assertEqual(self.decoder.frameSize, 50)
         self.assertEqual(self.messages, [])
 
+    def test_decoding_limits(self):
+        p = self.protocol
+
+        self.assertEqual(self.decoder.maxBufferedBytes, p.decodingBufferLimit)
+        self.assertEqual(self.decoder.maxOpenChannels, p.decodingChannelLimit)
+        self.assertEqual(self.decoder.maxMessageSizes,
+            p.decodingMessageLimits)
+
+    def test_too_many_channels(self):
+        """
+        Partial messages on more channels than allowed is an error.
+        """
+        self.decoder.setLimits(maxOpenChannels=1)
+
+        for channelId in (3, 4):
+            self.decoder.send(chr(channelId) + '\x00\x00\x00\x00\x01\x00\x12'
+                '\x00\x00\x00\x00' + 'a' * 128)
+
+        self.assertRaises(codec.MemoryLimitError, list, self.decoder)
+
+    def test_ping(self):
+        """
+        Pings from the peer are answered with the same value.
+        """
+        self.protocol.onControlMessage(message.ControlMessage(
+            message.ControlMessage.PING, 42), 0)
+
+        msg, stream = self.messages[0]
+
+        self.assertIdentical(stream, self.protocol)
+        self.assertEqual(msg.type, message.ControlMessage.PONG)
+        self.assertEqual(msg.value1, 42)
+
+    def test_pong(self):
+        pongs = []
+
+        class Pinger(object):
+            def pong(self, value):
+                pongs.append(value)
+
+        self.protocol.pinger = Pinger()
+        self.protocol.onControlMessage(message.ControlMessage(
+            message.ControlMessage.PONG, 42), 0)
+
+        self.assertEqual(pongs, [42])
+        self.assertEqual(self.messages, [])
+
+    def test_inline_decoding(self):
+        """
+        A small message is dispatched from C{dataReceived} when inline decoding
+        is enabled.
+        """
+        self.protocol.inlineDecodingBudget = 64
+        self.decoder.setBytesInterval(8)
+
+        self.protocol.dataReceived('\x03\x00\x00\x00\x00\x00\x04\x01'
+            '\x00\x00\x00\x00\x00\x00\x00\x32')
+
+        self.assertEqual(self.decoder.frameSize, 50)
+        self.assertEqual(len(self.messages), 1)
+        self.assertFalse(self.protocol.decoding)
+
+    def test_inline_decoding_backlog(self):
+        """
+        More than C{inlineDecodingBudget} bytes are left to the cooperator.
+        """
+        self.protocol.inlineDecodingBudget = 8
+
+        self.protocol.dataReceived('\x03\x00\x00\x00\x00\x00\x04\x01'
+            '\x00\x00\x00\x00\x00\x00\x00\x32')
+
+        self.assertNotEqual(self.decoder.frameSize, 50)
+        self.assertTrue(self.protocol.decoding)
+
+    def test_inline_decoding_error(self):
+        self.protocol.inlineDecodingBudget = 512
+        self.decoder.setLimits(maxOpenChannels=1)
+
+        errors = []
+
+        self.patch(self.protocol, 'logAndDisconnect', errors.append)
+
+        self.protocol.dataReceived(''.join([chr(channelId) +
+            '\x00\x00\x00\x00\x01\x00\x12\x00\x00\x00\x00' + 'a' * 128
+            for channelId in (3, 4)]))
+
+        failure, = errors
+        failure.trap(codec.MemoryLimitError)
+
 
 
 class InvokableStream(core.NetStream):
@@ -705,3 +1226,67 @@ class InvokingTestCase(ProtocolTestCase):
         self.assertIsInstance(d, defer.Deferred)
 
         return wait_ok
+
+
+
+class ViewDecodingTestCase(BasicResponseTestCase):
+    """
+    Tests for decoding RTMP messages when the protocol is using a
+    L{buffer.ByteBuffer}.
+    """
+
+    def setUp(self):
+        self.patch(SimpleProtocol, 'decodingBuffer', buffer.ByteBuffer)
+
+        BasicResponseTestCase.setUp(self)
+
+    def test_buffer(self):
+        self.assertIsInstance(self.decoder.stream, buffer.ByteBuffer)
+
+
+
+class ScatterEncodingTestCase(ProtocolTestCase):
+    """
+    Tests for encoding RTMP messages when the protocol is using a
+    L{buffer.SequenceBuffer}.
+    """
+
+    def setUp(self):
+        self.patch(SimpleProtocol, 'encodingBuffer', buffer.SequenceBuffer)
+
+        ProtocolTestCase.setUp(self)
+
+        self.connect()
+        self.protocol.handshakeSuccess('')
+        self.transport.clear()
+
+    def test_buffer(self):
+        self.assertIsInstance(self.protocol.encoder.stream,
+            buffer.SequenceBuffer)
+
+    def test_send(self):
+        self.protocol.sendMessage(message.Notify('foo'),
+            self.protocol.controlStream)
+
+        def cb(res):
+            self.assertEqual(self.transport.value(),
+                '\x03\x00\x00\x00\x00\x00\x06\x12\x00\x00\x00\x00'
+                '\x02\x00\x03foo')
+
+        return self.protocol.encoder_task.addCallback(cb)
+
+
+
+class DrainDecodingTestCase(BasicResponseTestCase):
+    """
+    Tests for decoding RTMP messages when the decoder drains the buffer in
+    batches.
+    """
+
+    def setUp(self):
+        self.patch(SimpleProtocol, 'decodingBytesBudget', 64 * 1024)
+
+        BasicResponseTestCase.setUp(self)
+
+    def test_budget(self):
+        self.assertEqual(self.decoder.bytesBudget, 64 * 1024)
@@ -0,0 +1,75 @@
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests for L{rtmpy.protocol.rtmp.shaping}.
+"""
+
+from twisted.trial import unittest
+
+from rtmpy.protocol.rtmp import shaping
+
+
+class TokenBucketTestCase(unittest.TestCase):
+    """
+    Tests for L{shaping.TokenBucket}
+    """
+
+    def setUp(self):
+        self.now = 0.0
+
+        self.bucket = shaping.TokenBucket(1000, 500)
+        self.bucket.clock = lambda: self.now
+
+    def test_create(self):
+        self.assertEqual(self.bucket.tokens, 500)
+
+        bucket = shaping.TokenBucket(1000)
+
+        self.assertEqual(bucket.burst, 1000)
+        self.assertEqual(bucket.tokens, 1000)
+
+    def test_consume(self):
+        self.bucket.consume(400)
+        self.assertEqual(self.bucket.tokens, 100)
+
+        self.now = 0.1
+        self.bucket.consume(300)
+
+        self.assertEqual(self.bucket.tokens, -100)
+
+    def test_refill(self):
+        """
+        The bucket never holds more than C{burst} tokens.
+        """
+        self.bucket.consume(500)
+
+        self.now = 0.25
+        self.bucket.refill()
+
+        self.assertEqual(self.bucket.tokens, 250)
+
+        self.now = 10
+        self.bucket.refill()
+
+        self.assertEqual(self.bucket.tokens, 500)
+
+    def test_delay(self):
+        self.assertEqual(self.bucket.getDelay(100), 0)
+
+        self.bucket.consume(600)
+
+        self.assertEqual(self.bucket.getDelay(100), 0.2)
+        self.assertEqual(self.bucket.getDelay(5000), 0.6)
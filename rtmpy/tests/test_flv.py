@@ -0,0 +1,66 @@
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests for L{rtmpy.flv}.
+"""
+
+from twisted.trial import unittest
+
+from rtmpy import flv, message
+
+
+class VideoTestCase(unittest.TestCase):
+    """
+    Tests for video tag inspection.
+    """
+
+    def test_frame_type(self):
+        self.assertEqual(flv.frame_type('\x17\x01'), flv.KEYFRAME)
+        self.assertEqual(flv.frame_type('\x27\x01'), flv.INTER_FRAME)
+        self.assertEqual(flv.frame_type(''), None)
+
+    def test_keyframe(self):
+        self.assertTrue(flv.is_keyframe('\x17\x01'))
+        self.assertTrue(flv.is_keyframe('\x12'))
+        self.assertFalse(flv.is_keyframe('\x27\x01'))
+        self.assertFalse(flv.is_keyframe(''))
+
+        # AVC sequence header
+        self.assertFalse(flv.is_keyframe('\x17\x00'))
+
+    def test_sequence_header(self):
+        self.assertTrue(flv.is_video_sequence_header('\x17\x00'))
+        self.assertFalse(flv.is_video_sequence_header('\x17\x01'))
+        self.assertFalse(flv.is_video_sequence_header('\x12\x00'))
+        self.assertFalse(flv.is_video_sequence_header('\x17'))
+
+
+
+class AudioTestCase(unittest.TestCase):
+    """
+    Tests for audio tag inspection.
+    """
+
+    def test_sequence_header(self):
+        self.assertTrue(flv.is_audio_sequence_header('\xaf\x00'))
+        self.assertFalse(flv.is_audio_sequence_header('\xaf\x01'))
+        self.assertFalse(flv.is_audio_sequence_header('\x2f\x00'))
+
+    def test_datatype(self):
+        self.assertTrue(flv.is_sequence_header(message.AUDIO_DATA, '\xaf\x00'))
+        self.assertTrue(flv.is_sequence_header(message.VIDEO_DATA, '\x17\x00'))
+        self.assertFalse(flv.is_sequence_header(message.VIDEO_DATA, '\xaf\x00'))
+        self.assertFalse(flv.is_sequence_header(message.INVOKE, '\x17\x00'))
@@ -23,7 +23,7 @@ from twisted.internet import defer, reactor, protocol
 from twisted.test.proto_helpers import StringTransportWithDisconnection, StringIOWithoutClosing
 
 from rtmpy import server, exc, rpc, util
-from rtmpy.protocol.rtmp import message
+from rtmpy.protocol.rtmp import message, codec, ping, shaping
 
 
 
@@ -380,6 +380,52 @@ class ServerFactoryTestCase(unittest.TestCase):
         return manager.getStream(manager.createStream())
 
 
+class SchedulerTestCase(ServerFactoryTestCase):
+    """
+    Tests for the encoding scheduler configured by L{server.ServerFactory}.
+    """
+
+    def test_default(self):
+        self.assertEqual(self.protocol.encoder.scheduler, None)
+        self.assertEqual(self.factory.buildScheduler(), None)
+
+    def test_priority(self):
+        self.factory.scheduler = codec.PriorityScheduler
+
+        self.assertIsInstance(self.factory.buildScheduler(),
+            codec.PriorityScheduler)
+
+    def test_custom(self):
+        self.factory.scheduler = lambda: codec.PriorityScheduler(bulkSize=10)
+
+        self.assertEqual(self.factory.buildScheduler().bulkSize, 10)
+
+
+
+class FrameSizePolicyTestCase(ServerFactoryTestCase):
+    """
+    Tests for the frame size policy configured by L{server.ServerFactory}.
+    """
+
+    def test_default(self):
+        policy = self.factory.buildFrameSizePolicy()
+
+        self.assertIsInstance(policy, codec.FixedFrameSize)
+        self.assertEqual(policy.getFrameSize(self.factory.egressBitrate), 4096)
+
+    def test_none(self):
+        self.factory.frameSizePolicy = None
+
+        self.assertEqual(self.factory.buildFrameSizePolicy(), None)
+
+    def test_custom(self):
+        self.factory.frameSizePolicy = codec.BitrateFrameSize
+
+        self.assertIsInstance(self.factory.buildFrameSizePolicy(),
+            codec.BitrateFrameSize)
+
+
+
 class ServerFactoryDisconnectedTestCase(unittest.TestCase):
     """
     """
@@ -445,6 +491,7 @@ class ConnectingTestCase(unittest.TestCase):
         self.control = self.protocol.controlStream
 
 
+
     def assertStatus(self, code=None, description=None, level='status'):
         """
         Ensures that a status message has been sent.
@@ -660,6 +707,105 @@ class ConnectingTestCase(unittest.TestCase):
 
         return d
 
+    def test_frame_size(self):
+        """
+        The outbound frame size is set when the connection is accepted.
+        """
+        self.factory.applications['what'] = SimpleApplication()
+
+        self.assertEqual(self.protocol.encoder.frameSize, 128)
+
+        d = self.connect({'app': 'what'})
+
+        def check_frame_size(res):
+            self.assertEqual(self.protocol.encoder.frameSize, 4096)
+
+        d.addCallback(check_frame_size)
+
+        self.protocol.onDownstreamBandwidth(2000, 2)
+
+        return d
+
+    def test_ping(self):
+        """
+        Once enabled, the peer is pinged when the connection has been
+        accepted.
+        """
+        self.factory.applications['what'] = SimpleApplication()
+
+        self.assertEqual(self.protocol.pinger, None)
+
+        self.factory.pingInterval = 10
+        pinger = self.protocol.pinger = self.protocol.buildPinger()
+        self.addCleanup(pinger.stop)
+
+        self.assertIsInstance(pinger, ping.Pinger)
+        self.assertEqual(pinger.interval, self.factory.pingInterval)
+        self.assertEqual(pinger.timeout, self.factory.pingTimeout)
+        self.assertFalse(pinger.running)
+
+        d = self.connect({'app': 'what'})
+
+        def check_ping(res):
+            self.assertTrue(pinger.running)
+            self.assertEqual(len(pinger.outstanding), 1)
+
+        d.addCallback(check_ping)
+
+        self.protocol.onDownstreamBandwidth(2000, 2)
+
+        return d
+
+    def test_send_window(self):
+        """
+        Flow control is off by default, a peer that never acknowledges data
+        is sent everything.
+        """
+        self.factory.applications['what'] = SimpleApplication()
+        self.factory.downstreamBandwidth = 1000
+
+        d = self.connect({'app': 'what'})
+
+        def check_window(res):
+            p = self.protocol
+
+            self.assertEqual(p.sendWindow, 0)
+
+            p.sendMessage(message.Notify('foo', 'a' * 5000), p.controlStream)
+
+            for _ in p.encoder:
+                pass
+
+            self.assertFalse(p.isThrottled())
+            self.assertEqual(p.bytesAcknowledged, 0)
+            self.assertTrue(p.encoder.bytes > 5000)
+
+        d.addCallback(check_window)
+
+        self.protocol.onDownstreamBandwidth(2000, 2)
+
+        return d
+
+    def test_flow_control(self):
+        """
+        The acknowledgement window sent to the peer is used for flow control
+        once enabled on the factory.
+        """
+        self.factory.applications['what'] = SimpleApplication()
+        self.factory.flowControl = True
+
+        d = self.connect({'app': 'what'})
+
+        def check_window(res):
+            self.assertEqual(self.protocol.sendWindow,
+                self.factory.downstreamBandwidth)
+
+        d.addCallback(check_window)
+
+        self.protocol.onDownstreamBandwidth(2000, 2)
+
+        return d
+
     def test_connect_args(self):
         """
         Ensure a successful connection to application with optional user
@@ -908,6 +1054,29 @@ class ApplicationInterfaceTestCase(ServerFactoryTestCase):
         self.flushLoggedErrors(TestRuntimeError)
 
 
+    def test_disconnect_publisher(self):
+        """
+        The streams published by a client are unpublished when it disconnects,
+        releasing the GOP cache reservation.
+        """
+        self.connect(self.app, self.protocol)
+        client = self.protocol.nc.client
+
+        s = self.createStream(self.manager)
+        s.name = 'foo'
+        publisher = self.app.publishStream(client, s, 'foo')
+
+        publisher.videoDataReceived('\x17\x01' + 'a' * 1000, 0)
+        publisher.videoDataReceived('\x27\x01' + 'b' * 1000, 40)
+
+        self.assertEqual(self.app.gopCacheLimit.size, 2004)
+
+        self.app._disconnect(client)
+
+        self.assertEqual(self.app.gopCacheLimit.size, 0)
+        self.assertFalse('foo' in self.app.streams)
+
+
 class ClientInterfaceTestCase(unittest.TestCase):
     """
     Tests for L{server.Client} implementing the L{server.IClient}
@@ -945,6 +1114,25 @@ class ClientInterfaceTestCase(unittest.TestCase):
         self.assertEqual(args, ('method_name', 1, 'string'))
         self.assertEqual(kwargs, {'kw': 'Hello'})
 
+    def test_rtt(self):
+        """
+        The round trip time estimates come from the pinger of the connection.
+        """
+        self.assertEqual(self.client.rtt, None)
+        self.assertEqual(self.client.jitter, None)
+
+        class Protocol(object):
+            pinger = ping.Pinger(None, reactor=object())
+
+        class NetConnection(object):
+            protocol = Protocol()
+
+        self.client.nc = NetConnection()
+        Protocol.pinger.update(0.2)
+
+        self.assertEqual(self.client.rtt, 0.2)
+        self.assertEqual(self.client.jitter, 0.1)
+
 
 class PublishingTestCase(ServerFactoryTestCase):
     """
@@ -1163,6 +1351,47 @@ class PlayTestCase(ServerFactoryTestCase):
 
 
 
+    def test_disconnect(self):
+        """
+        A subscriber whose connection has been lost is removed from the
+        publisher, which carries on without errors.
+        """
+        self.connect(self.app, self.protocol)
+
+        other = self.app.buildClient(self.nc, {'app': 'foo'})
+        self.app.acceptConnection(other)
+
+        publisher = self.app.publishStream(other, Publisher(), 'foo')
+
+        s = self.createStream(self.protocol.streamManager)
+        s.play('foo')
+
+        self.assertTrue(s in publisher.subscribers)
+
+        self.transport.loseConnection()
+
+        self.assertFalse(s in publisher.subscribers)
+        self.assertIdentical(s.source, None)
+
+        publisher.videoDataReceived('\x17\x01a', 0)
+        publisher.audioDataReceived('\xaf\x01b', 0)
+
+        self.assertEqual(self.flushLoggedErrors(), [])
+
+    def test_not_writable(self):
+        """
+        A stream is not writable once its connection has been lost.
+        """
+        s = self.createStream(self.protocol.streamManager)
+
+        self.assertTrue(s.isWritable())
+
+        self.transport.loseConnection()
+
+        self.assertFalse(s.isWritable())
+
+
+
 class Publisher(object):
     """
     A value object that acts like a publisher.
@@ -1269,3 +1498,527 @@ class SendTestCase(ServerFactoryTestCase):
 
         self.clearMetaData()
         self.assertMetaData({})
+
+
+    def test_deadline(self):
+        """
+        A message deadline is passed through to the protocol.
+        """
+        sent = []
+
+        def sendMessage(msg, stream, whenDone=None, deadline=None):
+            sent.append((msg, stream, deadline))
+
+        self.patch(self.protocol, 'sendMessage', sendMessage)
+
+        m = message.Notify('foo')
+        self.stream.sendMessage(m, deadline=5)
+
+        self.assertEqual(sent, [(m, self.stream, 5)])
+
+
+
+class GOPCacheTestCase(unittest.TestCase):
+    """
+    Tests for L{server.GOPCache}
+    """
+
+    def setUp(self):
+        self.cache = server.GOPCache()
+
+    def test_wait_for_keyframe(self):
+        self.cache.add(message.VIDEO_DATA, '\x27\x01', 0)
+        self.cache.add(message.AUDIO_DATA, '\xaf\x01', 0)
+
+        self.assertEqual(self.cache.frames, [])
+        self.assertEqual(self.cache.getStartTimestamp(), None)
+
+    def test_gop(self):
+        self.cache.add(message.VIDEO_DATA, '\x17\x01a', 10)
+        self.cache.add(message.AUDIO_DATA, '\xaf\x01b', 15)
+        self.cache.add(message.VIDEO_DATA, '\x27\x01c', 20)
+
+        self.assertEqual(len(self.cache.frames), 3)
+        self.assertEqual(self.cache.size, 9)
+        self.assertEqual(self.cache.getStartTimestamp(), 10)
+
+        self.cache.add(message.VIDEO_DATA, '\x17\x01d', 30)
+
+        self.assertEqual(self.cache.frames,
+            [(message.VIDEO_DATA, '\x17\x01d', 30)])
+        self.assertEqual(self.cache.size, 3)
+
+    def test_max_bytes(self):
+        self.cache.maxBytes = 6
+
+        self.cache.add(message.VIDEO_DATA, '\x17\x01a', 0)
+        self.cache.add(message.VIDEO_DATA, '\x27\x01b', 10)
+        self.cache.add(message.VIDEO_DATA, '\x27\x01c', 20)
+
+        # the gop is dropped until the next keyframe
+        self.assertEqual(self.cache.frames, [])
+
+        self.cache.add(message.VIDEO_DATA, '\x27\x01d', 30)
+        self.assertEqual(self.cache.frames, [])
+
+        self.cache.add(message.VIDEO_DATA, '\x17\x01e', 40)
+        self.assertEqual(len(self.cache.frames), 1)
+
+    def test_limit(self):
+        limit = server.CacheLimit(5)
+        other = server.GOPCache(limit=limit)
+
+        self.cache.limit = limit
+
+        self.cache.add(message.VIDEO_DATA, '\x17\x01a', 0)
+        other.add(message.VIDEO_DATA, '\x17\x01b', 0)
+
+        self.assertEqual(limit.size, 3)
+        self.assertEqual(other.frames, [])
+
+        self.cache.clear()
+
+        self.assertEqual(limit.size, 0)
+
+
+
+class SubscriberRecorder(object):
+    """
+    Records the a/v data sent to a subscriber.
+    """
+
+    def __init__(self):
+        self.received = []
+
+    def onMetaData(self, data):
+        pass
+
+    def videoDataReceived(self, data, timestamp, chunks=None):
+        self.received.append(('video', data, timestamp))
+
+    def audioDataReceived(self, data, timestamp, chunks=None):
+        self.received.append(('audio', data, timestamp))
+
+    def unpublish(self):
+        pass
+
+
+
+class ReplayTestCase(unittest.TestCase):
+    """
+    Tests for L{server.StreamPublisher.replay}
+    """
+
+    def setUp(self):
+        self.cache = server.GOPCache()
+        self.publisher = server.StreamPublisher(None, None, self.cache)
+
+    def test_replay(self):
+        p = self.publisher
+
+        p.videoDataReceived('\x17\x00', 0)
+        p.videoDataReceived('\x27\x01a', 100)
+        p.videoDataReceived('\x17\x01b', 200)
+        p.audioDataReceived('\xaf\x01c', 210)
+        p.videoDataReceived('\x27\x01d', 240)
+
+        s = SubscriberRecorder()
+
+        p.addSubscriber(s)
+        p.replay(s)
+
+        self.assertEqual(s.received, [
+            ('video', '\x17\x00', 0),
+            ('video', '\x17\x01b', 0),
+            ('audio', '\xaf\x01c', 10),
+            ('video', '\x27\x01d', 40),
+        ])
+
+        p.videoDataReceived('\x27\x01e', 280)
+
+        self.assertEqual(s.received[-1], ('video', '\x27\x01e', 80))
+
+    def test_no_cache(self):
+        p = server.StreamPublisher(None, None)
+        s = SubscriberRecorder()
+
+        p.videoDataReceived('\x17\x01b', 200)
+        p.addSubscriber(s)
+        p.replay(s)
+
+        self.assertEqual(s.received, [])
+
+    def test_sequence_headers(self):
+        """
+        Sequence headers are cached even if there is no GOP cache and are
+        replayed first.
+        """
+        p = server.StreamPublisher(None, None)
+
+        p.audioDataReceived('\xaf\x00a', 0)
+        p.videoDataReceived('\x17\x00v', 0)
+        p.videoDataReceived('\x17\x01b', 2000)
+
+        self.assertEqual(p.videoSequenceHeader, '\x17\x00v')
+        self.assertEqual(p.audioSequenceHeader, '\xaf\x00a')
+
+        s = SubscriberRecorder()
+
+        p.addSubscriber(s)
+        p.replay(s)
+
+        self.assertEqual(s.received, [
+            ('video', '\x17\x00v', 0),
+            ('audio', '\xaf\x00a', 0),
+        ])
+
+        p.unpublish()
+
+        self.assertEqual(p.videoSequenceHeader, None)
+        self.assertEqual(p.audioSequenceHeader, None)
+
+    def test_sequence_header_not_cached(self):
+        """
+        Sequence headers do not end up in the GOP cache.
+        """
+        p = self.publisher
+
+        p.videoDataReceived('\x17\x01b', 200)
+        p.videoDataReceived('\x17\x00v', 210)
+
+        self.assertEqual(self.cache.frames,
+            [(message.VIDEO_DATA, '\x17\x01b', 200)])
+
+    def test_unpublish(self):
+        self.publisher.videoDataReceived('\x17\x01b', 200)
+        self.publisher.unpublish()
+
+        self.assertEqual(self.cache.frames, [])
+
+    def test_application(self):
+        app = server.Application()
+        cache = app.buildGOPCache()
+
+        self.assertEqual(cache.maxBytes, app.gopCacheSize)
+        self.assertIdentical(cache.limit, app.gopCacheLimit)
+
+        app.gopCacheSize = 0
+
+        self.assertEqual(app.buildGOPCache(), None)
+
+
+
+class MediaQueueTestCase(unittest.TestCase):
+    """
+    Tests for L{server.MediaQueue}
+    """
+
+    def setUp(self):
+        self.queue = server.MediaQueue(maxBytes=10)
+
+    def push(self, *frames):
+        for datatype, data, timestamp in frames:
+            self.queue.push(datatype, data, timestamp)
+
+    def assertFrames(self, *expected):
+        self.assertEqual([f[:3] for f in self.queue.frames], list(expected))
+        self.assertEqual(self.queue.size,
+            sum([len(f[1]) for f in self.queue.frames]))
+
+    def test_push_pop(self):
+        self.push((message.VIDEO_DATA, '\x17\x01a', 0))
+
+        self.assertEqual(len(self.queue), 1)
+        self.assertEqual(self.queue.size, 3)
+        self.assertEqual(self.queue.pop(),
+            (message.VIDEO_DATA, '\x17\x01a', 0, None))
+        self.assertEqual(self.queue.size, 0)
+
+    def test_disposable(self):
+        """
+        Disposable frames are dropped first.
+        """
+        self.push(
+            (message.VIDEO_DATA, '\x17\x01a', 0),
+            (message.VIDEO_DATA, '\x37\x01b', 40),
+            (message.VIDEO_DATA, '\x27\x01c', 80),
+            (message.VIDEO_DATA, '\x37\x01d', 120))
+
+        self.assertFrames(
+            (message.VIDEO_DATA, '\x17\x01a', 0),
+            (message.VIDEO_DATA, '\x27\x01c', 80))
+
+        self.assertEqual(self.queue.droppedFrames, 2)
+        self.assertEqual(self.queue.droppedDisposableFrames, 2)
+        self.assertEqual(self.queue.droppedBytes, 6)
+        self.assertFalse(self.queue.waitingForKeyframe)
+
+    def test_keyframe(self):
+        """
+        Video up to the last queued keyframe is dropped, audio is kept.
+        """
+        self.push(
+            (message.VIDEO_DATA, '\x17\x01a', 0),
+            (message.AUDIO_DATA, '\xaf\x01b', 10),
+            (message.VIDEO_DATA, '\x27\x01c', 40),
+            (message.VIDEO_DATA, '\x17\x01d', 80))
+
+        self.assertFrames(
+            (message.AUDIO_DATA, '\xaf\x01b', 10),
+            (message.VIDEO_DATA, '\x17\x01d', 80))
+
+        self.assertEqual(self.queue.droppedFrames, 2)
+        self.assertEqual(self.queue.droppedDisposableFrames, 0)
+        self.assertFalse(self.queue.waitingForKeyframe)
+
+    def test_no_keyframe(self):
+        """
+        Without a keyframe to skip to, all queued video is dropped and video
+        is discarded until the next keyframe.
+        """
+        self.push(
+            (message.VIDEO_DATA, '\x17\x00s', 0),
+            (message.AUDIO_DATA, '\xaf\x01a', 0),
+            (message.VIDEO_DATA, '\x27\x01b', 40),
+            (message.VIDEO_DATA, '\x27\x01c', 80))
+
+        self.assertFrames(
+            (message.VIDEO_DATA, '\x17\x00s', 0),
+            (message.AUDIO_DATA, '\xaf\x01a', 0))
+        self.assertTrue(self.queue.waitingForKeyframe)
+
+        self.push(
+            (message.VIDEO_DATA, '\x27\x01d', 120),
+            (message.AUDIO_DATA, '\xaf\x01e', 130))
+
+        self.assertFrames(
+            (message.VIDEO_DATA, '\x17\x00s', 0),
+            (message.AUDIO_DATA, '\xaf\x01a', 0),
+            (message.AUDIO_DATA, '\xaf\x01e', 130))
+        self.assertEqual(self.queue.droppedFrames, 3)
+
+        self.queue.pop()
+        self.queue.pop()
+        self.push((message.VIDEO_DATA, '\x17\x01f', 160))
+
+        self.assertFrames(
+            (message.AUDIO_DATA, '\xaf\x01e', 130),
+            (message.VIDEO_DATA, '\x17\x01f', 160))
+        self.assertFalse(self.queue.waitingForKeyframe)
+
+    def test_duration(self):
+        self.queue = server.MediaQueue(maxDuration=100)
+
+        self.push(
+            (message.VIDEO_DATA, '\x17\x01a', 0),
+            (message.VIDEO_DATA, '\x27\x01b', 40),
+            (message.VIDEO_DATA, '\x17\x01c', 120))
+
+        self.assertFrames((message.VIDEO_DATA, '\x17\x01c', 120))
+
+    def test_pinned(self):
+        """
+        Pinned frames are never dropped and do not count towards the limits.
+        """
+        self.queue.push(message.VIDEO_DATA, '\x27\x01a', 0, pinned=True)
+        self.queue.push(message.VIDEO_DATA, '\x27\x01b', 40, pinned=True)
+        self.queue.push(message.VIDEO_DATA, '\x27\x01c', 80, pinned=True)
+        self.queue.push(message.VIDEO_DATA, '\x27\x01d', 120, pinned=True)
+
+        self.assertEqual(self.queue.pinned, 4)
+        self.assertFalse(self.queue.waitingForKeyframe)
+
+        self.push(
+            (message.VIDEO_DATA, '\x27\x01e', 160),
+            (message.VIDEO_DATA, '\x27\x01f', 200),
+            (message.VIDEO_DATA, '\x27\x01g', 240),
+            (message.VIDEO_DATA, '\x27\x01h', 280))
+
+        self.assertFrames(
+            (message.VIDEO_DATA, '\x27\x01a', 0),
+            (message.VIDEO_DATA, '\x27\x01b', 40),
+            (message.VIDEO_DATA, '\x27\x01c', 80),
+            (message.VIDEO_DATA, '\x27\x01d', 120))
+        self.assertTrue(self.queue.waitingForKeyframe)
+
+        self.queue.pop()
+
+        self.assertEqual(self.queue.pinned, 3)
+        self.assertEqual(self.queue.pinnedSize, 9)
+
+    def test_pinned_behind_live(self):
+        """
+        Frames can only be pinned at the head of the queue.
+        """
+        self.push((message.VIDEO_DATA, '\x17\x01a', 0))
+        self.queue.push(message.VIDEO_DATA, '\x27\x01b', 40, pinned=True)
+
+        self.assertEqual(self.queue.pinned, 0)
+
+
+
+class ChannelRecorder(object):
+    """
+    Records the data sent to a streaming channel.
+    """
+
+    def __init__(self, sent):
+        self.sent = sent
+
+    def sendData(self, data, timestamp, chunks=None):
+        self.sent.append((data, timestamp))
+
+
+
+class QueueingTestCase(unittest.TestCase):
+    """
+    Tests for queueing a/v data in L{server.NetStream}.
+    """
+
+    def setUp(self):
+        self.writable = True
+        self.sent = []
+
+        test = self
+
+        class Protocol(object):
+            def isWritable(self):
+                return test.writable
+
+        class NetConnection(object):
+            protocol = Protocol()
+
+        self.stream = server.NetStream(NetConnection(), 1)
+        self.stream._audioChannel = ChannelRecorder(self.sent)
+        self.stream._videoChannel = ChannelRecorder(self.sent)
+
+    def test_writable(self):
+        self.stream.videoDataReceived('\x17\x01a', 0)
+        self.stream.audioDataReceived('\xaf\x01b', 10)
+
+        self.assertEqual(self.sent, [('\x17\x01a', 0), ('\xaf\x01b', 10)])
+        self.assertEqual(len(self.stream.queue), 0)
+
+    def test_congested(self):
+        self.writable = False
+
+        self.stream.videoDataReceived('\x17\x01a', 0)
+        self.stream.audioDataReceived('\xaf\x01b', 10)
+
+        self.assertEqual(self.sent, [])
+        self.assertEqual(len(self.stream.queue), 2)
+
+        self.writable = True
+        self.stream.videoDataReceived('\x27\x01c', 40)
+
+        self.assertEqual(self.sent,
+            [('\x17\x01a', 0), ('\xaf\x01b', 10), ('\x27\x01c', 40)])
+        self.assertEqual(len(self.stream.queue), 0)
+
+    def test_flush(self):
+        self.writable = False
+
+        self.stream.videoDataReceived('\x17\x01a', 0)
+
+        self.writable = True
+        self.stream.flushQueue()
+
+        self.assertEqual(self.sent, [('\x17\x01a', 0)])
+
+    def test_replay(self):
+        """
+        A replayed GOP that has to be queued is not shed, however long it is.
+        """
+        self.stream.queue = server.MediaQueue(maxDuration=100)
+        self.stream.replaying = True
+
+        self.stream.videoDataReceived('\x17\x01a', 0)
+        self.writable = False
+
+        for i in xrange(1, 125):
+            self.stream.videoDataReceived('\x27\x01b', i * 40)
+
+        self.stream.replaying = False
+
+        self.assertEqual(len(self.stream.queue), 124)
+        self.assertEqual(self.stream.queue.droppedFrames, 0)
+
+        self.writable = True
+        self.stream.flushQueue()
+
+        self.assertEqual(len(self.sent), 125)
+
+
+
+class ResumeEncodingTestCase(ServerFactoryTestCase):
+    """
+    Tests for L{server.ServerProtocol.resumeEncoding}
+    """
+
+    def test_flush(self):
+        """
+        Queued a/v is written when the protocol resumes encoding.
+        """
+        s = self.createStream(self.manager)
+        flushed = []
+
+        self.patch(s, 'flushQueue', lambda: flushed.append(s))
+
+        self.protocol.resumeEncoding()
+        self.assertEqual(flushed, [])
+
+        self.protocol.pauseProducing()
+        self.protocol.resumeProducing()
+
+        self.assertEqual(flushed, [s])
+
+    def test_bytes_read(self):
+        """
+        Queued a/v is written when the peer acknowledges data.
+        """
+        s = self.createStream(self.manager)
+        flushed = []
+
+        self.patch(s, 'flushQueue', lambda: flushed.append(s))
+
+        self.protocol.onBytesRead(1000, 0)
+
+        self.assertEqual(flushed, [s])
+
+
+
+class ShapingTestCase(ServerFactoryTestCase):
+    """
+    Tests for configuring the bandwidth shaping of a connection.
+    """
+
+    def test_application(self):
+        app = server.Application()
+
+        self.assertEqual(app.buildShaper(None), None)
+
+        app.clientBandwidth = 1000
+        shaper = app.buildShaper(None)
+
+        self.assertIsInstance(shaper, shaping.TokenBucket)
+        self.assertEqual(shaper.rate, 1000)
+        self.assertEqual(shaper.burst, 1000)
+
+        app.clientBurst = 500
+
+        self.assertEqual(app.buildShaper(None).burst, 500)
+
+    def test_client(self):
+        client = self.connect(server.Application(), self.protocol)
+
+        self.assertEqual(self.protocol.shaper, None)
+
+        client.setBandwidthLimit(1000, 2000)
+
+        self.assertEqual(self.protocol.shaper.rate, 1000)
+        self.assertEqual(self.protocol.shaper.burst, 2000)
+
+        client.setBandwidthLimit(0)
+
+        self.assertEqual(self.protocol.shaper, None)
+        self.assertEqual(self.protocol.encoder.bytesLimit, 0)